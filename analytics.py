@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Price and volume analytics over parsed transactions, computed with NumPy array operations on the columns of a
+TransactionBatch, so years of transactions take seconds. Needs numpy.
+
+    $ python analytics.py <PATH TO DIRECTORY OF DAY REPORT TEXT FILES> --from 2015-01-01 --to 2015-03-31
+
+Every function takes the dict of columns from TransactionBatch.as_numpy() (or concat_columns of several) and
+ignores rows it can't use, like carwash-only rows for anything about gas, or rows without a time.
+"""
+import argparse
+from datetime import datetime, timedelta
+import functools
+import multiprocessing
+import sys
+import numpy
+from parse import Gas, INDEX_SUFFIX, TransactionBatch, get_code_name, get_date_for_day_file, get_day_files, get_gas_transactions_for_day, get_month_directories, map_day_files
+
+GRADES = [g.name for g in Gas]
+PUMPS = 16
+
+
+def concat_columns(batches):
+    """One dict of columns out of several, batches is a list of as_numpy() dicts"""
+    return dict((column, numpy.concatenate([b[column] for b in batches])) for column in batches[0])
+
+
+def get_gas_rows(columns):
+    """Mask of the rows that sold gas with a known volume and price"""
+    return (columns['gas_type'] > 0) & ~numpy.isnan(columns['volume']) & ~numpy.isnan(columns['price'])
+
+
+def get_revenue(columns):
+    """Dollars of gas sold in each row, to the cent"""
+    return numpy.round(columns['volume'] * columns['price'], 2)
+
+
+def get_timestamps(columns):
+    """Seconds since 1/1/1 of each row, -1 for rows without a date or time"""
+    timestamps = columns['day'].astype(numpy.int64) * 86400 + columns['seconds']
+    return numpy.where((columns['day'] > 0) & (columns['seconds'] >= 0), timestamps, -1)
+
+
+def drop_duplicates(columns):
+    """
+    Drop the rows whose transaction id, day and time are an earlier row's, like those of a day exported twice or of
+    month directories that overlap. Rows missing any of them are kept. Returns (the columns left, the dropped rows).
+    """
+    timestamps = get_timestamps(columns)
+    keyed = numpy.flatnonzero((columns['txn_id'] > 0) & (timestamps >= 0))
+    # lexsort is stable, so each key's first row comes first and is the one kept
+    order = keyed[numpy.lexsort((columns['txn_id'][keyed], timestamps[keyed]))]
+    txn_ids, timestamps = columns['txn_id'][order], timestamps[order]
+    repeats = (txn_ids[1:] == txn_ids[:-1]) & (timestamps[1:] == timestamps[:-1])
+    dropped = numpy.zeros(len(columns['txn_id']), dtype=bool)
+    dropped[order[1:][repeats]] = True
+    return dict((c, v[~dropped]) for c, v in columns.items()), dict((c, v[dropped]) for c, v in columns.items())
+
+
+def get_day_count(columns):
+    """"""
+    days = columns['day'][columns['day'] > 0]
+    return len(numpy.unique(days))
+
+
+def hourly_volume_profile(columns):
+    """
+    Gallons sold in each hour of the day by grade, averaged over the days in the batch. Returns a 24 x grades array,
+    grades in GRADES order.
+    """
+    rows = get_gas_rows(columns) & (columns['seconds'] >= 0)
+    hours = columns['seconds'][rows] // 3600
+    grades = columns['gas_type'][rows].astype(numpy.int64) - 1
+    gallons = numpy.bincount(hours * len(GRADES) + grades, weights=columns['volume'][rows], minlength=24 * len(GRADES))
+    return gallons.reshape(24, len(GRADES)) / max(get_day_count(columns), 1)
+
+
+def pump_utilization(columns, pumps=PUMPS):
+    """
+    Per pump number (index 0 is unused): sales, gallons, revenue, and utilization as the share of the batch's hours
+    in which the pump made at least one sale. Returns a dict of arrays of length pumps + 1.
+    """
+    rows = get_gas_rows(columns) & (columns['pump_num'] > 0) & (columns['pump_num'] <= pumps)
+    pump = columns['pump_num'][rows].astype(numpy.int64)
+    size = pumps + 1
+    timestamps = get_timestamps(columns)[rows]
+    timed = timestamps >= 0
+    # Distinct (hour, pump) pairs are the hours each pump was busy
+    busy = numpy.unique((timestamps[timed] // 3600) * size + pump[timed])
+    busy_hours = numpy.bincount(busy % size, minlength=size)
+    return {
+        'sales': numpy.bincount(pump, minlength=size),
+        'gallons': numpy.bincount(pump, weights=columns['volume'][rows], minlength=size),
+        'revenue': numpy.bincount(pump, weights=get_revenue(columns)[rows], minlength=size),
+        'utilization': busy_hours / float(max(get_day_count(columns), 1) * 24),
+    }
+
+
+def revenue_by_grade(columns):
+    """Per grade, in GRADES order: sales, gallons, revenue and the average price per gallon paid"""
+    rows = get_gas_rows(columns)
+    grades = columns['gas_type'][rows].astype(numpy.int64) - 1
+    gallons = numpy.bincount(grades, weights=columns['volume'][rows], minlength=len(GRADES))
+    revenue = numpy.bincount(grades, weights=get_revenue(columns)[rows], minlength=len(GRADES))
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        average_price = revenue / gallons
+    return {'sales': numpy.bincount(grades, minlength=len(GRADES)), 'gallons': gallons, 'revenue': revenue, 'average_price': average_price}
+
+
+def price_segments(columns):
+    """
+    Split each grade's sales, in time order, into runs at one price. A price is taken to hold from its first sale
+    until the grade's next price change (or its own last sale, for the latest price). Returns a dict of arrays, one
+    entry per run, ordered by grade and then time: grade (code), price, start, end, sales, gallons and gallons_per_hour.
+    """
+    rows = get_gas_rows(columns) & (get_timestamps(columns) >= 0)
+    grade = columns['gas_type'][rows].astype(numpy.int64)
+    price = columns['price'][rows]
+    timestamps = get_timestamps(columns)[rows]
+    volume = columns['volume'][rows]
+    order = numpy.lexsort((timestamps, grade))
+    grade, price, timestamps, volume = grade[order], price[order], timestamps[order], volume[order]
+    if not len(grade):
+        return dict((k, numpy.array([])) for k in ('grade', 'price', 'start', 'end', 'sales', 'gallons', 'gallons_per_hour'))
+    new_segment = numpy.ones(len(grade), dtype=bool)
+    new_segment[1:] = (grade[1:] != grade[:-1]) | (price[1:] != price[:-1])
+    starts = numpy.flatnonzero(new_segment)
+    segment = numpy.cumsum(new_segment) - 1
+    seg_grade = grade[starts]
+    start = timestamps[starts]
+    last_sale = numpy.maximum.reduceat(timestamps, starts)
+    # A price lasts until the next segment of the same grade starts
+    end = last_sale.copy()
+    same_grade_next = seg_grade[1:] == seg_grade[:-1]
+    end[:-1][same_grade_next] = start[1:][same_grade_next]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        gallons = numpy.bincount(segment, weights=volume)
+        gallons_per_hour = numpy.where(end > start, gallons / ((end - start) / 3600.0), numpy.nan)
+    return {'grade': seg_grade, 'price': price[starts], 'start': start, 'end': end, 'sales': numpy.bincount(segment), 'gallons': gallons, 'gallons_per_hour': gallons_per_hour}
+
+
+def price_elasticities(segments):
+    """
+    Arc elasticity of the gallons sold per hour across each price change: the percent change in the rate of sales
+    over the percent change in price, both relative to the midpoint. Returns a dict of arrays, one entry per change:
+    grade, old_price, new_price, at (the start of the new price) and elasticity.
+    """
+    change = numpy.flatnonzero(segments['grade'][1:] == segments['grade'][:-1])
+    old, new = change, change + 1
+    old_rate, new_rate = segments['gallons_per_hour'][old], segments['gallons_per_hour'][new]
+    old_price, new_price = segments['price'][old], segments['price'][new]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        rate_change = (new_rate - old_rate) / ((new_rate + old_rate) / 2)
+        price_change = (new_price - old_price) / ((new_price + old_price) / 2)
+        elasticity = rate_change / price_change
+    return {'grade': segments['grade'][new], 'old_price': old_price, 'new_price': new_price, 'at': segments['start'][new], 'elasticity': elasticity}
+
+
+def load_day_columns(day_path, use_index=False):
+    """Pool worker body: a day file's transactions as NumPy columns"""
+    gas_txns, carwash_txns = get_gas_transactions_for_day(day_path, use_index)
+    return TransactionBatch.from_txns(gas_txns, carwash_txns).as_numpy()
+
+
+def load_columns(months_directory_path, workers, start=None, end=None, use_index=False, keep_duplicates=False):
+    """
+    The transactions of every day file in [start, end] ('YYYY-MM-DD', either may be None) as NumPy columns. Unless
+    keep_duplicates, transactions in more than one day file are only kept once, see drop_duplicates.
+    """
+    day_files = [df for d in get_month_directories(months_directory_path) for df in get_day_files(d)]
+    day_files = [df for df in day_files if (not start or get_date_for_day_file(df).strftime('%Y-%m-%d') >= start) and (not end or get_date_for_day_file(df).strftime('%Y-%m-%d') <= end)]
+    batches = list(map_day_files(functools.partial(load_day_columns, use_index=use_index), day_files, workers))
+    columns = concat_columns(batches) if batches else TransactionBatch().as_numpy()
+    if not keep_duplicates:
+        columns, dropped = drop_duplicates(columns)
+        for txn_id, timestamp in zip(dropped['txn_id'], get_timestamps(dropped)):
+            print '\tDuplicate txn: {0} at {1}'.format(txn_id, format_timestamp(timestamp))
+    return columns
+
+
+def format_timestamp(timestamp):
+    """"""
+    return (datetime.fromordinal(int(timestamp // 86400)) + timedelta(seconds=int(timestamp % 86400))).strftime('%m/%d/%y %H:%M')
+
+
+def print_report(columns, pumps=PUMPS):
+    """"""
+    print 'Revenue by grade'
+    by_grade = revenue_by_grade(columns)
+    print '{0:<10}{1:>10}{2:>14}{3:>14}{4:>10}'.format('', 'sales', 'gallons', 'revenue', '$/gal')
+    for i, grade in enumerate(GRADES):
+        print '{0:<10}{1:>10}{2:>14.1f}{3:>14.2f}{4:>10.3f}'.format(grade, by_grade['sales'][i], by_grade['gallons'][i], by_grade['revenue'][i], by_grade['average_price'][i])
+
+    print '\nAverage gallons per day by hour'
+    profile = hourly_volume_profile(columns)
+    print '{0:<10}'.format('hour') + ''.join('{0:>10}'.format(g) for g in GRADES)
+    for hour in xrange(24):
+        print '{0:<10}'.format('{0:02d}:00'.format(hour)) + ''.join('{0:>10.1f}'.format(v) for v in profile[hour])
+
+    print '\nPumps'
+    pumps_used = pump_utilization(columns, pumps)
+    print '{0:<10}{1:>10}{2:>14}{3:>14}{4:>10}'.format('pump', 'sales', 'gallons', 'revenue', 'busy')
+    for pump in numpy.flatnonzero(pumps_used['sales']):
+        print '{0:<10}{1:>10}{2:>14.1f}{3:>14.2f}{4:>9.0f}%'.format(pump, pumps_used['sales'][pump], pumps_used['gallons'][pump], pumps_used['revenue'][pump], pumps_used['utilization'][pump] * 100)
+
+    print '\nPrice changes'
+    changes = price_elasticities(price_segments(columns))
+    print '{0:<16}{1:<10}{2:>10}{3:>10}{4:>12}'.format('from', 'grade', 'old', 'new', 'elasticity')
+    for i in xrange(len(changes['grade'])):
+        print '{0:<16}{1:<10}{2:>10.3f}{3:>10.3f}{4:>12.2f}'.format(format_timestamp(changes['at'][i]), get_code_name(Gas, changes['grade'][i]), changes['old_price'][i], changes['new_price'][i], changes['elasticity'][i])
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Price and volume analytics over Blue Cube day reports.')
+    arg_parser.add_argument('months_directory_path')
+    arg_parser.add_argument('--from', dest='start', metavar='YYYY-MM-DD')
+    arg_parser.add_argument('--to', dest='end', metavar='YYYY-MM-DD')
+    arg_parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of day files to parse in parallel (default: number of cores)')
+    arg_parser.add_argument('--pumps', type=int, default=PUMPS, help='highest pump number (default: {0})'.format(PUMPS))
+    arg_parser.add_argument('--index', action='store_true', help='keep a {0} file next to each day file with where its lines and transactions start, so parsing it again skips finding them'.format(INDEX_SUFFIX))
+    arg_parser.add_argument('--keep-duplicates', action='store_true', help='keep transactions whose id, date and time were already seen, like those of a day exported twice')
+    opts = arg_parser.parse_args(args[1:])
+    print_report(load_columns(opts.months_directory_path, opts.workers, opts.start, opts.end, opts.index, opts.keep_duplicates), opts.pumps)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks each stage of a run over a set of day reports: parsing (memory-mapped, streamed and through the sidecar
+indexes), counting, and writing the workbook (patched and streamed). Every stage runs in its own process, so the peak
+memory reported is that stage's alone.
+
+    $ python bench.py --days 31 --txns-per-day 5000
+    $ python bench.py --input <PATH TO DIRECTORY OF DAY REPORT TEXT FILES> --json bench.json
+
+Without --input the reports are generated into a temporary directory with generate_reports.py first.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import generate_reports
+import parse
+
+
+def parse_mmap_stage(day_files):
+    """"""
+    txns = 0
+    for df in day_files:
+        gas_txns, carwash_txns = parse.get_gas_transactions_for_day(df)
+        txns += len(gas_txns) + len(carwash_txns)
+    return txns
+
+
+def parse_stream_stage(day_files):
+    """"""
+    txns = 0
+    for df in day_files:
+        with open(df) as day:
+            gas_txns, carwash_txns = parse.get_gas_transactions_from_lines(day)
+        txns += len(gas_txns) + len(carwash_txns)
+    return txns
+
+
+def parse_indexed_stage(day_files):
+    """Parse through each day file's sidecar index, made first and not timed (and left behind with --input)"""
+    for df in day_files:
+        parse.get_gas_transactions_for_day(df, use_index=True)
+    start = time.time()
+    txns = 0
+    for df in day_files:
+        gas_txns, carwash_txns = parse.get_gas_transactions_for_day(df, use_index=True)
+        txns += len(gas_txns) + len(carwash_txns)
+    return txns, time.time() - start
+
+
+def aggregate_stage(day_files):
+    """"""
+    days = [(parse.get_date_for_day_file(df), parse.get_gas_transactions_for_day(df)) for df in day_files]
+    start = time.time()
+    txns = 0
+    for date_obj, (gas_txns, carwash_txns) in days:
+        parse.DayAnalyzer(gas_txns, date_obj, None, carwash_txns).get_cell_values()
+        txns += len(gas_txns) + len(carwash_txns)
+    return txns, time.time() - start
+
+
+def get_manifest(day_files, directory):
+    """A manifest holding the values of every day file, as a run would have left it"""
+    volume_buckets = parse.VolumeBuckets()
+    manifest = parse.IngestManifest(os.path.join(directory, 'bench.manifest.json'), volume_buckets)
+    for df, (date_obj, values, sha1, stats_record, leftovers, keys) in zip(day_files, parse.analyze_day_files(day_files, 1, volume_buckets)):
+        manifest.update(df, os.stat(df), sha1, values, leftovers, keys)
+    return manifest, volume_buckets
+
+
+def workbook_stage(day_files, directory):
+    """"""
+    manifest, volume_buckets = get_manifest(day_files, directory)
+    start = time.time()
+    wb = parse.create_workbook()
+    for month_dir, month_files in manifest.get_months():
+        parse.update_month_worksheet(wb, month_dir, month_files, manifest, volume_buckets)
+    wb.save(os.path.join(directory, 'bench.xlsx'))
+    return len(day_files), time.time() - start
+
+
+def workbook_streaming_stage(day_files, directory):
+    """"""
+    manifest, volume_buckets = get_manifest(day_files, directory)
+    start = time.time()
+    parse.write_workbook_streaming(os.path.join(directory, 'bench-streaming.xlsx'), manifest, volume_buckets)
+    return len(day_files), time.time() - start
+
+
+STAGES = [
+    ('parse (mmap)', parse_mmap_stage, 'txns'),
+    ('parse (stream)', parse_stream_stage, 'txns'),
+    ('parse (indexed)', parse_indexed_stage, 'txns'),
+    ('aggregate', aggregate_stage, 'txns'),
+    ('workbook', workbook_stage, 'days'),
+    ('workbook (streaming)', workbook_streaming_stage, 'days'),
+]
+
+
+def run_stage(stage, day_files, directory, queue):
+    """Child process body: time the stage and report its result and peak memory"""
+    # Keep the parser's progress output out of the report
+    sys.stdout = open(os.devnull, 'w')
+    # Stages that need setup time themselves and return (count, seconds), the others are timed whole
+    start = time.time()
+    if stage in (parse_mmap_stage, parse_stream_stage):
+        count = stage(day_files)
+        seconds = time.time() - start
+    elif stage in (parse_indexed_stage, aggregate_stage):
+        count, seconds = stage(day_files)
+    else:
+        count, seconds = stage(day_files, directory)
+    queue.put((count, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def get_input_mb(day_files):
+    """"""
+    return sum(os.path.getsize(df) for df in day_files) / 1048576.0
+
+
+def bench_stage(name, stage, unit, day_files, directory, repeat):
+    """Run a stage repeat times in fresh processes and keep the fastest"""
+    best = None
+    for _ in xrange(repeat):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_stage, args=(stage, day_files, directory, queue))
+        process.start()
+        count, seconds, peak_rss = queue.get()
+        process.join()
+        if best is None or seconds < best[1]:
+            best = (count, seconds, peak_rss)
+    count, seconds, peak_rss = best
+    input_mb = get_input_mb(day_files)
+    result = {'stage': name, 'seconds': seconds, unit: count, '{0}_per_sec'.format(unit): count / seconds if seconds else None, 'peak_rss_kb': peak_rss}
+    if unit == 'txns':
+        result['mb_per_sec'] = input_mb / seconds if seconds else None
+    return result
+
+
+def bench(day_files, directory, repeat=3):
+    """Benchmark every stage over day_files, returns a result dict per stage"""
+    return [bench_stage(name, stage, unit, day_files, directory, repeat) for name, stage, unit in STAGES]
+
+
+def print_results(results, day_count, input_mb):
+    """"""
+    print '{0} day files, {1:.1f} MB'.format(day_count, input_mb)
+    print '{0:<22}{1:>10}{2:>14}{3:>10}{4:>14}'.format('stage', 'seconds', 'per sec', 'MB/sec', 'peak RSS MB')
+    for r in results:
+        rate = r.get('txns_per_sec', r.get('days_per_sec'))
+        unit = 'txns' if 'txns' in r else 'days'
+        mb_rate = '{0:.1f}'.format(r['mb_per_sec']) if r.get('mb_per_sec') else '-'
+        print '{0:<22}{1:>10.3f}{2:>9.0f} {3:<4}{4:>10}{5:>14.1f}'.format(r['stage'], r['seconds'], rate or 0, unit, mb_rate, r['peak_rss_kb'] / 1024.0)
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Benchmark parsing, counting and workbook writing.')
+    arg_parser.add_argument('--input', metavar='DIR', help='directory of month directories to benchmark on instead of generated reports')
+    arg_parser.add_argument('--days', type=int, default=31)
+    arg_parser.add_argument('--txns-per-day', type=int, default=2000)
+    arg_parser.add_argument('--stations', type=int, default=1)
+    arg_parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the fastest is reported')
+    arg_parser.add_argument('--json', metavar='PATH', help='also write the results to PATH as JSON')
+    opts = arg_parser.parse_args(args[1:])
+
+    directory = tempfile.mkdtemp(prefix='chevron-bench-')
+    try:
+        if opts.input:
+            day_files = [df for d in parse.get_month_directories(opts.input) for df in parse.get_day_files(d)]
+        else:
+            day_files = generate_reports.generate(os.path.join(directory, 'reports'), opts.days, opts.txns_per_day, opts.stations)
+        results = bench(day_files, directory, opts.repeat)
+        input_mb = get_input_mb(day_files)
+    finally:
+        shutil.rmtree(directory)
+    print_results(results, len(day_files), input_mb)
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
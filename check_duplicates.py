@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Regression check for duplicate transactions in the workbook: generates day reports with generate_reports.py and makes
+the workbook (with rollups) from them, then re-exports days the way Blue Cube does and runs parse.py again on the
+same workbook. One day is exported a second time into the next month's directory, and another day's file is exported
+again starting with the last transactions of the day before it. The counts must come out as they were: every column
+of the first run unchanged, the second copy's column all zeros and the rollups the same apart from their days row.
+Runs sequentially and with --pipeline. Exits non-zero if any workbook is off or any run fails.
+
+    $ python check_duplicates.py --days 40 --txns-per-day 300
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import generate_reports
+import parse
+from check_pipeline import make_workbook
+
+
+def get_columns(cell_values):
+    """{sheet title: {column header: [values]}} of get_cell_values, leaving out the label column and the rollups' days row"""
+    sheets = {}
+    for title, rows in cell_values:
+        if not rows:
+            continue
+        sheets[title] = dict((header, [row[i] for row in rows[1:] if row[0] != 'Days']) for i, header in enumerate(rows[0]) if i and header is not None)
+    return sheets
+
+
+def re_export(months_directory_path):
+    """Add the re-exported day files, returns what a column of nothing but duplicates is headed by and in which sheet"""
+    month_dirs = parse.get_month_directories(months_directory_path)
+    january, february = month_dirs[0], month_dirs[1]
+    copied = parse.get_day_files(january)[9]
+    shutil.copy(copied, os.path.join(february, os.path.basename(copied)))
+    # The day after starts again with the last third of its day before's transactions
+    day_before, day = parse.get_day_files(january)[10:12]
+    with parse.open_day_buffer(day_before) as buf:
+        blocks = list(parse.iter_mapped_txn_blocks(buf))
+        overlap = buf[blocks[len(blocks) * 2 // 3].line_offsets[0]:len(buf)]
+    with open(day) as f:
+        text = f.read()
+    with open(day, 'w') as f:
+        f.write(overlap + text)
+    return parse.get_worksheet_title(february), parse.get_date_for_day_file(copied).strftime('%m/%d')
+
+
+def check_workbook(expected, values, extra_sheet, extra_header):
+    """Problems with values against expected, see the module docstring"""
+    problems = []
+    actual = get_columns(values)
+    for title, columns in get_columns(expected).items():
+        for header, column in columns.items():
+            if actual.get(title, {}).get(header) != column:
+                problems.append('{0} {1} is {2}, was {3}'.format(title, header, actual.get(title, {}).get(header), column))
+    extra = actual.get(extra_sheet, {}).get(extra_header)
+    if extra is None or any(extra):
+        problems.append('{0} {1} should be all zeros, is {2}'.format(extra_sheet, extra_header, extra))
+    return problems
+
+
+def check(reports, directory, options):
+    """True if re-exported days don't change the workbook parse.py keeps up to date with options"""
+    months_directory_path = os.path.join(directory, 'months')
+    shutil.copytree(reports, months_directory_path)
+    excel_workbook_path = os.path.join(directory, 'duplicates.xlsx')
+    expected = make_workbook(months_directory_path, excel_workbook_path, ['--rollups'] + options)
+    if expected is None:
+        return False
+    extra_sheet, extra_header = re_export(months_directory_path)
+    values = make_workbook(months_directory_path, excel_workbook_path, ['--rollups'] + options)
+    problems = ['run failed'] if values is None else check_workbook(expected, values, extra_sheet, extra_header)
+    print '{0:<28}{1}'.format(' '.join(options) or 'sequential', 'same' if not problems else 'DIFFERENT')
+    for problem in problems[:10]:
+        print '\t' + problem
+    return not problems
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Check that re-exported day files don\'t change the workbook counts.')
+    arg_parser.add_argument('--days', type=int, default=40)
+    arg_parser.add_argument('--txns-per-day', type=int, default=300)
+    arg_parser.add_argument('--workers', type=int, default=2)
+    opts = arg_parser.parse_args(args[1:])
+
+    directory = tempfile.mkdtemp(prefix='chevron-check-')
+    try:
+        reports = os.path.join(directory, 'reports')
+        generate_reports.generate(reports, opts.days, opts.txns_per_day)
+        ok = True
+        for i, options in enumerate((['--workers', str(opts.workers)], ['--pipeline', '--workers', str(opts.workers)])):
+            run_directory = os.path.join(directory, str(i))
+            os.mkdir(run_directory)
+            ok = check(reports, run_directory, options) and ok
+    finally:
+        shutil.rmtree(directory)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
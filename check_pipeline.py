@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Regression check for --pipeline: generates day reports with generate_reports.py, makes the workbook with a plain
+sequential run, then again with --pipeline at 1 and N workers, and compares every cell. Each run is its own
+parse.py process, like it would be from the command line. Exits non-zero if any workbook differs or any run fails.
+
+    $ python check_pipeline.py --days 40 --txns-per-day 300 --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from openpyxl import load_workbook
+import generate_reports
+
+PARSE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parse.py')
+
+
+def get_cell_values(excel_workbook_path):
+    """[(sheet title, [row values])] of a workbook, in sheet order"""
+    wb = load_workbook(excel_workbook_path)
+    return [(ws.title, [[c.value for c in row] for row in ws.rows]) for ws in wb.worksheets]
+
+
+def make_workbook(months_directory_path, excel_workbook_path, options):
+    """Run parse.py into a new workbook, returns its cell values, or None if the run failed"""
+    with open(os.devnull, 'w') as devnull:
+        status = subprocess.call([sys.executable, PARSE_SCRIPT, months_directory_path, excel_workbook_path] + options, stdout=devnull, stderr=subprocess.STDOUT)
+    if status:
+        print '\tparse.py {0} exited with {1}'.format(' '.join(options), status)
+        return None
+    return get_cell_values(excel_workbook_path)
+
+
+def check(months_directory_path, directory, workers):
+    """True if every --pipeline run makes the same workbook as the sequential run"""
+    expected = make_workbook(months_directory_path, os.path.join(directory, 'sequential.xlsx'), ['--workers', '1'])
+    if expected is None:
+        return False
+    ok = True
+    for n in sorted(set([1, workers])):
+        options = ['--pipeline', '--workers', str(n)]
+        values = make_workbook(months_directory_path, os.path.join(directory, 'pipeline-{0}.xlsx'.format(n)), options)
+        same = values == expected
+        print '{0:<28}{1}'.format(' '.join(options), 'same' if same else 'DIFFERENT' if values is not None else 'FAILED')
+        ok = ok and same
+    return ok
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Check that --pipeline makes the same workbook as a sequential run.')
+    arg_parser.add_argument('--days', type=int, default=40)
+    arg_parser.add_argument('--txns-per-day', type=int, default=300)
+    arg_parser.add_argument('--workers', type=int, default=max(multiprocessing.cpu_count(), 2), help='workers of the parallel pipeline run (default: number of cores, at least 2)')
+    opts = arg_parser.parse_args(args[1:])
+
+    directory = tempfile.mkdtemp(prefix='chevron-check-')
+    try:
+        reports = os.path.join(directory, 'reports')
+        generate_reports.generate(reports, opts.days, opts.txns_per_day)
+        ok = check(reports, directory, opts.workers)
+    finally:
+        shutil.rmtree(directory)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
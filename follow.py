@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Follows a day report while Blue Cube is still appending to it, so the day's numbers can be watched before it closes.
+
+    $ python follow.py <PATH TO TODAY'S DAY REPORT TEXT FILE> --interval 300
+
+Every poll parses only the bytes added since the last one. A transaction isn't complete until the next header is
+written, so the last one in the file is left for the next poll. The offset reached, the prepays still waiting for their
+finalization and the running column values are kept in <DAY FILE>.follow.json, so a restarted follower picks up where
+it stopped. Once the day is over the rest of the file is parsed and the follower exits.
+"""
+import argparse
+from datetime import datetime
+import io
+import json
+import os
+import sys
+import time
+from parse import DayAnalyzer, DayParser, FINALIZED_TRANSACTION_REGEX, GasTxn, ParseStats, VOLUME_BUCKET_EDGES, VolumeBuckets, get_date_for_day_file, get_gas_cell_labels, parse_volume_bucket_edges, txn_from_record, txn_to_record
+
+FOLLOW_SUFFIX = '.follow.json'
+FOLLOW_STATE_VERSION = 1
+
+
+def find_last_header(buf, start=0):
+    """Offset of the last finalized header line in buf at or after start, or -1"""
+    pos = len(buf)
+    while True:
+        pos = buf.rfind('CUSTOMER', start, pos)
+        if pos == -1:
+            return -1
+        if (pos == 0 or buf[pos - 1] == '\n') and FINALIZED_TRANSACTION_REGEX.match(buf, pos):
+            return pos
+
+
+class DayFollower(object):
+    """
+    Incremental parse of one growing day file. The DayParser is kept between polls, so prepays rung up in one poll
+    are matched with finalizations read in a later one, and the column values only ever get the new transactions added.
+    """
+    def __init__(self, day_path, state_path=None, volume_buckets=None):
+        self.day_path = os.path.abspath(day_path)
+        self.state_path = state_path or day_path + FOLLOW_SUFFIX
+        self.volume_buckets = volume_buckets or VolumeBuckets()
+        self.date = get_date_for_day_file(day_path)
+        self.labels = get_gas_cell_labels(self.volume_buckets)
+        self.reset()
+        self.load()
+
+    def reset(self):
+        """Start again from the beginning of the file"""
+        self.offset = 0
+        self.values = [0] * len(self.labels)
+        self.parser = DayParser(ParseStats(self.day_path))
+
+    def get_volume_buckets_config(self):
+        """"""
+        return {'edges': self.volume_buckets.edges, 'strict': self.volume_buckets.strict}
+
+    def load(self):
+        """"""
+        if not os.path.exists(self.state_path):
+            return
+        with open(self.state_path) as f:
+            state = json.load(f)
+        if state.get('version') != FOLLOW_STATE_VERSION or state.get('path') != self.day_path or state.get('volume_buckets') != self.get_volume_buckets_config():
+            return
+        self.offset = state['offset']
+        self.values = state['values']
+        self.parser.prepay_map = dict((str(ref_num), txn_from_record(GasTxn, record)) for ref_num, record in state['prepays'].items())
+        self.parser.skip_ref_set = set(str(ref_num) for ref_num in state['finalized'])
+        self.parser.stats.counts.update(state['counts'])
+
+    def save(self):
+        """"""
+        state = {
+            'version': FOLLOW_STATE_VERSION,
+            'path': self.day_path,
+            'volume_buckets': self.get_volume_buckets_config(),
+            'offset': self.offset,
+            'values': self.values,
+            'prepays': dict((ref_num, txn_to_record(txn)) for ref_num, txn in self.parser.prepay_map.items()),
+            'finalized': sorted(self.parser.skip_ref_set),
+            'counts': self.parser.stats.counts,
+        }
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.state_path)
+
+    def is_same_file(self, day):
+        """False if the file was truncated or rewritten under us, so the saved offset no longer starts a transaction"""
+        if self.offset == 0:
+            return True
+        size = os.fstat(day.fileno()).st_size
+        if size < self.offset:
+            return False
+        # After the final poll the offset is the end of the file rather than a header
+        day.seek(self.offset)
+        return size == self.offset or FINALIZED_TRANSACTION_REGEX.match(day.readline()) is not None
+
+    def poll(self, final=False):
+        """
+        Parse the transactions completed since the last poll into the running values, returns how many were read.
+        With final, the file is taken to be finished and its last transaction is parsed too.
+        """
+        with open(self.day_path, 'rb') as day:
+            if not self.is_same_file(day):
+                self.reset()
+            day.seek(self.offset)
+            buf = day.read()
+        # Only whole lines, and only up to the header of the last transaction, which may still be growing
+        end = len(buf) if final else buf.rfind('\n') + 1
+        if not final:
+            end = max(find_last_header(buf[:end], 1), 0)
+        if not end:
+            return 0
+        parser = self.parser
+        # Split the way file iteration does, only at newlines
+        for line in io.BytesIO(buf[:end]):
+            parser.feed(line)
+        parser.end_txn()
+        if final:
+            parser.stats.counts['unmatched_prepays'] = len(parser.prepay_map)
+        new_txns = len(parser.gas_txns) + len(parser.carwash_txns)
+        new_values = DayAnalyzer(parser.gas_txns, self.date, None, parser.carwash_txns, self.volume_buckets).get_cell_values()
+        self.values = [a + b for a, b in zip(self.values, new_values)]
+        # Counted, so they don't need to be kept around
+        parser.gas_txns, parser.carwash_txns, parser.orphaned_txns = [], [], []
+        self.offset += end
+        self.save()
+        return new_txns
+
+    def print_values(self):
+        """"""
+        print '{0} {1}'.format(datetime.now().strftime('%H:%M:%S'), ', '.join('{0}: {1}'.format(label, value) for label, value in zip(self.labels, self.values)))
+
+
+def is_day_over(date_obj):
+    """"""
+    return date_obj.date() < datetime.now().date()
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Follow a Blue Cube day report as it is written and keep its counts up to date.')
+    arg_parser.add_argument('day_path')
+    arg_parser.add_argument('--interval', type=float, default=300, help='seconds between polls (default: 300)')
+    arg_parser.add_argument('--state', metavar='PATH', help='where to keep the follow state (default: the day file path + {0})'.format(FOLLOW_SUFFIX))
+    arg_parser.add_argument('--once', action='store_true', help='poll once and exit, for running from cron')
+    arg_parser.add_argument('--volume-buckets', type=parse_volume_bucket_edges, default=VOLUME_BUCKET_EDGES, metavar='EDGES', help='comma separated gallon edges of the volume rows (default: 5,10,14,19)')
+    opts = arg_parser.parse_args(args[1:])
+
+    follower = DayFollower(opts.day_path, opts.state, VolumeBuckets(opts.volume_buckets))
+    while True:
+        # Checked before polling, so anything written up to the end of the day is read by the final poll
+        final = is_day_over(follower.date)
+        if follower.poll(final) or final or opts.once:
+            follower.print_values()
+        if final or opts.once:
+            break
+        time.sleep(opts.interval)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
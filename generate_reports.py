@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Writes synthetic Blue Cube day reports covering every transaction format parse.py understands: outdoor sales,
+indoor fuel prepays (some voided and rung up again), their finalizations, carwash add-ons and carwash-only or other
+indoor sales. Prepays still open at the end of a day are finalized at the start of the next one, as happens around
+midnight at a real store.
+
+    $ python generate_reports.py <OUTPUT DIRECTORY> --days 31 --txns-per-day 2000 --stations 3
+
+Each station gets a directory of YYYYMM month directories holding YYYYMMDD.txt files, the layout parse.py reads.
+With a single station the month directories go straight into the output directory.
+"""
+import argparse
+from datetime import date, timedelta
+import os
+import random
+import sys
+
+GAS_PRICES = {'UNLEADED': 3.899, 'PLUS': 4.069, 'SUPREME': 4.169}
+CARWASH_TYPES = {'- W': 6.00, 'DEL': 8.00, 'SUP': 10.00}
+RULE = '-' * 40
+
+
+class ReportMix(object):
+    """Shares of each kind of transaction in a generated day"""
+    def __init__(self, outdoor=0.5, prepay=0.25, other=0.25, void=0.05, carwash=0.15, unfinished=0.02):
+        # outdoor, prepay and other pick the kind of a new transaction, the rest are rates within those kinds
+        self.outdoor = outdoor
+        self.prepay = prepay
+        self.other = other
+        self.void = void
+        self.carwash = carwash
+        self.unfinished = unfinished
+
+
+class ReportGenerator(object):
+    """
+    Generates consecutive day reports for one station. Transaction and prepay reference numbers keep counting up
+    across days, and prepays left open at the end of a day are finalized early the next day.
+    """
+    def __init__(self, seed=0, txns_per_day=1000, mix=None, pumps=8):
+        self.random = random.Random(seed)
+        self.txns_per_day = txns_per_day
+        self.mix = mix or ReportMix()
+        self.pumps = pumps
+        self.txn_id = 100000
+        self.ref_num = 2740000
+        self.open_prepays = []
+
+    def generate_day(self, day):
+        """The text of the day report for day"""
+        r = self.random
+        prices = dict((g, p + r.choice((-0.1, 0, 0, 0, 0.1))) for g, p in GAS_PRICES.items())
+        # Times are spread over the day in order
+        seconds = sorted(r.randint(0, 86399) for _ in xrange(self.txns_per_day))
+        lines = ['BLUE CUBE SALES JOURNAL', 'Store #{0}'.format(r.randint(1000, 9999)), '']
+        carried, self.open_prepays = self.open_prepays, []
+        kinds = (self.mix.outdoor, self.mix.outdoor + self.mix.prepay)
+        total = self.mix.outdoor + self.mix.prepay + self.mix.other
+        for i, second in enumerate(seconds):
+            self.txn_id += 1
+            when = '{0} {1:02d}:{2:02d}:{3:02d}'.format(day.strftime('%m/%d/%y'), second // 3600, second // 60 % 60, second % 60)
+            # Finalize last night's open prepays first, and today's own a few transactions after they were rung up
+            if carried:
+                lines += self.finalization(when, carried.pop(0), prices)
+            elif self.open_prepays and (r.random() < 0.5 or i == len(seconds) - 1) and r.random() >= self.mix.unfinished:
+                lines += self.finalization(when, self.open_prepays.pop(0), prices)
+            else:
+                x = r.random() * total
+                if x < kinds[0]:
+                    lines += self.outdoor_sale(when, prices)
+                elif x < kinds[1]:
+                    lines += self.prepay(when)
+                else:
+                    lines += self.other_sale(when)
+                if r.random() < 0.01:
+                    # Transactions that weren't finalized don't count, the parser has to skip them
+                    lines += ['CUSTOMER TRANSACTION    {0}   Suspended'.format(self.txn_id + 900000), when, 'Indoor tmnl: 1', RULE, '']
+            lines.append('')
+        lines += ['END OF JOURNAL', '']
+        return '\n'.join(lines)
+
+    def header(self, when, location, terminal):
+        """"""
+        return ['CUSTOMER TRANSACTION    {0}   Finalized'.format(self.txn_id), when, '{0} tmnl: {1}'.format(location, terminal)]
+
+    def carwash(self):
+        """"""
+        wash_type = self.random.choice(sorted(CARWASH_TYPES))
+        return '    CAR WASH {0}        {1:.2f}'.format(wash_type, CARWASH_TYPES[wash_type]), CARWASH_TYPES[wash_type]
+
+    def card(self, total):
+        """"""
+        return ['{0} Card          {1:.2f}'.format(self.random.choice(('Credit', 'Debit')), total), 'Card Type: {0}'.format(self.random.choice(('VISA', 'MASTERCARD', 'AMEX')))]
+
+    def fuel(self, gas_type, price, volume, pump):
+        """"""
+        return ['    {0} PUR       {1:.2f}'.format(gas_type, volume * price), 'Ticket #{0}      Pump {1}'.format(self.txn_id, pump), '    Vol     {0:.3f}@     {1:.3f}'.format(volume, price)]
+
+    def volume(self):
+        """"""
+        return min(max(self.random.lognormvariate(2.3, 0.5), 0.5), 30.0)
+
+    def outdoor_sale(self, when, prices):
+        """"""
+        r = self.random
+        pump = r.randint(1, self.pumps)
+        gas_type = r.choice(sorted(prices))
+        volume = self.volume()
+        total = round(volume * prices[gas_type], 2)
+        lines = self.header(when, 'Outdoor', pump) + ['User Session: 0', RULE] + self.fuel(gas_type, prices[gas_type], volume, pump)
+        if r.random() < self.mix.carwash:
+            line, amount = self.carwash()
+            lines.append(line)
+            total += amount
+        return lines + ['TOTAL DUE     {0:.2f}'.format(total)] + self.card(total)
+
+    def prepay(self, when):
+        """"""
+        r = self.random
+        self.ref_num += 1
+        pump = r.randint(1, self.pumps)
+        amount = float(r.choice((10, 20, 20, 30, 40, 50, 60)))
+        lines = self.header(when, 'Indoor', 1) + ['User Session: {0}'.format(r.randint(1000, 9999)), RULE]
+        total = 0.0
+        if r.random() < 0.3:
+            lines.append('    SNACKS                1.59')
+            total += 1.59
+        if r.random() < self.mix.void:
+            # Rung up on the wrong pump, voided and rung up again
+            lines += ['Fuel Prepay Ref#{0} Pump {1}'.format(self.ref_num, r.randint(1, self.pumps)), 'FUEL PREPAY     {0:.2f}'.format(amount), '    *Void*   Fuel Prepay   ']
+            self.ref_num += 1
+        lines += ['Fuel Prepay Ref#{0} Pump {1}'.format(self.ref_num, pump), 'FUEL PREPAY     {0:.2f}'.format(amount)]
+        total += amount
+        if r.random() < self.mix.carwash:
+            line, wash_amount = self.carwash()
+            lines.append(line)
+            total += wash_amount
+        lines.append('TOTAL DUE     {0:.2f}'.format(total))
+        tender = r.choice(('Cash', 'Cash', 'Card', 'Balance'))
+        if tender == 'Balance':
+            lines.append('BALANCE DUE     0.00')
+        elif tender == 'Cash':
+            lines += ['', 'Cash     {0:.2f}'.format(total)]
+        else:
+            lines += [''] + self.card(total)
+        self.open_prepays.append((self.ref_num, pump, amount))
+        return lines
+
+    def finalization(self, when, prepay, prices):
+        """"""
+        r = self.random
+        ref_num, pump, amount = prepay
+        gas_type = r.choice(sorted(prices))
+        # Most prepays are pumped in full, the rest get change back
+        volume = amount / prices[gas_type] * (1.0 if r.random() < 0.7 else r.uniform(0.3, 0.99))
+        pumped = round(volume * prices[gas_type], 2)
+        lines = self.header(when, 'Indoor', 1)
+        if r.random() < 0.7:
+            lines.append('User Session: {0}'.format(r.randint(1000, 9999)))
+        else:
+            lines.append('Operator: Auto')
+        lines += [RULE, 'Original Fuel Prepay Ref#{0}'.format(ref_num), 'FUEL PREPAY    -{0:.2f}'.format(amount)] + self.fuel(gas_type, prices[gas_type], volume, pump)
+        return lines + ['TOTAL DUE     -{0:.2f}'.format(amount - pumped), '', 'Cash     -{0:.2f}'.format(amount - pumped)]
+
+    def other_sale(self, when):
+        """"""
+        r = self.random
+        lines = self.header(when, 'Indoor', r.randint(1, 2)) + ['User Session: {0}'.format(r.randint(1000, 9999)), RULE]
+        total = 0.0
+        if r.random() < 0.6:
+            lines.append('    GROCERY               4.25')
+            total += 4.25
+        if total == 0 or r.random() < self.mix.carwash:
+            line, amount = self.carwash()
+            lines.append(line)
+            total += amount
+        return lines + ['TOTAL DUE     {0:.2f}'.format(total)] + self.card(total)
+
+
+def write_station(directory, generator, first_day, days):
+    """Write days of reports starting at first_day into month directories under directory, returns the file paths"""
+    paths = []
+    for i in xrange(days):
+        day = first_day + timedelta(days=i)
+        month_dir = os.path.join(directory, day.strftime('%Y%m'))
+        if not os.path.isdir(month_dir):
+            os.makedirs(month_dir)
+        path = os.path.join(month_dir, day.strftime('%Y%m%d.txt'))
+        with open(path, 'w') as f:
+            f.write(generator.generate_day(day))
+        paths.append(path)
+    return paths
+
+
+def generate(directory, days=31, txns_per_day=1000, stations=1, first_day=date(2015, 1, 1), seed=0, mix=None):
+    """Write reports for every station, returns the file paths"""
+    paths = []
+    for station in xrange(stations):
+        station_dir = directory if stations == 1 else os.path.join(directory, 'station{0:02d}'.format(station + 1))
+        paths += write_station(station_dir, ReportGenerator(seed + station, txns_per_day, mix), first_day, days)
+    return paths
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Write synthetic Blue Cube day reports.')
+    arg_parser.add_argument('directory')
+    arg_parser.add_argument('--days', type=int, default=31)
+    arg_parser.add_argument('--txns-per-day', type=int, default=1000)
+    arg_parser.add_argument('--stations', type=int, default=1)
+    arg_parser.add_argument('--start', default='2015-01-01', metavar='YYYY-MM-DD', help='first day to generate')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--outdoor', type=float, default=0.5, help='share of outdoor sales')
+    arg_parser.add_argument('--prepay', type=float, default=0.25, help='share of indoor fuel prepays')
+    arg_parser.add_argument('--other', type=float, default=0.25, help='share of other indoor sales')
+    arg_parser.add_argument('--void', type=float, default=0.05, help='rate of voided prepays')
+    arg_parser.add_argument('--carwash', type=float, default=0.15, help='rate of carwash add-ons')
+    opts = arg_parser.parse_args(args[1:])
+    first_day = date(*[int(p) for p in opts.start.split('-')])
+    mix = ReportMix(outdoor=opts.outdoor, prepay=opts.prepay, other=opts.other, void=opts.void, carwash=opts.carwash)
+    paths = generate(opts.directory, opts.days, opts.txns_per_day, opts.stations, first_day, opts.seed, mix)
+    print 'wrote {0} day reports'.format(len(paths))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
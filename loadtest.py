@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Load test for serve.py: a number of threads query random date ranges for a while, then the requests per second and
+latency percentiles are printed.
+
+    $ python loadtest.py http://127.0.0.1:8421 --from 2015-01-01 --to 2015-12-31 --threads 8 --seconds 30
+"""
+import argparse
+from datetime import datetime, timedelta
+import random
+import sys
+import threading
+import time
+import urllib2
+
+ENDPOINTS = ('days', 'pumps', 'grades', 'tenders')
+PERCENTILES = (50, 90, 95, 99)
+
+
+def get_random_query(start, end, max_days):
+    """A random endpoint over a random range of at most max_days days between start and end"""
+    span = (end - start).days
+    first = start + timedelta(days=random.randint(0, span))
+    last = min(first + timedelta(days=random.randint(0, max_days - 1)), end)
+    return '/{0}?from={1}&to={2}'.format(random.choice(ENDPOINTS), first.strftime('%Y-%m-%d'), last.strftime('%Y-%m-%d'))
+
+
+def run_client(url, start, end, max_days, deadline, latencies, errors):
+    """Query until the deadline, appending each request's seconds to latencies"""
+    while time.time() < deadline:
+        query = get_random_query(start, end, max_days)
+        began = time.time()
+        try:
+            urllib2.urlopen(url + query).read()
+        except (urllib2.URLError, IOError) as e:
+            errors.append('{0}: {1}'.format(query, e))
+            continue
+        latencies.append(time.time() - began)
+
+
+def get_percentile(values, percentile):
+    """values has to be sorted"""
+    return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Load test a running serve.py with random date range queries.')
+    arg_parser.add_argument('url', help='where serve.py is listening, like http://127.0.0.1:8421')
+    arg_parser.add_argument('--from', dest='start', required=True, metavar='YYYY-MM-DD', help='first day queries can cover')
+    arg_parser.add_argument('--to', dest='end', required=True, metavar='YYYY-MM-DD', help='last day queries can cover')
+    arg_parser.add_argument('--max-days', type=int, default=31, help='longest range to query (default: 31)')
+    arg_parser.add_argument('--threads', type=int, default=8)
+    arg_parser.add_argument('--seconds', type=float, default=30)
+    opts = arg_parser.parse_args(args[1:])
+
+    url = opts.url.rstrip('/')
+    start, end = datetime.strptime(opts.start, '%Y-%m-%d'), datetime.strptime(opts.end, '%Y-%m-%d')
+    latencies, errors = [], []
+    began = time.time()
+    deadline = began + opts.seconds
+    threads = [threading.Thread(target=run_client, args=(url, start, end, opts.max_days, deadline, latencies, errors)) for _ in xrange(opts.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - began
+
+    latencies.sort()
+    print '{0} requests in {1:.1f}s, {2:.1f} requests/s, {3} errors'.format(len(latencies), elapsed, len(latencies) / elapsed, len(errors))
+    for error in errors[:5]:
+        print '\t' + error
+    if latencies:
+        print 'latency ms: ' + ', '.join('p{0} {1:.1f}'.format(p, get_percentile(latencies, p) * 1000) for p in PERCENTILES) + ', max {0:.1f}'.format(latencies[-1] * 1000)
+        print urllib2.urlopen(url + '/cache').read()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,19 +1,55 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime
+from array import array
+import argparse
+import base64
+import bisect
+from collections import Counter, OrderedDict, namedtuple
+import contextlib
+import cProfile
+from datetime import date, datetime, timedelta
+# strptime imports _strptime on first use, which fails in a thread while another one holds the import lock, like the
+# WorkbookWriter importing openpyxl. Importing it up front makes strptime safe in any thread.
+import _strptime
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import multiprocessing
 import os
+import Queue
 import re
+import struct
 from enum import Enum
 import sys
+import tarfile
+import threading
+import time
+import zipfile
 from os.path import isdir
-from openpyxl import load_workbook, Workbook
-from openpyxl.exceptions import InvalidFileException
-from openpyxl.styles import Font, PatternFill, Style, Color
 
 Location = Enum('Location', 'Indoor Outdoor')
 Gas = Enum('Gas', 'UNLEADED PLUS SUPREME')
 Carwash = Enum('Carwash', 'Regular Deluxe Super')
 Tender = Enum('Tender', 'Cash Credit Debit')
-DIRECTORY_ANALYZED_FILENAME = 'ALREADY_ANALYZED'
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 3
+PREPAY_TTL_HOURS = 36
+PREFETCH_FILES = 4
+MONTH_ARCHIVE_SUFFIXES = ('.zip', '.tar.gz', '.tgz', '.tar')
+GZIP_DAY_FILE_SUFFIX = '.txt.gz'
+ROLLUP_PERIODS = ('week', 'month', 'quarter', 'year')
+ROLLUP_SHEET_TITLES = {'week': 'Weekly', 'month': 'Monthly', 'quarter': 'Quarterly', 'year': 'Yearly'}
+MAX_PENDING_PREPAYS = 10000
+SPLIT_DAY_FILE_MB = 64
+CHUNKS_PER_WORKER = 4
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+TXN_ID_BITS = 27
+TXN_KEY_TYPECODE = 'L'
+TXN_KEY_MERGE_SIZE = 65536
 FINALIZED_TRANSACTION_REGEX = re.compile(r'CUSTOMER\sTRANSACTION\s+(?P<txn_id>[0-9]+)\s+Finalized')
 INDOOR_OUTDOOR_REGEX = re.compile(r'(?P<location>(Indoor|Outdoor)+)\s+tmnl(\s+)?:\s+(?P<terminal>[0-9]+)')
 USER_SESSION_REGEX = re.compile(r'User\s+Session:\s+[0-9]+')
@@ -28,36 +64,116 @@ FUEL_TYPE_REGEX = re.compile(r'\s+(?P<gas_type>(PLUS|UNLEADED|SUPREME)+)\s+PUR(E
 FUEL_VOLUME_REGEX = re.compile(r'\s+Vol\s+(?P<galls>[0-9]+)\.(?P<galls_dec>[0-9]+)@\s+(?P<price>[0-9]+)\.(?P<price_dec>[0-9]+)')
 OUTDOOR_TENDER_TYPE_REGEX = re.compile(r'(?P<tender>(Credit|Debit)+)\s+Card\s+[0-9]+.[0-9]+')
 VOID_TRANSACTION_REGEX = re.compile(r'\s+\*Void\*\s+')
-GAS_CELL_LABELS = ['gallons < 5', '5 < gallons < 10', '10 < gallons < 14', '14 < gallons < 19', 'gallons > 19', 'Unleaded', 'Plus', 'Supreme', 'Indoor', 'Outdoor', 'Credit card', 'Debit card', 'Cash', 'Total carwash', 'Regular', 'Deluxe', 'Super', 'Regular indoor', 'Regular outdoor', 'Deluxe indoor', 'Deluxe outdoor', 'Super indoor', 'Super outdoor']
+VOLUME_BUCKET_EDGES = (5.0, 10.0, 14.0, 19.0)
+COUNT_CELL_LABELS = ['Unleaded', 'Plus', 'Supreme', 'Indoor', 'Outdoor', 'Credit card', 'Debit card', 'Cash', 'Total carwash', 'Regular', 'Deluxe', 'Super', 'Regular indoor', 'Regular outdoor', 'Deluxe indoor', 'Deluxe outdoor', 'Super indoor', 'Super outdoor']
 CARWASH_REGEX = re.compile(r'\s+CAR\s+WASH\s+(?P<type>(SUP|DEL|\-\s+W))\s+(\-)?(?P<dollars>[0-9]+)\.(?P<cents>[0-9]+)')
+LineKind = Enum('LineKind', 'Finalized DateTime Location UserSession Prepay PrepayAmount OriginalPrepay FuelPurchase Volume Tender Carwash Void TotalDue BalanceDue')
+LINE_KIND_REGEXES = {
+    LineKind.Finalized: FINALIZED_TRANSACTION_REGEX, LineKind.DateTime: DATE_TIME_REGEX, LineKind.Location: INDOOR_OUTDOOR_REGEX,
+    LineKind.UserSession: USER_SESSION_REGEX, LineKind.Prepay: INITIAL_FUEL_PREPAY_REGEX, LineKind.PrepayAmount: FUEL_PREPAY_AMOUNT_REGEX,
+    LineKind.OriginalPrepay: FINAL_FUEL_PREPAY_REGEX, LineKind.FuelPurchase: FUEL_TYPE_REGEX, LineKind.Volume: FUEL_VOLUME_REGEX,
+    LineKind.Tender: OUTDOOR_TENDER_TYPE_REGEX, LineKind.Carwash: CARWASH_REGEX, LineKind.Void: VOID_TRANSACTION_REGEX,
+    LineKind.TotalDue: TOTAL_DUE_REGEX, LineKind.BalanceDue: BALANCE_DUE_REGEX,
+}
+# (indented, first token) -> the only kind a line can be. Lines starting with a digit are dates, and lines that aren't
+# in here aren't any kind at all, so each line costs one token match and at most one pattern match.
+LINE_KIND_TOKENS = {
+    (False, 'CUSTOMER'): LineKind.Finalized, (False, 'Indoor'): LineKind.Location, (False, 'Outdoor'): LineKind.Location,
+    (False, 'User'): LineKind.UserSession, (False, 'Fuel'): LineKind.Prepay, (False, 'FUEL'): LineKind.PrepayAmount,
+    (False, 'Original'): LineKind.OriginalPrepay, (False, 'Credit'): LineKind.Tender, (False, 'Debit'): LineKind.Tender,
+    (False, 'TOTAL'): LineKind.TotalDue, (False, 'BALANCE'): LineKind.BalanceDue, (True, 'UNLEADED'): LineKind.FuelPurchase,
+    (True, 'PLUS'): LineKind.FuelPurchase, (True, 'SUPREME'): LineKind.FuelPurchase, (True, 'Vol'): LineKind.Volume,
+    (True, 'CAR'): LineKind.Carwash, (True, '*Void*'): LineKind.Void,
+}
+# The same tables keyed the way the parser looks them up, enum members hash too slowly for the per-line path
+LINE_TOKEN_REGEXES = dict((key, LINE_KIND_REGEXES[kind]) for key, kind in LINE_KIND_TOKENS.items())
+CLASSIFIED_REGEXES = frozenset(LINE_KIND_REGEXES.values())
+LINE_TOKEN_REGEX = re.compile(r'\s*(\S*)')
+NO_KIND = (None, None)
+
+
+class VolumeBuckets(object):
+    """
+    Gallon ranges counted in the first rows of a day column, split at edges. When strict (the default) the ranges are
+    open, so a volume sitting exactly on an edge is in no bucket. Otherwise every edge belongs to the bucket above it.
+    """
+    def __init__(self, edges=VOLUME_BUCKET_EDGES, strict=True):
+        self.edges = sorted(float(e) for e in edges)
+        self.strict = strict
+
+    def __len__(self):
+        return len(self.edges) + 1
+
+    def labels(self):
+        """"""
+        edges = ['{0:g}'.format(e) for e in self.edges]
+        lower_op, upper_op = ('<', '>') if self.strict else ('<=', '>=')
+        labels = ['gallons < {0}'.format(edges[0])]
+        labels += ['{0} {1} gallons < {2}'.format(low, lower_op, high) for low, high in zip(edges, edges[1:])]
+        labels.append('gallons {0} {1}'.format(upper_op, edges[-1]))
+        return labels
+
+    def index(self, volume):
+        """Bucket volume falls in, or None if it is on an edge and the buckets are strict"""
+        if not self.strict:
+            return bisect.bisect_right(self.edges, volume)
+        i = bisect.bisect_left(self.edges, volume)
+        if i < len(self.edges) and self.edges[i] == volume:
+            return None
+        return i
+
+
+GAS_CELL_LABELS = VolumeBuckets().labels() + COUNT_CELL_LABELS
+# Made on first use by get_label_cell_style
+LABEL_CELL_STYLE = None
+COMMANDS = ('parse', 'aggregate', 'export-xlsx')
+GROUPINGS = ('day', 'month', 'total')
+
+
+def get_gas_cell_labels(volume_buckets=None):
+    """"""
+    if volume_buckets is None:
+        return GAS_CELL_LABELS
+    return volume_buckets.labels() + COUNT_CELL_LABELS
+
+
+def intern_name(name):
+    """Share one copy of a name string between all the transactions that carry it"""
+    return name if name is None else intern(name)
 
 
 class Txn(object):
+    __slots__ = ('id', 'date', 'time', 'amount', 'location', 'tender')
+
     def __init__(self, id, date, time, amount, location, tender):
         """"""
         self.id = id
-        self.date = date
+        self.date = intern_name(date)
         self.time = time
-        self.amount = amount
+        self.amount = amount if amount is None else float(amount)
         self.location = location
-        self.tender = tender
+        self.tender = intern_name(tender)
 
 
 class GasTxn(Txn):
+    __slots__ = ('volume', 'gas_type', 'pump_num', 'indoor_prepay', 'reference_num', 'price', 'carwash_txn')
+
     def __init__(self, id, date, time, amount, location, tender, volume, gas_type, pump_num, indoor_prepay=False, reference_num=None, price=None):
         """"""
         Txn.__init__(self, id, date, time, amount, location, tender)
         self.volume = volume if not volume else float(volume)
-        self.gas_type = gas_type
+        self.gas_type = intern_name(gas_type)
         self.pump_num = pump_num if not pump_num else int(pump_num)
         self.indoor_prepay = indoor_prepay
         self.reference_num = reference_num
-        self.price = price
+        self.price = price if price is None else float(price)
         self.carwash_txn = None
 
 
 class CarWashTxn(Txn):
     """"""
+    __slots__ = ('carwash_type',)
+
     def __init__(self, id, date, time, amount, location, carwash_type, tender):
         Txn.__init__(self, id, date, time, amount, location, tender)
         if carwash_type == '- W':
@@ -68,339 +184,661 @@ class CarWashTxn(Txn):
             self.carwash_type = Carwash.Super.name
 
 
+def get_name_code(enum, name):
+    """Small integer code for an enum member name: its value, or 0 if name is missing or not a member"""
+    member = enum.__members__.get(name) if name else None
+    return member.value if member else 0
+
+
+def get_code_name(enum, code):
+    """"""
+    return enum(code).name if code else None
+
+
+def get_txn_fields(txn):
+    """"""
+    return [name for cls in reversed(type(txn).__mro__) for name in getattr(cls, '__slots__', ())]
+
+
+def txn_to_record(txn):
+    """JSON-able dict of a transaction's fields, carwash add-ons included"""
+    record = dict((name, getattr(txn, name)) for name in get_txn_fields(txn))
+    if record.get('carwash_txn'):
+        record['carwash_txn'] = txn_to_record(record['carwash_txn'])
+    return record
+
+
+def txn_from_record(cls, record):
+    """Rebuild a transaction saved by txn_to_record, without running the parsing conversions in __init__ again"""
+    txn = cls.__new__(cls)
+    for name, value in record.items():
+        if isinstance(value, unicode):
+            value = str(value)
+        setattr(txn, name, value)
+    if getattr(txn, 'carwash_txn', None):
+        txn.carwash_txn = txn_from_record(CarWashTxn, record['carwash_txn'])
+    return txn
+
+
+class TransactionBatch(object):
+    """
+    Column-oriented transactions, one typed array per field instead of an object per transaction. Location, tender,
+    gas type and carwash type are stored as codes from get_name_code, missing numbers as NaN (or 0 for pump and ids).
+    Carwash-only transactions are rows with a gas type of 0.
+    """
+    FLOAT_COLUMNS = ('amount', 'volume', 'price')
+    INT_COLUMNS = ('txn_id', 'reference_num', 'day', 'seconds')
+    CODE_COLUMNS = ('pump_num', 'location', 'tender', 'gas_type', 'carwash_type')
+
+    def __init__(self):
+        for column in self.FLOAT_COLUMNS:
+            setattr(self, column, array('d'))
+        for column in self.INT_COLUMNS:
+            setattr(self, column, array('l'))
+        for column in self.CODE_COLUMNS:
+            setattr(self, column, array('B'))
+        self._days = {}
+
+    def __len__(self):
+        return len(self.txn_id)
+
+    @classmethod
+    def from_txns(cls, gas_txns, carwash_txns=()):
+        """"""
+        batch = cls()
+        batch.extend(gas_txns)
+        batch.extend(carwash_txns)
+        return batch
+
+    def extend(self, txns):
+        """"""
+        for t in txns:
+            self.append(t)
+
+    def append(self, txn):
+        """Add a GasTxn or CarWashTxn as a new row"""
+        nan = float('nan')
+        carwash_type = txn.carwash_txn.carwash_type if getattr(txn, 'carwash_txn', None) else getattr(txn, 'carwash_type', None)
+        self.amount.append(nan if txn.amount is None else txn.amount)
+        self.volume.append(getattr(txn, 'volume', None) or nan)
+        self.price.append(getattr(txn, 'price', None) or nan)
+        self.txn_id.append(int(txn.id or 0))
+        self.reference_num.append(int(getattr(txn, 'reference_num', None) or 0))
+        self.day.append(self.get_day_ordinal(txn.date))
+        self.seconds.append(get_seconds_of_day(txn.time))
+        self.pump_num.append(getattr(txn, 'pump_num', None) or 0)
+        self.location.append(get_name_code(Location, txn.location))
+        self.tender.append(get_name_code(Tender, txn.tender))
+        self.gas_type.append(get_name_code(Gas, getattr(txn, 'gas_type', None)))
+        self.carwash_type.append(get_name_code(Carwash, carwash_type))
+
+    def get_day_ordinal(self, date):
+        """"""
+        return get_date_ordinal(date, self._days)
+
+    def as_numpy(self):
+        """The columns as a dict of NumPy arrays sharing memory with the batch (needs numpy)"""
+        import numpy
+        columns = {}
+        for column in self.FLOAT_COLUMNS + self.INT_COLUMNS + self.CODE_COLUMNS:
+            values = getattr(self, column)
+            columns[column] = numpy.frombuffer(values, dtype=numpy.dtype(values.typecode)) if len(values) else numpy.array([], dtype=values.typecode)
+        return columns
+
+
+def get_date_ordinal(date, cache):
+    """Proleptic Gregorian ordinal of a transaction's 'MM/DD/YY' date, or 0 if it has none. cache is a dict to keep them in"""
+    if not date:
+        return 0
+    if date not in cache:
+        date_format = '%m/%d/%y' if len(date.split('/')[-1]) == 2 else '%m/%d/%Y'
+        cache[date] = datetime.strptime(date, date_format).toordinal()
+    return cache[date]
+
+
+def get_seconds_of_day(time):
+    """Seconds since midnight of a transaction's 'HH:MM:SS' time, or -1 if it has none"""
+    if not time:
+        return -1
+    hr, mins, sec = time.split(':')
+    return int(hr) * 3600 + int(mins) * 60 + int(sec)
+
+
 class DayAnalyzer(object):
-    def __init__(self, gas_txns, date, index, carwash_txns):
+    def __init__(self, gas_txns, date, index, carwash_txns, volume_buckets=None):
         self.gas_txns = gas_txns
         self.date = date
         self.index = index
         self.carwash_txns = carwash_txns
+        self.volume_buckets = volume_buckets or VolumeBuckets()
 
     def add_gas_txns_to_worksheet(self, ws):
         """"""
-        bold_font = Font(bold=True)
-        label_fill = PatternFill(fill_type='solid', start_color=Color('00EEEEEE'))
-        label_cell_style = Style(font=bold_font, fill=label_fill)
-        label_cell = ws.cell(get_column_letter_for_column_number(1, self.index))
-        label_cell.style = label_cell_style
-        label_cell.value = self.date.strftime('%m/%d')
-        # ['gallons < 5', '5 < gallons < 10', '10 < gallons < 14', '14 < gallons < 19', 'gallons > 19', 'Unleaded', 'Plus', 'Supreme', 'Indoor', 'Outdoor', 'Credit card', 'Debit card', 'Cash', 'Total carwash', 'Regular', 'Deluxe', 'Super', 'Regular indoor', 'Regular outdoor', 'Deluxe indoor', 'Deluxe outdoor', 'Super indoor', 'Super outdoor']
-        row_index = 2
-        lt5_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        lt5_cell.value = self.get_vol_less_than(less_than=5.0)
-        row_index += 1
-        btw_5_10_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        btw_5_10_cell.value = self.get_vol_btw(greater_than=5.0, less_than=10.0)
-        row_index += 1
-        btw_10_14 = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        btw_10_14.value = self.get_vol_btw(greater_than=10.0, less_than=14.0)
-        row_index += 1
-        btw_14_19 = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        btw_14_19.value = self.get_vol_btw(greater_than=14.0, less_than=19.0)
-        row_index += 1
-        gt_20 = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        gt_20.value = self.get_vol_greater_than(greater_than=19.0)
-        row_index += 1
-        unleaded_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        unleaded_cell.value = self.get_count_with_gas_type(Gas.UNLEADED.name)
-        row_index += 1
-        plus_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        plus_cell.value = self.get_count_with_gas_type(Gas.PLUS.name)
-        row_index += 1
-        supreme_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        supreme_cell.value = self.get_count_with_gas_type(Gas.SUPREME.name)
-        row_index += 1
-        indoor_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        indoor_cell.value = self.get_location_count(Location.Indoor.name)
-        row_index += 1
-        outdoor_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        outdoor_cell.value = self.get_location_count(Location.Outdoor.name)
-        row_index += 1
-        credit_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        credit_cell.value = self.get_tender_count(Tender.Credit.name)
-        row_index += 1
-        debit_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        debit_cell.value = self.get_tender_count(Tender.Debit.name)
-        row_index += 1
-        cash_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        cash_cell.value = self.get_tender_count(Tender.Cash.name)
-        regular_indoor = self.get_wash_type_count_for_location(Location.Indoor.name, Carwash.Regular.name)
-        regular_outdoor = self.get_wash_type_count_for_location(Location.Outdoor.name, Carwash.Regular.name)
-        deluxe_indoor = self.get_wash_type_count_for_location(Location.Indoor.name, Carwash.Deluxe.name)
-        deluxe_outdoor = self.get_wash_type_count_for_location(Location.Outdoor.name, Carwash.Deluxe.name)
-        super_indoor = self.get_wash_type_count_for_location(Location.Indoor.name, Carwash.Super.name)
-        super_outdoor = self.get_wash_type_count_for_location(Location.Outdoor.name, Carwash.Super.name)
-        row_index += 1
-        total_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        total_cell.value = regular_indoor + regular_outdoor + deluxe_indoor + deluxe_outdoor + super_indoor + super_outdoor
-        row_index += 1
-        reg_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        reg_cell.value = regular_indoor + regular_outdoor
-        row_index += 1
-        del_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        del_cell.value = deluxe_indoor + deluxe_outdoor
-        row_index += 1
-        sup_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        sup_cell.value = super_indoor + super_outdoor
-        row_index += 1
-        regi_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        regi_cell.value = regular_indoor
-        row_index += 1
-        rego_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        rego_cell.value = regular_outdoor
-        row_index += 1
-        deli_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        deli_cell.value = deluxe_indoor
-        row_index += 1
-        delo_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        delo_cell.value = deluxe_outdoor
-        row_index += 1
-        supi_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        supi_cell.value = super_indoor
-        row_index += 1
-        supo_cell = ws.cell(get_column_letter_for_column_number(row_index, self.index))
-        supo_cell.value = super_outdoor
+        add_day_column_to_worksheet(ws, self.index, self.date, self.get_cell_values())
 
-    def get_pump_count(self, pump):
-        count = 0
-        for t in self.gas_txns:
-            if t.pump_num == pump:
-                count += 1
-        return count
+    def get_cell_values(self):
+        """Values for the day's column, in get_gas_cell_labels(self.volume_buckets) order"""
+        vol_counts, counts, wash_counts = self.count()
+        wash_type_counts = [wash_counts[(Location.Indoor.name, w.name)] + wash_counts[(Location.Outdoor.name, w.name)] for w in Carwash]
+        values = list(vol_counts)
+        values += [counts[g.name] for g in Gas]
+        values += [counts[l.name] for l in Location]
+        values += [counts[Tender.Credit.name], counts[Tender.Debit.name], counts[Tender.Cash.name]]
+        values.append(sum(wash_type_counts))
+        values += wash_type_counts
+        values += [wash_counts[(l.name, w.name)] for w in Carwash for l in Location]
+        return values
 
-    def get_wash_type_count_for_location(self, location, wash_type):
-        """"""
-        count = 0
-        for g in self.gas_txns:
-            if g.carwash_txn and g.carwash_txn.carwash_type == wash_type and g.location == location:
-                count += 1
+    def count(self):
+        """
+        Count everything in the day's column in one pass over the transactions. Returns the count per volume bucket, a
+        Counter of gas types, locations and tenders (their names don't overlap), and a Counter of carwashes keyed by
+        (location, carwash type).
+        """
+        vol_counts = [0] * len(self.volume_buckets)
+        counts, wash_counts = Counter(), Counter()
+        bucket_index = self.volume_buckets.index
+        for t in self.gas_txns:
+            bucket = bucket_index(t.volume)
+            if bucket is not None:
+                vol_counts[bucket] += 1
+            counts[t.gas_type] += 1
+            counts[t.location] += 1
+            counts[t.tender] += 1
+            if t.carwash_txn:
+                wash_counts[(t.location, t.carwash_txn.carwash_type)] += 1
         for c in self.carwash_txns:
-            if c.carwash_type == wash_type and c.location == location:
-                count += 1
-        return count
+            wash_counts[(c.location, c.carwash_type)] += 1
+        return vol_counts, counts, wash_counts
 
-    def get_tender_count(self, tender):
-        count = 0
+    def get_partial(self, sources=()):
+        """The day as a PartialAggregate covering sources"""
+        volume = revenue = 0.0
         for t in self.gas_txns:
-            if t.tender == tender:
-                count += 1
-        return count
+            if t.volume and t.price:
+                volume += t.volume
+                revenue += round(t.volume * t.price, 2)
+        return PartialAggregate(self.volume_buckets, self.get_cell_values(), volume, revenue, sources)
 
-    def get_location_count(self, location):
+    def get_pump_count(self, pump):
         count = 0
         for t in self.gas_txns:
-            if t.location == location:
+            if t.pump_num == pump:
                 count += 1
         return count
 
-    def get_count_with_gas_type(self, gas_type):
-        count = 0
-        for t in self.gas_txns:
-            if t.gas_type == gas_type:
-                count += 1
-        return count
 
-    def get_vol_btw(self, greater_than, less_than):
-        count = 0
-        for t in self.gas_txns:
-            if greater_than < t.volume < less_than:
-                count += 1
-        return count
+class PartialAggregate(object):
+    """
+    Counts of a day column plus the gallons and dollars of gas sold, for any set of sources (a source is one day at
+    one station, 'station/YYYY-MM-DD'). Merging adds everything up and is associative and commutative, so partials
+    can be combined across days, stations and machines in any grouping. A source can only be counted once: merging
+    partials that share one is an error rather than a double count.
+    """
+    def __init__(self, volume_buckets=None, values=None, volume=0.0, revenue=0.0, sources=()):
+        self.volume_buckets = volume_buckets or VolumeBuckets()
+        self.values = list(values) if values is not None else [0] * len(get_gas_cell_labels(self.volume_buckets))
+        self.volume = volume
+        self.revenue = revenue
+        self.sources = frozenset(sources)
 
-    def get_vol_greater_than(self, greater_than):
-        count = 0
-        for t in self.gas_txns:
-            if t.volume > greater_than:
-                count += 1
-        return count
+    def get_volume_buckets_config(self):
+        """"""
+        return {'edges': self.volume_buckets.edges, 'strict': self.volume_buckets.strict}
+
+    def merge(self, other):
+        """A new partial covering the sources of both"""
+        return merge_partials([self, other])
 
-    def get_vol_less_than(self, less_than):
+    def as_record(self):
         """"""
-        count = 0
-        for t in self.gas_txns:
-            if t.volume < less_than:
-                count += 1
-        return count
+        return {'volume_buckets': self.get_volume_buckets_config(), 'values': self.values, 'volume': self.volume, 'revenue': self.revenue, 'sources': sorted(self.sources)}
 
+    @classmethod
+    def from_record(cls, record):
+        """"""
+        volume_buckets = VolumeBuckets(record['volume_buckets']['edges'], record['volume_buckets']['strict'])
+        return cls(volume_buckets, record['values'], record['volume'], record['revenue'], [str(s) for s in record['sources']])
 
-def touch(fname, times=None):
-    """"""
-    with open(fname, 'a'):
-        os.utime(fname, times)
 
+def merge_partials(partials):
+    """Merge any number of PartialAggregates in one pass, None if there are none"""
+    partials = list(partials)
+    if not partials:
+        return None
+    config = partials[0].get_volume_buckets_config()
+    merged = PartialAggregate(partials[0].volume_buckets)
+    sources = set()
+    for p in partials:
+        if p.get_volume_buckets_config() != config:
+            raise ValueError('Can\'t merge partials counted with different volume buckets')
+        overlap = sources & p.sources
+        if overlap:
+            overlap = sorted(overlap)
+            raise ValueError('Partials both cover {0}{1}'.format(', '.join(overlap[:3]), ' and {0} more'.format(len(overlap) - 3) if len(overlap) > 3 else ''))
+        sources |= p.sources
+        merged.values = [a + b for a, b in zip(merged.values, p.values)]
+        merged.volume += p.volume
+        merged.revenue += p.revenue
+    merged.sources = frozenset(sources)
+    return merged
 
-def get_month_directories_to_analyze(dir_paths):
-    """"""
-    for p in dir_paths:
-        if DIRECTORY_ANALYZED_FILENAME not in os.listdir(p):
-            yield p
+
+def get_period(date_obj, period):
+    """(period key, last day) of the ISO week, month, quarter or year date_obj is in. Keys sort in date order"""
+    if period == 'week':
+        year, week, weekday = date_obj.isocalendar()
+        return '{0}-W{1:02d}'.format(year, week), date_obj + timedelta(days=7 - weekday)
+    if period == 'month':
+        return date_obj.strftime('%Y-%m'), get_month_end(date_obj.year, date_obj.month)
+    if period == 'quarter':
+        quarter = (date_obj.month - 1) // 3 + 1
+        return '{0}-Q{1}'.format(date_obj.year, quarter), get_month_end(date_obj.year, quarter * 3)
+    return str(date_obj.year), date(date_obj.year, 12, 31)
 
 
-def mark_directory_as_analyzed(dir_path):
+def get_month_end(year, month):
     """"""
-    touch(fname=os.path.join(dir_path, DIRECTORY_ANALYZED_FILENAME))
+    return date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+
+
+def get_period_end(key, period):
+    """Last day of the period with key"""
+    if period == 'week':
+        year, week = key.split('-W')
+        # The 4th of January is always in week 1
+        jan4 = date(int(year), 1, 4)
+        return jan4 + timedelta(days=7 - jan4.isoweekday(), weeks=int(week) - 1)
+    if period == 'month':
+        year, month = key.split('-')
+        return get_month_end(int(year), int(month))
+    if period == 'quarter':
+        year, quarter = key.split('-Q')
+        return get_month_end(int(year), int(quarter) * 3)
+    return date(int(key), 12, 31)
+
+
+def get_period_label(key, period):
+    """Column heading of a rollup"""
+    if period == 'week':
+        return 'Week of {0}'.format((get_period_end(key, period) - timedelta(days=6)).strftime('%m/%d/%y'))
+    if period == 'month':
+        return datetime.strptime(key, '%Y-%m').strftime('%b %Y')
+    return key.replace('-', ' ')
+
+
+class IngestManifest(object):
+    """
+    Record of what has gone into a workbook: for every day file its size, mtime and sha1, the column values counted
+    from it and the worksheet column they were written to. New day files and corrected ones are picked up in any
+    month, and files whose size and mtime haven't changed are never parsed again. The keys of each day's transactions
+    are kept too, so the duplicates of transactions in earlier day files can be found without parsing those again.
+    """
+    def __init__(self, path, volume_buckets):
+        self.path = path
+        self.volume_buckets = {'edges': volume_buckets.edges, 'strict': volume_buckets.strict}
+        self.days = {}
+        # {period: {period key: rollup}} of every week, month, quarter and year with days in the manifest
+        self.rollups = {}
+        # Days added, changed or removed since the rollups were last brought up to date
+        self.changed_days = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            # The cached values are only good for the buckets they were counted with
+            if manifest.get('version') == MANIFEST_VERSION and manifest.get('volume_buckets') == self.volume_buckets:
+                self.days = manifest['days']
+                self.rollups = manifest.get('rollups', {})
+                self.changed_days = set(manifest.get('changed_days', []))
+
+    def is_stale(self, day_path, stat):
+        """"""
+        entry = self.days.get(day_path)
+        return entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime
+
+    def update(self, day_path, stat, sha1, values, leftovers=None, keys=None):
+        """Record a freshly parsed day file, returns True if its column has to be written again"""
+        entry = self.days.get(day_path)
+        changed = entry is None or entry['sha1'] != sha1 or entry['values'] != values
+        recovered = [0] * len(values) if changed else entry['recovered']
+        # A changed day's duplicates are looked for again by drop_duplicates
+        duplicates, dropped = (None, [0] * len(values)) if changed else (entry['duplicates'], entry['dropped'])
+        self.days[day_path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1, 'values': values, 'leftovers': leftovers or {'prepays': [], 'orphans': [], 'finalized': []}, 'recovered': recovered, 'keys': keys or pack_txn_keys([]), 'duplicates': duplicates, 'dropped': dropped, 'column': None if changed else entry['column']}
+        if changed:
+            self.changed_days.add(day_path)
+        return changed
+
+    def get_values(self, day_path):
+        """
+        A day's column: its own counts plus those of the finalizations matched to earlier days' prepays, less those of
+        its transactions that were already counted in an earlier day
+        """
+        entry = self.days[day_path]
+        return [a + b - c for a, b, c in zip(entry['values'], entry['recovered'], entry['dropped'])]
+
+    def drop_duplicates(self, key_index=None):
+        """
+        Run every day through key_index in date order, see dedup_day. Without one, duplicates are all kept. Returns
+        (day file, number of duplicates) of every day with any.
+        """
+        duplicates = []
+        for month_dir, day_files in self.get_months():
+            for day_path in day_files:
+                count = self.dedup_day(key_index, day_path)
+                if count:
+                    duplicates.append((day_path, count))
+        return duplicates
+
+    def dedup_day(self, key_index, day_path):
+        """
+        Find the day's transactions that an earlier day file, or the same one, already had (see TxnKeyIndex), after
+        all the days before it, and keep the counts of those dropped with the day. The day file is only parsed again
+        if its duplicates changed. Returns how many there are.
+        """
+        entry = self.days[day_path]
+        positions = key_index.add_day(day_path, entry['keys']) if key_index else []
+        if positions != entry['duplicates']:
+            dropped = self.count_duplicates(day_path, positions) if positions else [0] * len(entry['values'])
+            if dropped != entry['dropped']:
+                entry['dropped'], entry['column'] = dropped, None
+                self.changed_days.add(day_path)
+            entry['duplicates'] = positions
+        return len(positions)
+
+    def count_duplicates(self, day_path, positions):
+        """Column values of the transactions at positions of a day file, see split_duplicate_txns"""
+        day = parse_day(day_path)
+        _, (gas_txns, carwash_txns) = split_duplicate_txns(day.gas_txns, day.carwash_txns, positions)
+        return DayAnalyzer(gas_txns, day.date, None, carwash_txns, self.get_volume_buckets()).get_cell_values()
+
+    def reconcile(self, reconciler):
+        """
+        Run every day's leftovers through reconciler in date order and keep the counts of what it recovers with each
+        day. Columns whose recovered counts changed have to be written again. Returns the unmatched prepays and the
+        finalizations no prepay was found for, both as (day file, transaction) pairs.
+        """
+        unmatched, missing = [], []
+        for month_dir, day_files in self.get_months():
+            for day_path in day_files:
+                evicted, day_missing = self.reconcile_day(reconciler, day_path)
+                unmatched += [(day_path, prepay) for prepay in evicted]
+                missing += [(day_path, final_txn) for final_txn in day_missing]
+        return unmatched, missing
+
+    def reconcile_day(self, reconciler, day_path):
+        """Reconcile one day, after all the days before it. Returns (the prepays evicted unmatched, the day's finalizations no prepay was found for)"""
+        entry = self.days[day_path]
+        date_obj = get_date_for_day_file(day_path)
+        txns, evicted, missing = reconciler.add_day(date_obj, entry['leftovers'])
+        recovered = DayAnalyzer(txns, date_obj, None, [], self.get_volume_buckets()).get_cell_values()
+        if recovered != entry['recovered']:
+            entry['recovered'], entry['column'] = recovered, None
+            self.changed_days.add(day_path)
+        return evicted, missing
+
+    def get_volume_buckets(self):
+        """"""
+        return VolumeBuckets(self.volume_buckets['edges'], self.volume_buckets['strict'])
+
+    def update_rollups(self):
+        """
+        Bring the week, month, quarter and year rollups in line with the day columns. A period is closed once a
+        later day is in the manifest, and a closed period none of whose days changed is kept as cached instead of
+        being summed again. Returns True if any rollup changed.
+        """
+        dates = dict((p, get_date_for_day_file(p).date()) for p in self.days)
+        last_date = max(dates.values()) if dates else None
+        changed_dates = [get_date_for_day_file(p).date() for p in self.changed_days]
+        changed = False
+        for period in ROLLUP_PERIODS:
+            cached = self.rollups.get(period, {})
+            changed_keys = set(get_period(d, period)[0] for d in changed_dates)
+            days_by_key = {}
+            for p, d in dates.items():
+                days_by_key.setdefault(get_period(d, period)[0], []).append(p)
+            rollups = {}
+            for key, day_paths in days_by_key.items():
+                rollup = cached.get(key)
+                if rollup is None or not rollup['closed'] or key in changed_keys:
+                    values = [sum(column) for column in zip(*[self.get_values(p) for p in day_paths])]
+                    rollup = {'values': values, 'days': len(day_paths), 'closed': get_period_end(key, period) < last_date}
+                rollups[key] = rollup
+            changed = changed or rollups != cached
+            self.rollups[period] = rollups
+        self.changed_days = set()
+        return changed
+
+    def remove_missing(self, day_files_by_dir):
+        """
+        Forget every day file that wasn't scanned, whether the file, its month directory or its archive is gone, or
+        the month was moved into an archive. Returns {month directory: columns left over on its sheet} for the
+        scanned months, a removed day's column counting for the month directory or archive that now holds its month.
+        """
+        present = set(df for _, day_files in day_files_by_dir for df in day_files)
+        month_dirs = dict((get_month_name(d), d) for d, _ in day_files_by_dir)
+        removed_columns = dict((d, []) for d, _ in day_files_by_dir)
+        for p in [p for p in self.days if p not in present]:
+            self.changed_days.add(p)
+            column = self.days.pop(p)['column']
+            month_dir = month_dirs.get(get_month_name(os.path.dirname(p)))
+            if month_dir is not None:
+                removed_columns[month_dir].append(column)
+        return removed_columns
+
+    def get_months(self):
+        """(month directory, day files in date order) for every month in the manifest, in month order"""
+        months = {}
+        for day_path in self.days:
+            months.setdefault(os.path.dirname(day_path), []).append(day_path)
+        return [(month_dir, sorted(months[month_dir])) for month_dir in sorted(months, key=get_month_name)]
+
+    def save(self):
+        """"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'volume_buckets': self.volume_buckets, 'days': self.days, 'rollups': self.rollups, 'changed_days': sorted(self.changed_days)}, f)
+        os.rename(tmp_path, self.path)
+
+
+def match_line_kind(line, pos=0, endpos=None):
+    """
+    (pattern, match) for the line kind of line[pos:endpos], or NO_KIND. The first token picks the kind's pattern, which
+    then has to match for the line to be that kind.
+    """
+    if endpos is None:
+        endpos = len(line)
+    token_match = LINE_TOKEN_REGEX.match(line, pos, endpos)
+    indented, token = token_match.start(1) != pos, token_match.group(1)
+    if not indented and token[:1].isdigit():
+        regex = DATE_TIME_REGEX
+    else:
+        regex = LINE_TOKEN_REGEXES.get((indented, token))
+        if regex is None:
+            return NO_KIND
+    m = regex.match(line, pos, endpos)
+    return (regex, m) if m else NO_KIND
+
+
+class TxnBlock(object):
+    """
+    The lines of one finalized transaction, from its CUSTOMER TRANSACTION header up to the next one. Each line is
+    classified once, the first time any scan touches it, and matching a line kind's pattern reuses that match.
+    """
+    def __init__(self, lines, header_match=None):
+        self.lines = lines
+        self.voided = False
+        # (pattern, match) of each line's kind, filled in as lines are first looked at
+        self._kinds = [None] * len(self)
+        if header_match:
+            self._kinds[0] = (FINALIZED_TRANSACTION_REGEX, header_match)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def classify(self, i):
+        """(pattern, match) of the kind of line i, lines past the end of the block are NO_KIND"""
+        try:
+            kind = self._kinds[i]
+        except IndexError:
+            return NO_KIND
+        if kind is None:
+            kind = self._kinds[i] = self.match_line_kind(i)
+        return kind
+
+    def match_line_kind(self, i):
+        """"""
+        return match_line_kind(self.lines[i])
+
+    def match(self, regex, i):
+        """Match regex against line i, lines past the end of the block never match"""
+        kind_regex, m = self.classify(i)
+        if kind_regex is regex:
+            return m
+        if regex in CLASSIFIED_REGEXES or i >= len(self._kinds):
+            return None
+        # Patterns that aren't a line kind, like the indoor tender line, are only ever tried at one known line
+        return self.match_line(regex, i)
+
+    def match_line(self, regex, i):
+        """"""
+        return regex.match(self.lines[i])
+
+    def find(self, start, *regexes):
+        """
+        Scan forward from line start for the first line of any of the kinds whose patterns are regexes.
+        Returns (line index, regex, match), or (len(block), None, None) if the end of the block is reached.
+        """
+        kinds = self._kinds
+        for i in xrange(start, len(kinds)):
+            kind_regex, m = kinds[i] or self.classify(i)
+            if kind_regex in regexes:
+                return i, kind_regex, m
+        return len(kinds), None, None
+
+
+class MappedTxnBlock(TxnBlock):
+    """
+    A TxnBlock over a slice of a memory-mapped day file. Lines are never copied out of the buffer: patterns are matched
+    in place between line offsets, so only the first tokens and captured fields become new strings.
+    """
+    def __init__(self, buf, line_offsets, header_match=None):
+        self.buf = buf
+        # One offset per line start, plus the end of the block
+        self.line_offsets = line_offsets
+        TxnBlock.__init__(self, None, header_match)
+
+    def __len__(self):
+        return len(self.line_offsets) - 1
+
+    def match_line_kind(self, i):
+        """"""
+        return match_line_kind(self.buf, self.line_offsets[i], self.line_offsets[i + 1])
+
+    def match_line(self, regex, i):
+        """"""
+        return regex.match(self.buf, self.line_offsets[i], self.line_offsets[i + 1])
 
 
-def handle_initial_gas_txn(fuel_prepay_ref_match, txn_line_offset, line_offsets, txn_line, f, txn_id, date, time):
+def handle_initial_gas_txn(fuel_prepay_ref_match, txn_line_offset, block, txn_id, date, time):
     """"""
     # Check to make sure there isn't a void. If there is, the fuel_prepay_ref_match needs to be updated
-    void_offset = 0
-    void_found = False
-    while not void_found:
-        void_offset += 1
-        f.seek(line_offsets[txn_line + void_offset])
-        l = f.readline()
-        if re.match(VOID_TRANSACTION_REGEX, l):
-            void_found = True
-        elif re.match(TOTAL_DUE_REGEX, l):
-            break
+    void_offset, found, _ = block.find(1, VOID_TRANSACTION_REGEX, TOTAL_DUE_REGEX)
     # If there was a void transaction, advance until you find the new fuel prepay, or if total due is hit you're fine
-    # Otherwise, seek backwards
-    if void_found:
-        fuel_prepay_found = False
-        while not fuel_prepay_found:
-            void_offset += 1
-            f.seek(line_offsets[txn_line + void_offset])
-            l = f.readline()
-            new_prepay_match = re.match(INITIAL_FUEL_PREPAY_REGEX, l)
-            if new_prepay_match:
-                fuel_prepay_found = True
-                fuel_prepay_ref_match = new_prepay_match
-            elif re.match(TOTAL_DUE_REGEX, l):
-                break
-    else:
-        f.seek(line_offsets[txn_line + txn_line_offset])
+    if found is VOID_TRANSACTION_REGEX:
+        block.voided = True
+        _, found, new_prepay_match = block.find(void_offset + 1, INITIAL_FUEL_PREPAY_REGEX, TOTAL_DUE_REGEX)
+        if found is INITIAL_FUEL_PREPAY_REGEX:
+            fuel_prepay_ref_match = new_prepay_match
     # We've got a prepay, create a new gas txn
     ref_num = fuel_prepay_ref_match.group('ref_num')
     pump_num = fuel_prepay_ref_match.group('pump_num')
-    # Seek to the next line to get the amount
+    # The amount is on the line after the prepay
     txn_line_offset += 1
-    f.seek(line_offsets[txn_line + txn_line_offset])
-    f_pre_amt_line = f.readline()
-    amt_match = re.match(FUEL_PREPAY_AMOUNT_REGEX, f_pre_amt_line)
+    amt_match = block.match(FUEL_PREPAY_AMOUNT_REGEX, txn_line_offset)
     amount = float('{0}.{1}'.format(amt_match.group('dollars'), amt_match.group('cents')))
-    # Seek until you reach the TOTAL DUE line
-    total_due_line_found = False
-    while not total_due_line_found:
-        txn_line_offset += 1
-        f.seek(line_offsets[txn_line + txn_line_offset])
-        l = f.readline()
-        if re.match(TOTAL_DUE_REGEX, l):
-            total_due_line_found = True
-    # Seek ahead one line, if it's BALANCE DUE then it's cash and you're good
+    # Advance until you reach the TOTAL DUE line
+    txn_line_offset, _, _ = block.find(txn_line_offset + 1, TOTAL_DUE_REGEX)
+    # Look ahead one line, if it's BALANCE DUE then it's cash and you're good
     txn_line_offset += 1
-    f.seek(line_offsets[txn_line + txn_line_offset])
-    next_line = f.readline()
-    if re.match(BALANCE_DUE_REGEX, next_line):
+    if block.match(BALANCE_DUE_REGEX, txn_line_offset):
         tender = Tender.Cash.name
     else:
-        # Seek ahead one more line, and pull the word out
+        # Look ahead one more line, and pull the word out
         txn_line_offset += 1
-        f.seek(line_offsets[txn_line + txn_line_offset])
-        t_type_line = f.readline()
-        tender_type_match = re.match(INDOOR_TENDER_TYPE_REGEX, t_type_line)
+        tender_type_match = block.match(INDOOR_TENDER_TYPE_REGEX, txn_line_offset)
         if tender_type_match:
             tender = tender_type_match.group('tender')
         else:
             tender = Tender.Cash.name
     prepay_txn = GasTxn(id=txn_id, date=date, time=time, amount=amount, location=Location.Indoor.name, tender=tender, volume=None, gas_type=None, pump_num=pump_num, indoor_prepay=True, reference_num=ref_num)
-    carwash_txn = scan_for_carwash_from_line(txn_line, line_offsets, f)
+    carwash_txn = scan_for_carwash(block)
     if carwash_txn:
         prepay_txn.carwash_txn = carwash_txn
     return True, prepay_txn
 
 
-def handle_final_gas_txn(original_fuel_prepay_match, txn_line_offset, line_offsets, txn_line, f, txn_id, date, time):
+def handle_final_gas_txn(original_fuel_prepay_match, txn_line_offset, block, txn_id, date, time):
     """"""
     ref_num = original_fuel_prepay_match.group('ref_num')
-    # Seek ahead to get the gas type
-    fuel_type_found, fuel_type_match = False, None
-    while not fuel_type_found:
-        txn_line_offset += 1
-        f.seek(line_offsets[txn_line + txn_line_offset])
-        t_line = f.readline()
-        fuel_type_match = re.match(FUEL_TYPE_REGEX, t_line)
-        if fuel_type_match:
-            fuel_type_found = True
+    # Advance to get the gas type
+    txn_line_offset, _, fuel_type_match = block.find(txn_line_offset + 1, FUEL_TYPE_REGEX)
     if not fuel_type_match:
         return False, None
     fuel_type = fuel_type_match.group('gas_type')
-    # Seek forward two lines to get the volume
+    # The volume is two lines further on
     txn_line_offset += 2
-    f.seek(line_offsets[txn_line + txn_line_offset])
-    vol_line = f.readline()
-    vol_match = re.match(FUEL_VOLUME_REGEX, vol_line)
+    vol_match = block.match(FUEL_VOLUME_REGEX, txn_line_offset)
     fuel_volume = '{0}.{1}'.format(vol_match.group('galls'), vol_match.group('galls_dec'))
     price = '{0}.{1}'.format(vol_match.group('price'), vol_match.group('price_dec'))
     final_txn = GasTxn(id=txn_id, date=date, time=time, amount=None, volume=fuel_volume, location=Location.Indoor.name, tender=None, gas_type=fuel_type, pump_num=None, indoor_prepay=False, reference_num=ref_num, price=price)
     return True, final_txn
 
 
-def handle_outdoor_gas_txn(txn_id, date, time, pump_num, txn_line_offset, line_offsets, txn_line, f):
+def handle_outdoor_gas_txn(txn_id, date, time, pump_num, txn_line_offset, block):
     """"""
-    # Advance 2 lines to get fuel type
+    # Advance 3 lines to get fuel type
     txn_line_offset += 3
-    f.seek(line_offsets[txn_line + txn_line_offset])
-    f_type_line = f.readline()
-    fuel_type_match = re.match(FUEL_TYPE_REGEX, f_type_line)
+    fuel_type_match = block.match(FUEL_TYPE_REGEX, txn_line_offset)
     fuel_type = fuel_type_match.group('gas_type')
     amount = '{0}.{1}'.format(fuel_type_match.group('dollars'), fuel_type_match.group('cents'))
     # Advance 2 lines to get volume
     txn_line_offset += 2
-    f.seek(line_offsets[txn_line + txn_line_offset])
-    vol_line = f.readline()
-    vol_match = re.match(FUEL_VOLUME_REGEX, vol_line)
+    vol_match = block.match(FUEL_VOLUME_REGEX, txn_line_offset)
     fuel_volume = '{0}.{1}'.format(vol_match.group('galls'), vol_match.group('galls_dec'))
     price = '{0}.{1}'.format(vol_match.group('price'), vol_match.group('price_dec'))
-    tender_type_found, tender = False, None
-    while not tender_type_found:
-        txn_line_offset += 1
-        f.seek(line_offsets[txn_line + txn_line_offset])
-        t_line = f.readline()
-        tender_match = re.match(OUTDOOR_TENDER_TYPE_REGEX, t_line)
-        if tender_match:
-            tender_type_found = True
-            tender = tender_match.group('tender')
+    _, _, tender_match = block.find(txn_line_offset + 1, OUTDOOR_TENDER_TYPE_REGEX)
+    tender = tender_match.group('tender') if tender_match else None
     outdoor_txn = GasTxn(id=txn_id, date=date, time=time, amount=amount, volume=fuel_volume, location=Location.Outdoor.name, tender=tender, gas_type=fuel_type, pump_num=pump_num, indoor_prepay=False, reference_num=None, price=price)
-    carwash_txn = scan_for_carwash_from_line(txn_line, line_offsets, f)
+    carwash_txn = scan_for_carwash(block)
     if carwash_txn:
         outdoor_txn.carwash_txn = carwash_txn
     return outdoor_txn
 
 
-def scan_for_carwash_from_line(txn_line, line_offsets, f, location=None, tender_scan=False):
+def scan_for_carwash(block, location=None, tender_scan=False):
     """"""
-    carwash_found, carwash_match = False, None
-    carwash_offset = 0
-    l = None
-    while not carwash_found:
-        carwash_offset += 1
-        f.seek(line_offsets[txn_line + carwash_offset])
-        l = f.readline()
-        carwash_match = re.match(CARWASH_REGEX, l)
-        total_due_match = re.match(TOTAL_DUE_REGEX, l)
-        if carwash_match:
-            carwash_found = True
-        elif total_due_match:
-            break
-    if carwash_found:
-        if l[(carwash_match.start('dollars')-1)] != '-':
+    carwash_offset, found, carwash_match = block.find(1, CARWASH_REGEX, TOTAL_DUE_REGEX)
+    if found is CARWASH_REGEX:
+        if carwash_match.string[(carwash_match.start('dollars')-1)] != '-':
             tender = None
             if tender_scan:
-                tender_found, tender_match = False, None
-                tender_offset = carwash_offset
-                while not tender_found:
-                    tender_offset += 1
-                    f.seek(line_offsets[txn_line + tender_offset])
-                    l = f.readline()
-                    tender_match = re.match(OUTDOOR_TENDER_TYPE_REGEX, l)
-                    if tender_match:
-                        tender_found = True
-                tender = tender_match.group('tender')
+                _, _, tender_match = block.find(carwash_offset + 1, OUTDOOR_TENDER_TYPE_REGEX)
+                if tender_match:
+                    tender = tender_match.group('tender')
             return CarWashTxn(id=None, date=None, time=None, amount=None, location=location, carwash_type=carwash_match.group('type'), tender=tender)
     return None
 
 
-def get_gas_transaction_from_line(txn_line, line_offsets, f):
+def get_txn_header(block):
+    """(txn_id, date, time) from the header of a transaction block"""
+    txn_id = block.match(FINALIZED_TRANSACTION_REGEX, 0).group('txn_id')
+    dt_match = block.match(DATE_TIME_REGEX, 1)
+    date = '{0}/{1}/{2}'.format(dt_match.group('month'), dt_match.group('day'), dt_match.group('yr'))
+    time = '{0}:{1}:{2}'.format(dt_match.group('hr'), dt_match.group('min'), dt_match.group('sec'))
+    return txn_id, date, time
+
+
+def get_gas_transaction_from_block(block):
     """
     txn_line + 1: Date and time
     txn_line + 2: Indoor or Outdoor
@@ -430,68 +868,37 @@ def get_gas_transaction_from_line(txn_line, line_offsets, f):
         txn_line + 8: 'UNLEADED PUR       17.00
         txn_line + 9: 'Ticket #923757      Pump 6'
         txn_line + 10: 'Vol      4.078@     4.169'
+
+    Offsets are relative to the header line. No search ever leaves the block: running off its end behaves like the end of the file.
     """
-    f.seek(line_offsets[txn_line])
     txn_line_offset = 0
-    txn_id = re.match(FINALIZED_TRANSACTION_REGEX, f.readline()).group('txn_id')
-    txn_line_offset += 1
-    d_time_line = f.readline()
-    dt_match = re.match(DATE_TIME_REGEX, d_time_line)
-    date = '{0}/{1}/{2}'.format(dt_match.group('month'), dt_match.group('day'), dt_match.group('yr'))
-    time = '{0}:{1}:{2}'.format(dt_match.group('hr'), dt_match.group('min'), dt_match.group('sec'))
-    txn_line_offset += 1
-    f.seek(line_offsets[txn_line + txn_line_offset])
-    loc_tmnl_line = f.readline()
-    loc_tmnl_match = re.match(INDOOR_OUTDOOR_REGEX, loc_tmnl_line)
+    txn_id, date, time = get_txn_header(block)
+    txn_line_offset += 2
+    loc_tmnl_match = block.match(INDOOR_OUTDOOR_REGEX, txn_line_offset)
     if loc_tmnl_match.group('location') == Location.Indoor.name:
-        # Seek to the next line to test for user session
+        # Check the next line for a user session
         txn_line_offset += 1
-        f.seek(line_offsets[txn_line + txn_line_offset])
-        u_ses_line = f.readline()
-        user_session_match = re.match(USER_SESSION_REGEX, u_ses_line)
-        if user_session_match:
-            # Seek ahead to see if this is a fuel prepay. If TOTAL DUE is hit, it's not
-            fuel_prepay_found, fuel_prepay_ref_match = False, None
-            original_fuel_prepay_line_found, ofp_match = False, None
-            while not (fuel_prepay_found or original_fuel_prepay_line_found):
-                txn_line_offset += 1
-                f.seek(line_offsets[txn_line + txn_line_offset])
-                l = f.readline()
-                fuel_prepay_ref_match = re.match(INITIAL_FUEL_PREPAY_REGEX, l)
-                ofp_match = re.match(FINAL_FUEL_PREPAY_REGEX, l)
-                if fuel_prepay_ref_match:
-                    fuel_prepay_found = True
-                elif ofp_match:
-                    original_fuel_prepay_line_found = True
-                elif re.match(TOTAL_DUE_REGEX, l):
-                    break
-            if fuel_prepay_found:
-                return handle_initial_gas_txn(fuel_prepay_ref_match, txn_line_offset, line_offsets, txn_line, f, txn_id, date, time)
-            elif original_fuel_prepay_line_found:
-                return handle_final_gas_txn(ofp_match, txn_line_offset, line_offsets, txn_line, f, txn_id, date, time)
+        if block.match(USER_SESSION_REGEX, txn_line_offset):
+            # Search ahead to see if this is a fuel prepay. If TOTAL DUE is hit, it's not
+            txn_line_offset, found, prepay_match = block.find(txn_line_offset + 1, INITIAL_FUEL_PREPAY_REGEX, FINAL_FUEL_PREPAY_REGEX, TOTAL_DUE_REGEX)
+            if found is INITIAL_FUEL_PREPAY_REGEX:
+                return handle_initial_gas_txn(prepay_match, txn_line_offset, block, txn_id, date, time)
+            elif found is FINAL_FUEL_PREPAY_REGEX:
+                return handle_final_gas_txn(prepay_match, txn_line_offset, block, txn_id, date, time)
             else:
                 # It's not a prepay, return False, None
                 return False, None
         else:
             # Could be a finalized fuel transaction still
-            original_fuel_prepay_line_found, ofp_match = False, None
-            while not original_fuel_prepay_line_found:
-                txn_line_offset += 1
-                f.seek(line_offsets[txn_line + txn_line_offset])
-                l = f.readline()
-                ofp_match = re.match(FINAL_FUEL_PREPAY_REGEX, l)
-                if ofp_match:
-                    original_fuel_prepay_line_found = True
-                elif re.match(TOTAL_DUE_REGEX, l):
-                    break
-            if original_fuel_prepay_line_found:
-                return handle_final_gas_txn(ofp_match, txn_line_offset, line_offsets, txn_line, f, txn_id, date, time)
+            txn_line_offset, found, ofp_match = block.find(txn_line_offset + 1, FINAL_FUEL_PREPAY_REGEX, TOTAL_DUE_REGEX)
+            if found is FINAL_FUEL_PREPAY_REGEX:
+                return handle_final_gas_txn(ofp_match, txn_line_offset, block, txn_id, date, time)
             else:
                 return False, None
     else:
         # It's outdoor, this is a gas txn
         pump_num = loc_tmnl_match.group('terminal')
-        return True, handle_outdoor_gas_txn(txn_id, date, time, pump_num, txn_line_offset, line_offsets, txn_line, f)
+        return True, handle_outdoor_gas_txn(txn_id, date, time, pump_num, txn_line_offset, block)
 
 
 def merge_txns(prepay_txn, final_txn):
@@ -503,101 +910,1753 @@ def merge_txns(prepay_txn, final_txn):
     return final_txn
 
 
-def get_gas_transactions_for_day(day_path):
-    """"""
-    gas_txns = []
-    carwash_txns = []
-    prepay_map = {}
-    skip_ref_set = set()
-    with open(day_path, 'r') as day:
-        txn_lines, line_offsets = [], []
-        offset = day.tell()
-        for i, line in enumerate(day):
-            line_offsets.append(offset)
-            offset += len(line)
-            m = re.match(FINALIZED_TRANSACTION_REGEX, line)
-            if m:
-                txn_lines.append(i)
-        day.seek(0)
-        for txn in txn_lines:
-            is_gas_txn, gas_txn = get_gas_transaction_from_line(txn, line_offsets, day)
-            if is_gas_txn:
-                if gas_txn.indoor_prepay:
-                    # put it in the prepay map
-                    prepay_map[gas_txn.reference_num] = gas_txn
-                elif gas_txn.location == Location.Indoor.name:
-                    if gas_txn.reference_num in skip_ref_set:
-                        continue
-                    skip_ref_set.add(gas_txn.reference_num)
-                    if gas_txn.reference_num not in prepay_map:
-                        print '\tMissing txn number: {0}'.format(gas_txn.reference_num)
-                        continue
-                    prepay_txn = prepay_map[gas_txn.reference_num]
-                    del prepay_map[gas_txn.reference_num]
-                    gas_txn = merge_txns(prepay_txn, gas_txn)
-                    gas_txns.append(gas_txn)
-                else:
-                    gas_txns.append(gas_txn)
+class ParseStats(object):
+    """
+    Counters and timings for parsing one day file:
+        lines: lines read into finalized transactions
+        txns: finalized transactions seen, each one is counted as exactly one of gas, carwash or skipped
+        voids: prepays that were voided and rung up again
+        prepays: indoor prepays rung up
+        unmatched_prepays: prepays still waiting for their finalization at the end of the file
+        orphaned_finalizations: finalizations whose prepay wasn't in the file, left for PrepayReconciler to match
+        duplicate_finalizations: finalizations of a prepay that was already finalized
+    """
+    COUNTERS = ('lines', 'txns', 'gas', 'carwash', 'skipped', 'voids', 'prepays', 'unmatched_prepays', 'orphaned_finalizations', 'duplicate_finalizations')
+
+    def __init__(self, path=None):
+        self.path = path
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.seconds = {}
+
+    def add_seconds(self, stage, seconds):
+        """"""
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def as_record(self):
+        """"""
+        return {'path': self.path, 'counts': self.counts, 'seconds': self.seconds}
+
+
+class DayParser(object):
+    """
+    Forward-only parser for a day report. Lines are fed in order and each one is read exactly once: until the first
+    CUSTOMER TRANSACTION header the parser is waiting, after that it is collecting the current transaction, which is
+    parsed as soon as the next header (or the end of the input) closes it. It never seeks, so any line iterable will
+    do, including pipes.
+    """
+    def __init__(self, stats=None):
+        self.gas_txns = []
+        self.carwash_txns = []
+        self.prepay_map = {}
+        self.skip_ref_set = set()
+        # Finalizations whose prepay wasn't seen, it may have been rung up the day before
+        self.orphaned_txns = []
+        self.txn_lines = None
+        self.header_match = None
+        self.stats = stats or ParseStats()
+
+    def feed(self, line):
+        """"""
+        # Only header lines start with CUSTOMER, so the rest never reach the pattern
+        header_match = line.startswith('CUSTOMER') and FINALIZED_TRANSACTION_REGEX.match(line)
+        if header_match:
+            self.end_txn()
+            self.txn_lines, self.header_match = [line], header_match
+        elif self.txn_lines is not None:
+            self.txn_lines.append(line)
+
+    def end_txn(self):
+        """"""
+        if self.txn_lines is None:
+            return
+        block = TxnBlock(self.txn_lines, self.header_match)
+        self.txn_lines, self.header_match = None, None
+        self.add_txn_block(block)
+
+    def add_txn_block(self, block):
+        """"""
+        counts = self.stats.counts
+        counts['lines'] += len(block)
+        counts['txns'] += 1
+        is_gas_txn, gas_txn = get_gas_transaction_from_block(block)
+        if is_gas_txn:
+            counts['gas'] += 1
+            if gas_txn.indoor_prepay:
+                counts['voids'] += block.voided
+            self.add_gas_txn(gas_txn)
+        else:
+            # Get the location type
+            l_match = block.match(INDOOR_OUTDOOR_REGEX, 2)
+            carwash_txn = scan_for_carwash(block, location=l_match.group('location'), tender_scan=True)
+            if carwash_txn:
+                counts['carwash'] += 1
+                # Its own transaction, so it can be told apart from the same carwash in a re-exported day file
+                carwash_txn.id, date, carwash_txn.time = get_txn_header(block)
+                carwash_txn.date = intern_name(date)
+                self.carwash_txns.append(carwash_txn)
             else:
-                # Get the location type
-                day.seek(line_offsets[txn + 2])
-                l_match = re.match(INDOOR_OUTDOOR_REGEX, day.readline())
-                carwash_txn = scan_for_carwash_from_line(txn, line_offsets, day, location=l_match.group('location'),tender_scan=True)
-                if carwash_txn:
-                    carwash_txns.append(carwash_txn)
-    return gas_txns, carwash_txns
+                counts['skipped'] += 1
+
+    def add_gas_txn(self, gas_txn):
+        """Pair prepays with their finalizations, any other gas transaction is kept as it is"""
+        counts = self.stats.counts
+        if gas_txn.indoor_prepay:
+            counts['prepays'] += 1
+            # put it in the prepay map
+            self.prepay_map[gas_txn.reference_num] = gas_txn
+        elif gas_txn.location == Location.Indoor.name:
+            if gas_txn.reference_num in self.skip_ref_set:
+                counts['duplicate_finalizations'] += 1
+                return
+            self.skip_ref_set.add(gas_txn.reference_num)
+            if gas_txn.reference_num not in self.prepay_map:
+                # Not missing yet, its prepay may be in an earlier day file
+                counts['orphaned_finalizations'] += 1
+                self.orphaned_txns.append(gas_txn)
+                return
+            prepay_txn = self.prepay_map.pop(gas_txn.reference_num)
+            self.gas_txns.append(merge_txns(prepay_txn, gas_txn))
+        else:
+            self.gas_txns.append(gas_txn)
 
+    def add_chunk(self, gas_txns, carwash_txns, counts):
+        """Merge what a ChunkParser read, chunks have to be added in file order"""
+        for counter, count in counts.items():
+            self.stats.counts[counter] += count
+        self.carwash_txns += carwash_txns
+        for gas_txn in gas_txns:
+            self.add_gas_txn(gas_txn)
 
-def get_column_letter_for_column_number(row, col):
+    def close(self):
+        """Parse the last open transaction and return (gas_txns, carwash_txns)"""
+        self.end_txn()
+        self.stats.counts['unmatched_prepays'] = len(self.prepay_map)
+        return self.gas_txns, self.carwash_txns
+
+    def get_leftovers(self):
+        """
+        What this day leaves for PrepayReconciler, as JSON-able records: the prepays still waiting for their
+        finalization, the finalizations that had no prepay and the reference numbers that were finalized here.
+        """
+        orphan_refs = set(t.reference_num for t in self.orphaned_txns)
+        return {
+            'prepays': [txn_to_record(t) for t in sorted(self.prepay_map.values(), key=lambda t: get_seconds_of_day(t.time))],
+            'orphans': [txn_to_record(t) for t in self.orphaned_txns],
+            'finalized': sorted(self.skip_ref_set - orphan_refs),
+        }
+
+
+class ChunkParser(DayParser):
     """
+    DayParser for one chunk of a day file parsed on its own. Its prepays may be finalized in a later chunk and its
+    finalizations may belong to an earlier one, so gas transactions are kept in file order, unpaired, for
+    DayParser.add_chunk to pair once the chunks before it are in.
     """
-    quot, rem = divmod(col-1, 26)
-    return((chr(quot-1 + ord("A")) if quot else "") +
-           (chr(rem + ord("A")) + str(row)))
+    def add_gas_txn(self, gas_txn):
+        """"""
+        self.gas_txns.append(gas_txn)
 
 
-def initialize_worksheet(ws):
-    """"""
-    index = 2
-    bold_font = Font(bold=True)
-    label_fill = PatternFill(fill_type='solid', start_color=Color('00EEEEEE'))
-    label_cell_style = Style(font=bold_font, fill=label_fill)
-    for i, label in enumerate(GAS_CELL_LABELS):
-        label_cell = ws.cell('A{0}'.format(i + index))
-        label_cell.value = label
-        label_cell.style = label_cell_style
-    return ws
+class ExpiringStore(object):
+    """
+    Values keyed by reference number, each stamped with the time it was added, kept for at most ttl seconds and
+    max_size entries. Entries are expected to be added roughly in time order, so the oldest are always at the front
+    and eviction never has to look past the first entry that's still young enough.
+    """
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
 
+    def __len__(self):
+        return len(self.entries)
 
-def main(args):
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, key, timestamp, value=None):
+        """Add or replace key, returns the (key, value) pairs pushed out to stay within max_size"""
+        self.entries.pop(key, None)
+        self.entries[key] = (timestamp, value)
+        evicted = []
+        while len(self.entries) > self.max_size:
+            old_key, (_, old_value) = self.entries.popitem(last=False)
+            evicted.append((old_key, old_value))
+        return evicted
+
+    def pop(self, key):
+        """"""
+        return self.entries.pop(key)[1]
+
+    def expire(self, now):
+        """Drop everything added more than ttl seconds before now, returns the dropped (key, value) pairs"""
+        evicted = []
+        while self.entries:
+            key, (timestamp, value) = next(self.entries.iteritems())
+            if timestamp >= now - self.ttl:
+                break
+            del self.entries[key]
+            evicted.append((key, value))
+        return evicted
+
+
+def get_timestamp(date_obj, time=None):
+    """Seconds since 1/1/1 of an 'HH:MM:SS' time in the day file for date_obj, midnight if there's no time"""
+    return date_obj.toordinal() * 86400 + max(get_seconds_of_day(time), 0)
+
+
+class PrepayReconciler(object):
+    """
+    Matches finalizations to prepays rung up on earlier days, like a prepay before midnight pumped after it. Fed the
+    get_leftovers() of consecutive days in date order, it keeps the unmatched prepays and the reference numbers already
+    finalized in ExpiringStores, so memory stays bounded however many years are fed through. A prepay that ages out
+    of its store was never finalized and is reported as unmatched.
+    """
+    def __init__(self, ttl_hours=PREPAY_TTL_HOURS, max_pending=MAX_PENDING_PREPAYS):
+        self.pending = ExpiringStore(ttl_hours * 3600, max_pending)
+        self.finalized = ExpiringStore(ttl_hours * 3600, max_pending)
+        self.counts = dict.fromkeys(('recovered', 'unmatched', 'missing', 'duplicates'), 0)
+
+    def add_day(self, date_obj, leftovers):
+        """
+        Reconcile one day's leftovers with the days before it. Returns (the day's orphaned finalizations merged with
+        their prepays, the prepays evicted unmatched while doing so, the day's finalizations whose prepay wasn't in
+        any earlier day either). Prepays are rung up before they're finalized, so a finalization is only ever missing
+        on its own day.
+        """
+        recovered, evicted, missing = [], [], []
+        for record in leftovers['orphans']:
+            final_txn = txn_from_record(GasTxn, record)
+            now = get_timestamp(date_obj, final_txn.time)
+            evicted += self.expire(now)
+            ref_num = final_txn.reference_num
+            if ref_num in self.pending:
+                recovered.append(merge_txns(self.pending.pop(ref_num), final_txn))
+                self.finalized.add(ref_num, now)
+            elif ref_num in self.finalized:
+                self.counts['duplicates'] += 1
+            else:
+                missing.append(final_txn)
+        day_start = get_timestamp(date_obj)
+        for ref_num in leftovers['finalized']:
+            self.finalized.add(ref_num, day_start)
+        for record in leftovers['prepays']:
+            prepay_txn = txn_from_record(GasTxn, record)
+            evicted += [prepay for _, prepay in self.pending.add(prepay_txn.reference_num, get_timestamp(date_obj, prepay_txn.time), prepay_txn)]
+        # Everything up to the end of the day has been seen
+        evicted += self.expire(day_start + 86400)
+        self.counts['recovered'] += len(recovered)
+        self.counts['unmatched'] += len(evicted)
+        self.counts['missing'] += len(missing)
+        return recovered, evicted, missing
+
+    def expire(self, now):
+        """"""
+        self.finalized.expire(now)
+        return [prepay for _, prepay in self.pending.expire(now)]
+
+
+class TxnKeySet(object):
+    """
+    Exact set of integer keys, packed into a sorted array of machine words (8 bytes a key) instead of a Python set's
+    70 or so, so every transaction in years of history fits in a few tens of MB. New keys wait in a small set until it
+    reaches a quarter of the array (TXN_KEY_MERGE_SIZE at least) and are then merged in, which keeps the cost of
+    merging at a few steps a key. Keys the array can't hold, like tuples, go to a plain set.
+    """
+    def __init__(self):
+        self.keys = array(TXN_KEY_TYPECODE)
+        self.pending = set()
+        self.overflow = set()
+        self.limit = 1 << (8 * self.keys.itemsize)
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending) + len(self.overflow)
+
+    def __contains__(self, key):
+        if not isinstance(key, (int, long)) or not 0 <= key < self.limit:
+            return key in self.overflow
+        if key in self.pending:
+            return True
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def add(self, key):
+        """Add key, returns False if it was already in the set"""
+        if key in self:
+            return False
+        if not isinstance(key, (int, long)) or not 0 <= key < self.limit:
+            self.overflow.add(key)
+            return True
+        self.pending.add(key)
+        if len(self.pending) >= max(TXN_KEY_MERGE_SIZE, len(self.keys) // 4):
+            self.merge()
+        return True
+
+    def merge(self):
+        """"""
+        self.keys = array(TXN_KEY_TYPECODE, heapq.merge(self.keys, sorted(self.pending)))
+        self.pending = set()
+
+
+def get_txn_key(txn, date_ordinals):
+    """
+    A transaction's id, date and time packed into one int for a TxnKeySet, or a tuple of them if the id is too long to
+    pack. None if the transaction is missing any of them.
+    """
+    if not (txn.id and txn.date and txn.time):
+        return None
+    txn_id = int(txn.id)
+    timestamp = get_date_ordinal(txn.date, date_ordinals) * 86400 + get_seconds_of_day(txn.time)
+    if txn_id >> TXN_ID_BITS:
+        return timestamp, txn_id
+    return (timestamp << TXN_ID_BITS) | txn_id
+
+
+class DuplicateFilter(object):
+    """
+    Drops transactions that were already seen, in an earlier day file or earlier in the same one, like the days of a
+    day file Blue Cube exported twice or of month directories that overlap. Transactions are the same if their id,
+    date and time are; one missing any of those is always kept. Fed years of day files, the keys of every transaction
+    seen so far stay in a TxnKeySet.
+    """
+    def __init__(self):
+        self.keys = TxnKeySet()
+        self.date_ordinals = {}
+        self.counts = dict.fromkeys(('checked', 'duplicates'), 0)
+
+    def filter(self, txns):
+        """Returns (the transactions not seen before, the duplicates dropped), each in the order given"""
+        kept, dropped = [], []
+        for txn in txns:
+            key = get_txn_key(txn, self.date_ordinals)
+            (kept if key is None or self.keys.add(key) else dropped).append(txn)
+        self.counts['checked'] += len(kept) + len(dropped)
+        self.counts['duplicates'] += len(dropped)
+        return kept, dropped
+
+
+def get_day_txn_keys(gas_txns, carwash_txns):
+    """pack_txn_keys of a day file's transactions, gas_txns then carwash_txns"""
+    date_ordinals = {}
+    return pack_txn_keys([get_txn_key(t, date_ordinals) for t in itertools.chain(gas_txns, carwash_txns)])
+
+
+def pack_txn_keys(keys):
+    """
+    JSON-able form of a day file's transaction keys (see get_txn_key), for the manifest and pool results: the keys
+    that fit packed into 8 byte words and base64 encoded, 0 standing in for a missing key, the rest as [position,
+    timestamp, id]. Along with them go the first and last date ordinal they fall on and whether any of them repeats.
+    """
+    words, other, timestamps = [], [], []
+    for i, key in enumerate(keys):
+        if key is None:
+            words.append(0)
+            continue
+        if isinstance(key, tuple):
+            timestamp = key[0]
+        else:
+            timestamp = key >> TXN_ID_BITS
+        timestamps.append(timestamp)
+        if isinstance(key, tuple) or key >> 64:
+            words.append(0)
+            other.append([i, timestamp, key[1] if isinstance(key, tuple) else key & ((1 << TXN_ID_BITS) - 1)])
+        else:
+            words.append(key)
+    present = [k for k in keys if k is not None]
+    return {
+        'packed': base64.b64encode(struct.pack('<{0}Q'.format(len(words)), *words)),
+        'other': other,
+        'dates': [min(timestamps) // 86400, max(timestamps) // 86400] if timestamps else None,
+        'repeats': len(set(present)) != len(present),
+    }
+
+
+def unpack_txn_keys(packed):
+    """The keys pack_txn_keys was given, except that those too big to pack come back as (timestamp, id)"""
+    data = base64.b64decode(packed['packed'])
+    keys = [k or None for k in struct.unpack('<{0}Q'.format(len(data) // 8), data)]
+    for i, timestamp, txn_id in packed['other']:
+        keys[i] = (timestamp, txn_id)
+    return keys
+
+
+class TxnKeyIndex(object):
+    """
+    DuplicateFilter for day files whose transactions are long gone, working from their pack_txn_keys instead. Days
+    are looked up by the dates their transactions fall on, so a day is only compared key by key with the earlier days
+    that have transactions on the same dates, and a day with none is never even unpacked.
+    """
+    def __init__(self):
+        self.days_by_date = {}
+        self.packed = {}
+        self.key_sets = {}
+        self.counts = dict.fromkeys(('days', 'duplicates'), 0)
+
+    def add_day(self, day, packed):
+        """Positions of the day's keys that an earlier day, or an earlier transaction of the same day, already had"""
+        dates = xrange(packed['dates'][0], packed['dates'][1] + 1) if packed['dates'] else ()
+        earlier = []
+        for d in dates:
+            earlier += [other for other in self.days_by_date.get(d, ()) if other not in earlier]
+        for d in dates:
+            self.days_by_date.setdefault(d, []).append(day)
+        self.packed[day] = packed
+        positions = []
+        if earlier or packed['repeats']:
+            seen = set()
+            for other in earlier:
+                seen.update(self.get_key_set(other))
+            for i, key in enumerate(unpack_txn_keys(packed)):
+                if key is None:
+                    continue
+                if key in seen:
+                    positions.append(i)
+                else:
+                    seen.add(key)
+        self.counts['days'] += 1
+        self.counts['duplicates'] += len(positions)
+        return positions
+
+    def get_key_set(self, day):
+        """"""
+        if day not in self.key_sets:
+            self.key_sets[day] = set(k for k in unpack_txn_keys(self.packed[day]) if k is not None)
+        return self.key_sets[day]
+
+
+def split_duplicate_txns(gas_txns, carwash_txns, positions):
+    """
+    ((gas txns, carwash txns) kept, (gas txns, carwash txns) dropped) of a day file, positions being those
+    TxnKeyIndex.add_day found of the duplicates, counting through gas_txns and then carwash_txns
+    """
+    positions = set(positions)
+    kept, dropped = ([], []), ([], [])
+    for i, t in enumerate(gas_txns):
+        (dropped if i in positions else kept)[0].append(t)
+    for i, t in enumerate(carwash_txns, len(gas_txns)):
+        (dropped if i in positions else kept)[1].append(t)
+    return kept, dropped
+
+
+def get_gas_transactions_from_lines(lines, stats=None):
     """"""
-    months_directory_path = './'
-    excel_workbook_path = './results.xlsx'
-    if len(args) > 2:
-        months_directory_path = args[1]
-        excel_workbook_path = args[2]
-
-    month_directories = [os.path.join(months_directory_path, p) for p in os.listdir(months_directory_path) if isdir(os.path.join(months_directory_path, p))]
-    dirs = get_month_directories_to_analyze(month_directories)
-    try:
-        wb = load_workbook(excel_workbook_path)
-    except InvalidFileException:
-        wb = Workbook()
-        wb.save(excel_workbook_path)
-    for d in dirs:
-        day_files = [os.path.join(d, p) for p in os.listdir(d) if os.path.splitext(p)[1] == '.txt']
-        date_obj = datetime.strptime(str(d).split('/')[-1], '%Y%m')
-        ws_title = date_obj.strftime('%B %Y')
-        ws = wb.create_sheet(title=ws_title)
-        ws = initialize_worksheet(ws)
-        for i, df in enumerate(day_files):
-            gas_txns, carwash_txns = get_gas_transactions_for_day(df)
-            date_obj = datetime.strptime(str(df).split('/')[-1].split('.txt')[0], '%Y%m%d')
-            da = DayAnalyzer(gas_txns, date_obj, i+2, carwash_txns)
-            print 'adding gas txns for {0}'.format(date_obj)
-            da.add_gas_txns_to_worksheet(ws)
-        mark_directory_as_analyzed(d)
-        wb.save(excel_workbook_path)
+    start = time.time()
+    parser = DayParser(stats)
+    for line in lines:
+        parser.feed(line)
+    txns = parser.close()
+    parser.stats.add_seconds('parse', time.time() - start)
+    return txns
+
+
+def find_line_start(buf, sub, start=0, end=None):
+    """Offset of the first occurrence of sub at the start of a line in buf[start:end], or -1"""
+    if end is None:
+        end = len(buf)
+    pos = buf.find(sub, start, end)
+    while pos > 0 and buf[pos - 1] != '\n':
+        pos = buf.find(sub, pos + 1, end)
+    return pos
+
+
+def find_txn_header(buf, start=0, end=None):
+    """(offset, match) of the first CUSTOMER TRANSACTION header line in buf[start:end], or (-1, None)"""
+    if end is None:
+        end = len(buf)
+    pos = find_line_start(buf, 'CUSTOMER', start, end)
+    while pos != -1:
+        line_end = buf.find('\n', pos, end)
+        line_end = end if line_end == -1 else line_end + 1
+        m = FINALIZED_TRANSACTION_REGEX.match(buf, pos, line_end)
+        if m:
+            return pos, m
+        pos = find_line_start(buf, 'CUSTOMER', line_end, end)
+    return -1, None
+
+
+def iter_mapped_txn_blocks(buf, start=0, end=None):
+    """
+    Yield a MappedTxnBlock for each finalized transaction whose header is in buf[start:end], in order. The last block
+    ends at end, so a range that ends at a header holds only whole transactions.
+    """
+    if end is None:
+        end = len(buf)
+    pos, header_match = find_txn_header(buf, start, end)
+    while header_match:
+        next_pos, next_match = find_txn_header(buf, header_match.end(), end)
+        yield MappedTxnBlock(buf, get_line_offsets(buf, pos, end if next_match is None else next_pos), header_match)
+        pos, header_match = next_pos, next_match
+
+
+def get_chunk_bounds(buf, chunks):
+    """
+    Split buf into at most chunks (start, end) ranges of about the same size, each of them starting at a transaction
+    header (except the first, which starts at 0) so that every transaction falls entirely inside one range.
+    """
+    size = len(buf)
+    offsets = [0]
+    for i in xrange(1, chunks):
+        pos, _ = find_txn_header(buf, max(size * i // chunks, offsets[-1] + 1))
+        if pos == -1:
+            break
+        offsets.append(pos)
+    offsets.append(size)
+    return zip(offsets, offsets[1:])
+
+
+def get_line_offsets(buf, start, end):
+    """Start offsets of the lines in buf[start:end], followed by end"""
+    # One copy of the block, split in C, is much cheaper than a find call per line
+    offsets = [start]
+    pos = start
+    for line in buf[start:end - 1].split('\n'):
+        pos += len(line) + 1
+        offsets.append(pos)
+    offsets[-1] = end
+    return offsets
+
+
+class DayIndex(object):
+    """
+    Where the lines and transactions of a day file start, saved next to it as <DAY FILE>.idx so that parsing it again
+    while it's unchanged skips looking for them. line_offsets holds the start of every line from the first transaction
+    header on, followed by the end of the file; txn_lines holds the line number of every header, followed by the number
+    of lines. Both are packed arrays, of 4 byte ints for files under 4GB, transaction i being lines txn_lines[i] up to
+    txn_lines[i + 1].
+    """
+    HEADER = struct.Struct('=6sBcqdqq')
+    MAGIC = 'CHVIDX'
+
+    def __init__(self, typecode='I'):
+        self.typecode = typecode
+        self.line_offsets = array(typecode)
+        self.txn_lines = array(typecode)
+
+    def __len__(self):
+        return len(self.txn_lines) - 1
+
+    def add_block(self, block):
+        """Add the next block of the file while the index is being built"""
+        self.txn_lines.append(len(self.line_offsets))
+        self.line_offsets.extend(block.line_offsets[:-1])
+
+    def finish(self, end):
+        """"""
+        self.txn_lines.append(len(self.line_offsets))
+        self.line_offsets.append(end)
+
+    def get_block_line_offsets(self, i):
+        """Line offsets of transaction i, followed by its end"""
+        return self.line_offsets[self.txn_lines[i]:self.txn_lines[i + 1] + 1]
+
+    def iter_blocks(self, buf, first=0, last=None):
+        """iter_mapped_txn_blocks without searching buf, of transactions first up to last"""
+        for i in xrange(first, len(self) if last is None else last):
+            line_offsets = self.get_block_line_offsets(i)
+            yield MappedTxnBlock(buf, line_offsets, FINALIZED_TRANSACTION_REGEX.match(buf, line_offsets[0], line_offsets[1]))
+
+    def close(self):
+        """"""
+        pass
+
+    def save(self, index_path, stat):
+        """Write the index for the day file stat was taken of"""
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, INDEX_VERSION, self.typecode, stat.st_size, stat.st_mtime, len(self.line_offsets), len(self.txn_lines)))
+            self.txn_lines.tofile(f)
+            self.line_offsets.tofile(f)
+        os.rename(tmp_path, index_path)
+
+
+class MappedDayIndex(DayIndex):
+    """A saved DayIndex, mapped read-only. The line offsets of each block are unpacked from the map as it's parsed."""
+    def __init__(self, index_map, typecode, txns):
+        DayIndex.__init__(self, typecode)
+        self.map = index_map
+        self.txns = txns
+        # Native, like the arrays it was written from
+        self.line_pair = struct.Struct('2' + typecode)
+        self.item_size = self.line_offsets.itemsize
+        self.line_offsets_start = self.HEADER.size + txns * self.item_size
+
+    def __len__(self):
+        return self.txns - 1
+
+    def get_block_line_offsets(self, i):
+        """"""
+        first_line, end_line = self.line_pair.unpack_from(self.map, self.HEADER.size + i * self.item_size)
+        return array(self.typecode, self.map[self.line_offsets_start + first_line * self.item_size:self.line_offsets_start + (end_line + 1) * self.item_size])
+
+    def close(self):
+        """"""
+        self.map.close()
+
+
+def load_day_index(index_path, stat):
+    """The DayIndex saved at index_path, mapped, if it was made for the day file as stat describes it, else None"""
+    try:
+        f = open(index_path, 'rb')
+    except IOError:
+        return None
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < DayIndex.HEADER.size:
+            return None
+        index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, typecode, day_size, day_mtime, lines, txns = DayIndex.HEADER.unpack_from(index_map)
+    valid = (magic, version) == (DayIndex.MAGIC, INDEX_VERSION) and typecode in ('I', 'L') and (day_size, day_mtime) == (stat.st_size, stat.st_mtime)
+    if not valid or size != DayIndex.HEADER.size + (lines + txns) * array(typecode).itemsize:
+        index_map.close()
+        return None
+    return MappedDayIndex(index_map, typecode, txns)
+
+
+def iter_indexed_txn_blocks(day_path, buf):
+    """
+    iter_mapped_txn_blocks for a day file mapped into buf, through its DayIndex. An index that's missing or out of date
+    is built while the blocks are found, and saved once the end of the file is reached.
+    """
+    index_path = day_path + INDEX_SUFFIX
+    stat = os.stat(day_path)
+    if stat.st_size != len(buf):
+        # Changed since it was mapped, there's no telling which version an index would describe
+        for block in iter_mapped_txn_blocks(buf):
+            yield block
+        return
+    index = load_day_index(index_path, stat)
+    if index:
+        try:
+            for block in index.iter_blocks(buf):
+                yield block
+        finally:
+            index.close()
+        return
+    index = DayIndex('I' if len(buf) < 1 << 32 else 'L')
+    for block in iter_mapped_txn_blocks(buf):
+        index.add_block(block)
+        yield block
+    index.finish(len(buf))
+    try:
+        index.save(index_path, stat)
+    except (IOError, OSError):
+        # Reports on read-only storage just don't get indexed
+        pass
+
+
+def add_mapped_txn_blocks(parser, buf, start=0, end=None, day_path=None):
+    """
+    Feed parser the transaction blocks of buf[start:end]. With day_path, buf is that whole day file mapped and the
+    blocks are found through its DayIndex.
+    """
+    add_txn_blocks(parser, iter_indexed_txn_blocks(day_path, buf) if day_path else iter_mapped_txn_blocks(buf, start, end))
+
+
+def add_txn_blocks(parser, blocks):
+    """Feed parser blocks, timing how long finding them and parsing them takes"""
+    # Splitting the buffer into blocks is timed as indexing, the rest as parsing
+    index_seconds = parse_seconds = 0.0
+    clock = time.time
+    block_start = clock()
+    for block in blocks:
+        parse_start = clock()
+        index_seconds += parse_start - block_start
+        parser.add_txn_block(block)
+        block_start = clock()
+        parse_seconds += block_start - parse_start
+    index_seconds += clock() - block_start
+    parser.stats.add_seconds('index', index_seconds)
+    parser.stats.add_seconds('parse', parse_seconds)
+
+
+def get_gas_transactions_from_buffer(buf, stats=None, parser=None, day_path=None):
+    """With day_path, buf has to be that day file, mapped with open_day_buffer, and its sidecar DayIndex is used"""
+    parser = parser or DayParser(stats)
+    add_mapped_txn_blocks(parser, buf, day_path=day_path if isinstance(buf, mmap.mmap) else None)
+    return parser.close()
+
+
+def record_txn_blocks(blocks, index):
+    """Yield blocks, adding each one to index on the way"""
+    for block in blocks:
+        index.add_block(block)
+        yield block
+
+
+def parse_day_chunk(chunk):
+    """
+    Pool worker body: (gas txns, carwash txns, counts, seconds, index part) of a ChunkParser over one range of a day
+    file. chunk is (day file, start, end, data, txns, typecode): data is the range's text for day files that can't be
+    mapped, or None. txns is the (first, last) transaction numbers of the range in the day file's DayIndex, its blocks
+    are then taken from there instead of searching for them. With a typecode, the range's blocks are recorded into a
+    DayIndex of that typecode, returned as its (txn_lines, line_offsets) arrays for get_gas_transactions_in_chunks to
+    put together and save, else the index part is None.
+    """
+    day_path, start, end, data, txns, typecode = chunk
+    parser = ChunkParser(ParseStats(day_path))
+    part = DayIndex(typecode) if typecode else None
+    if data is not None:
+        add_mapped_txn_blocks(parser, data)
+    else:
+        with open_day_buffer(day_path) as buf:
+            index = load_day_index(day_path + INDEX_SUFFIX, os.stat(day_path)) if txns else None
+            if index is not None:
+                try:
+                    add_txn_blocks(parser, index.iter_blocks(buf, *txns))
+                finally:
+                    index.close()
+            else:
+                # Without an index, or if the day file changed since the parent mapped it, the range is searched
+                blocks = iter_mapped_txn_blocks(buf, start, end)
+                add_txn_blocks(parser, blocks if part is None else record_txn_blocks(blocks, part))
+    return parser.gas_txns, parser.carwash_txns, parser.stats.counts, parser.stats.seconds, None if part is None else (part.txn_lines, part.line_offsets)
+
+
+def get_indexed_chunks(day_path, index, chunks):
+    """parse_day_chunk arguments splitting the transactions of a day file's DayIndex into at most chunks runs"""
+    txns = len(index)
+    bounds = sorted(set(txns * i // chunks for i in xrange(chunks + 1)))
+    return [(day_path, index.get_block_line_offsets(first)[0], index.get_block_line_offsets(last - 1)[-1], None, (first, last), None) for first, last in zip(bounds, bounds[1:])]
+
+
+def get_gas_transactions_in_chunks(day_path, buf, workers, stats=None, parser=None, use_index=False):
+    """
+    get_gas_transactions_from_buffer for one large day file, with its transaction blocks parsed in chunks across a
+    pool of workers. Every chunk is a run of whole blocks, so no scan ever reads another worker's lines. Mapped files
+    are mapped again by each worker, only the offsets of its chunk are sent. Prepays are paired with their finalizations
+    afterwards, as the chunks are merged in file order, so the result is the same as parsing the file in one go.
+    With use_index, chunks are split at transactions of the day file's DayIndex and the workers take their blocks from
+    it; if there's no index yet, each worker records the blocks of its chunk and the parts are saved as one.
+    """
+    parser = parser or DayParser(stats)
+    mapped = isinstance(buf, mmap.mmap)
+    index = typecode = stat = None
+    if use_index and mapped:
+        stat = os.stat(day_path)
+        # Changed since it was mapped, there's no telling which version an index would describe
+        if stat.st_size == len(buf):
+            index = load_day_index(day_path + INDEX_SUFFIX, stat)
+            typecode = None if index is not None else 'I' if len(buf) < 1 << 32 else 'L'
+    chunks = None
+    if index is not None:
+        try:
+            chunks = get_indexed_chunks(day_path, index, workers * CHUNKS_PER_WORKER)
+        finally:
+            index.close()
+    if not chunks:
+        chunks = [(day_path, start, end, None if mapped else buf[start:end], None, typecode) for start, end in get_chunk_bounds(buf, workers * CHUNKS_PER_WORKER)]
+    built = DayIndex(typecode) if typecode else None
+    pool = multiprocessing.Pool(min(workers, len(chunks)))
+    try:
+        for gas_txns, carwash_txns, counts, seconds, part in pool.imap(parse_day_chunk, chunks):
+            if built is not None:
+                txn_lines, line_offsets = part
+                built.txn_lines.extend(array(typecode, [t + len(built.line_offsets) for t in txn_lines]))
+                built.line_offsets.extend(line_offsets)
+            start = time.time()
+            parser.add_chunk(gas_txns, carwash_txns, counts)
+            parser.stats.add_seconds('merge', time.time() - start)
+            # Summed over the workers, so these are CPU seconds rather than wall time
+            for stage, stage_seconds in seconds.items():
+                parser.stats.add_seconds(stage, stage_seconds)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    if built is not None:
+        built.finish(len(buf))
+        try:
+            built.save(day_path + INDEX_SUFFIX, stat)
+        except (IOError, OSError):
+            # Reports on read-only storage just don't get indexed
+            pass
+    return parser.close()
+
+
+@contextlib.contextmanager
+def open_day_buffer(day_path):
+    """
+    Map a day file read-only. Empty files can't be mapped, they give an empty string instead, and so do compressed
+    day files, which are decompressed into one.
+    """
+    if is_compressed_day_file(day_path):
+        yield read_day_data(day_path)
+        return
+    with open(day_path, 'rb') as day:
+        if not os.fstat(day.fileno()).st_size:
+            yield ''
+            return
+        buf = mmap.mmap(day.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+
+def get_gas_transactions_for_day(day_path, use_index=False):
+    """
+    Parse a day file through a read-only memory map, so the report is never decoded line by line and the pages are
+    shared with any other process reading the same file. Use get_gas_transactions_from_lines for streams. With
+    use_index, the file's sidecar DayIndex is used, or made.
+    """
+    with open_day_buffer(day_path) as buf:
+        return get_gas_transactions_from_buffer(buf, day_path=day_path if use_index else None)
+
+
+def get_column_letter(col):
+    """"""
+    quot, rem = divmod(col-1, 26)
+    return((chr(quot-1 + ord("A")) if quot else "") +
+           chr(rem + ord("A")))
+
+
+def get_column_letter_for_column_number(row, col):
+    """
+    """
+    return get_column_letter(col) + str(row)
+
+
+def get_worksheet_title(month_dir):
+    """"""
+    return datetime.strptime(get_month_name(month_dir), '%Y%m').strftime('%B %Y')
+
+
+def get_label_cell_style():
+    """Bold and shaded. openpyxl is only imported by the functions that write workbooks, it's most of the startup time"""
+    global LABEL_CELL_STYLE
+    if LABEL_CELL_STYLE is None:
+        from openpyxl.styles import Font, PatternFill, Style, Color
+        LABEL_CELL_STYLE = Style(font=Font(bold=True), fill=PatternFill(fill_type='solid', start_color=Color('00EEEEEE')))
+    return LABEL_CELL_STYLE
+
+
+def create_workbook(write_only=False):
+    """"""
+    from openpyxl import Workbook
+    return Workbook(write_only=write_only)
+
+
+def add_day_column_to_worksheet(ws, index, date, values):
+    """Write one day's label and cell values into column index"""
+    add_column_to_worksheet(ws, index, date.strftime('%m/%d'), values)
+
+
+def add_column_to_worksheet(ws, index, label, values):
+    """"""
+    column = get_column_letter(index)
+    label_cell = ws.cell('{0}1'.format(column))
+    label_cell.style = get_label_cell_style()
+    label_cell.value = label
+    for row_index, value in enumerate(values, 2):
+        ws.cell('{0}{1}'.format(column, row_index)).value = value
+
+
+def initialize_worksheet(ws, volume_buckets=None):
+    """"""
+    index = 2
+    for i, label in enumerate(get_gas_cell_labels(volume_buckets)):
+        label_cell = ws.cell('A{0}'.format(i + index))
+        label_cell.value = label
+        label_cell.style = get_label_cell_style()
+    return ws
+
+
+def get_rollup_labels(volume_buckets=None):
+    """"""
+    return get_gas_cell_labels(volume_buckets) + ['Days']
+
+
+def get_rollup_columns(manifest, period):
+    """(heading, values and day count) of every rollup of a period, in date order"""
+    rollups = manifest.rollups.get(period, {})
+    return [(get_period_label(key, period), rollups[key]['values'] + [rollups[key]['days']]) for key in sorted(rollups)]
+
+
+def update_rollup_sheets(wb, manifest, volume_buckets, rollups_changed):
+    """Rewrite the Weekly, Monthly, Quarterly and Yearly sheets if the rollups changed or a sheet is missing"""
+    updated = False
+    labels = get_rollup_labels(volume_buckets)
+    for period in ROLLUP_PERIODS:
+        ws = wb.get_sheet_by_name(ROLLUP_SHEET_TITLES[period])
+        if ws is not None and not rollups_changed:
+            continue
+        if ws is None:
+            ws = wb.create_sheet(title=ROLLUP_SHEET_TITLES[period])
+        for i, label in enumerate(labels, 2):
+            label_cell = ws.cell('A{0}'.format(i))
+            label_cell.value = label
+            label_cell.style = get_label_cell_style()
+        columns = get_rollup_columns(manifest, period)
+        for i, (heading, values) in enumerate(columns, 2):
+            add_column_to_worksheet(ws, i, heading, values)
+        # Periods can disappear when day files are removed
+        for column in xrange(len(columns) + 2, ws.get_highest_column() + 1):
+            for row in xrange(1, len(labels) + 2):
+                ws.cell(get_column_letter_for_column_number(row, column)).value = None
+        updated = True
+    return updated
+
+
+def get_rollup_sheet_index(wb):
+    """Index of the first rollup sheet, where new month sheets go to keep the rollups last, None if there isn't one"""
+    rollup_titles = set(ROLLUP_SHEET_TITLES.values())
+    for i, title in enumerate(wb.get_sheet_names()):
+        if title in rollup_titles:
+            return i
+    return None
+
+
+def append_rollup_sheets(wb, manifest, volume_buckets):
+    """Add the rollup sheets to a write-only workbook"""
+    for period in ROLLUP_PERIODS:
+        ws = wb.create_sheet(title=ROLLUP_SHEET_TITLES[period])
+        columns = get_rollup_columns(manifest, period)
+        ws.append([None] + [get_label_cell(ws, heading) for heading, _ in columns])
+        for row_index, label in enumerate(get_rollup_labels(volume_buckets)):
+            ws.append([get_label_cell(ws, label)] + [values[row_index] for _, values in columns])
+
+
+def get_label_cell(ws, value):
+    """A bold, shaded cell for appending to a write-only sheet"""
+    from openpyxl.writer.dump_worksheet import WriteOnlyCell
+    cell = WriteOnlyCell(ws, value=value)
+    cell.style = get_label_cell_style()
+    return cell
+
+
+def write_workbook_streaming(excel_workbook_path, manifest, volume_buckets, rollups=False):
+    """
+    Build the whole workbook from the values cached in the manifest with openpyxl's write-only mode. The old
+    workbook is never loaded and rows go straight to disk as they are appended, so this stays quick and small however
+    many months of history there are. Sheets that didn't come from this script are not carried over.
+    """
+    wb = create_workbook(write_only=True)
+    for month_dir, day_files in manifest.get_months():
+        append_month_sheet(wb, month_dir, day_files, manifest, volume_buckets)
+    if rollups:
+        append_rollup_sheets(wb, manifest, volume_buckets)
+    wb.save(excel_workbook_path)
+
+
+def append_month_sheet(wb, month_dir, day_files, manifest, volume_buckets):
+    """Add a month's sheet to a write-only workbook, sheets have to be appended in month order"""
+    ws = wb.create_sheet(title=get_worksheet_title(month_dir))
+    ws.append([None] + [get_label_cell(ws, get_date_for_day_file(df).strftime('%m/%d')) for df in day_files])
+    columns = [manifest.get_values(df) for df in day_files]
+    for row_index, label in enumerate(get_gas_cell_labels(volume_buckets)):
+        ws.append([get_label_cell(ws, label)] + [values[row_index] for values in columns])
+    for i, df in enumerate(day_files):
+        manifest.days[df]['column'] = i+2
+
+
+def get_month_directories(months_directory_path):
+    """
+    Absolute paths of the month directories, in month order. YYYYMM.zip, .tar.gz, .tgz and .tar month archives count
+    as month directories too, unless the month has also been extracted next to them.
+    """
+    names = os.listdir(months_directory_path)
+    month_dirs = [p for p in names if isdir(os.path.join(months_directory_path, p))]
+    extracted = set(month_dirs)
+    month_dirs += [p for p in names if get_archive_suffix(p) and re.match(r'[0-9]{6}$', get_month_name(p)) and get_month_name(p) not in extracted and os.path.isfile(os.path.join(months_directory_path, p))]
+    return sorted((os.path.abspath(os.path.join(months_directory_path, p)) for p in month_dirs), key=get_month_name)
+
+
+def get_month_name(month_dir):
+    """YYYYMM of a month directory or archive"""
+    name = os.path.basename(month_dir)
+    suffix = get_archive_suffix(name)
+    return name[:-len(suffix)] if suffix else name
+
+
+def get_archive_suffix(path):
+    """"""
+    for suffix in MONTH_ARCHIVE_SUFFIXES:
+        if path.endswith(suffix):
+            return suffix
+    return None
+
+
+def is_day_file_name(name):
+    """"""
+    return os.path.splitext(name)[1] == '.txt' or name.endswith(GZIP_DAY_FILE_SUFFIX)
+
+
+def get_day_files(month_dir):
+    """
+    Day report files in a month directory, in date order. The day files of a month archive get paths as if the
+    archive were a directory, month_dir/YYYYMMDD.txt, wherever they sit inside it.
+    """
+    if not isdir(month_dir):
+        return sorted(os.path.join(month_dir, name) for name in get_archive_members(month_dir))
+    names = set(os.listdir(month_dir))
+    # A day that is there both plain and gzipped is read from the plain file
+    return sorted(os.path.join(month_dir, p) for p in names if is_day_file_name(p) and not (p.endswith('.gz') and p[:-len('.gz')] in names))
+
+
+ArchiveMemberStat = namedtuple('ArchiveMemberStat', 'st_size st_mtime')
+ARCHIVE_MEMBERS = {}
+
+
+def get_archive_members(archive_path):
+    """
+    {day file name: (member name, ArchiveMemberStat)} of the day reports in a month archive. Listing a compressed tar
+    means reading all of it, so listings are kept until the archive changes.
+    """
+    stat = os.stat(archive_path)
+    key = (archive_path, stat.st_size, stat.st_mtime)
+    if key not in ARCHIVE_MEMBERS:
+        members = {}
+        if archive_path.endswith('.zip'):
+            with contextlib.closing(zipfile.ZipFile(archive_path)) as zf:
+                for info in zf.infolist():
+                    name = os.path.basename(info.filename)
+                    if is_day_file_name(name):
+                        members[name] = (info.filename, ArchiveMemberStat(info.file_size, time.mktime(info.date_time + (0, 0, -1))))
+        else:
+            with contextlib.closing(tarfile.open(archive_path)) as tf:
+                for info in tf:
+                    name = os.path.basename(info.name)
+                    if info.isfile() and is_day_file_name(name):
+                        members[name] = (info.name, ArchiveMemberStat(info.size, info.mtime))
+        ARCHIVE_MEMBERS[key] = members
+    return ARCHIVE_MEMBERS[key]
+
+
+def split_archive_path(day_path):
+    """(month archive, day file name) for a day file inside a month archive, (None, None) for any other"""
+    month_dir, name = os.path.split(day_path)
+    if get_archive_suffix(month_dir) and os.path.isfile(month_dir):
+        return month_dir, name
+    return None, None
+
+
+def is_compressed_day_file(day_path):
+    """"""
+    return day_path.endswith('.gz') or split_archive_path(day_path)[0] is not None
+
+
+def stat_day_file(day_path):
+    """os.stat of a day file, or size and mtime of a day file inside a month archive"""
+    archive_path, name = split_archive_path(day_path)
+    if archive_path:
+        return get_archive_members(archive_path)[name][1]
+    return os.stat(day_path)
+
+
+def read_day_data(day_path):
+    """The whole text of a day file, decompressed straight out of its month archive or .gz file"""
+    archive_path, name = split_archive_path(day_path)
+    if archive_path is None:
+        with (gzip.open(day_path, 'rb') if day_path.endswith('.gz') else open(day_path, 'rb')) as day:
+            return day.read()
+    member = get_archive_members(archive_path)[name][0]
+    if archive_path.endswith('.zip'):
+        with contextlib.closing(zipfile.ZipFile(archive_path)) as zf:
+            return zf.read(member)
+    with contextlib.closing(tarfile.open(archive_path)) as tf:
+        return tf.extractfile(member).read()
+
+
+def iter_tar_day_data(archive_path, day_files):
+    """
+    (day file, text) for day_files of a tar month archive, in the order given, decompressing the archive only once.
+    Members stored ahead of their turn are held until it comes.
+    """
+    members = get_archive_members(archive_path)
+    # A day file gone from an archive replaced since it was listed is reported once its turn can't come
+    wanted = dict((members[os.path.basename(df)][0], df) for df in day_files if os.path.basename(df) in members)
+    order = iter(day_files)
+    next_file = next(order, None)
+    held = {}
+    with contextlib.closing(tarfile.open(archive_path, 'r|*')) as tf:
+        for info in tf:
+            if info.name not in wanted:
+                continue
+            held[wanted[info.name]] = tf.extractfile(info).read()
+            while next_file in held:
+                yield next_file, held.pop(next_file)
+                next_file = next(order, None)
+    if next_file is not None:
+        raise tarfile.TarError('{0} is no longer in {1}'.format(os.path.basename(next_file), archive_path))
+
+
+def iter_day_data(day_files):
+    """
+    (day file, text or the error reading it) for each of day_files in order. Runs of day files from the same tar
+    month archive are read in a single pass over it.
+    """
+    i = 0
+    while i < len(day_files):
+        archive_path, _ = split_archive_path(day_files[i])
+        if archive_path and not archive_path.endswith('.zip'):
+            run = [day_files[i]]
+            while i + len(run) < len(day_files) and split_archive_path(day_files[i + len(run)])[0] == archive_path:
+                run.append(day_files[i + len(run)])
+            done = 0
+            try:
+                for df, data in iter_tar_day_data(archive_path, run):
+                    yield df, data
+                    done += 1
+            except (EnvironmentError, tarfile.TarError) as e:
+                # Whichever file was due next gets the error, nothing after it can be read
+                yield run[done], e
+                return
+            i += len(run)
+            continue
+        try:
+            data = read_day_data(day_files[i])
+        except EnvironmentError as e:
+            data = e
+        yield day_files[i], data
+        i += 1
+
+
+def get_date_for_day_file(day_path):
+    """"""
+    return datetime.strptime(str(day_path).split('/')[-1].split('.txt')[0], '%Y%m%d')
+
+
+def analyze_day_file(day_path, volume_buckets=None, workers=1, use_index=False):
+    """
+    Parse and count a single day file. This is what pool workers run, so only the date, the column values, the
+    sha1 of the file, its ParseStats record, the leftovers for PrepayReconciler and the pack_txn_keys of its
+    transactions are sent back to the parent, never the transactions themselves. With workers > 1 the file's transaction blocks are parsed in chunks across that
+    many processes. With use_index, the file's sidecar DayIndex is used, or made.
+    """
+    with open_day_buffer(day_path) as buf:
+        return analyze_day_buffer(day_path, buf, volume_buckets, workers, use_index)
+
+
+def analyze_day_buffer(day_path, buf, volume_buckets=None, workers=1, use_index=False):
+    """analyze_day_file for a day file that is already mapped or read into buf"""
+    stats = ParseStats(day_path)
+    parser = DayParser(stats)
+    sha1 = hashlib.sha1(buf).hexdigest()
+    if workers > 1:
+        gas_txns, carwash_txns = get_gas_transactions_in_chunks(day_path, buf, workers, parser=parser, use_index=use_index)
+    else:
+        gas_txns, carwash_txns = get_gas_transactions_from_buffer(buf, parser=parser, day_path=day_path if use_index else None)
+    date_obj = get_date_for_day_file(day_path)
+    start = time.time()
+    values = DayAnalyzer(gas_txns, date_obj, None, carwash_txns, volume_buckets).get_cell_values()
+    stats.add_seconds('aggregate', time.time() - start)
+    return date_obj, values, sha1, stats.as_record(), parser.get_leftovers(), get_day_txn_keys(gas_txns, carwash_txns)
+
+
+def map_day_files(func, day_files, workers):
+    """
+    Yield func(day_file) in the order of day_files, fanning the work out to a process pool if workers > 1. day_files
+    can be any iterable, the pipeline feeds it from a generator so that it's only read as fast as it's parsed.
+    """
+    # A pool for a single file is all startup and no speedup, only a list or tuple can tell that up front
+    if workers <= 1 or (isinstance(day_files, (list, tuple)) and len(day_files) < 2):
+        for df in day_files:
+            yield func(df)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(func, day_files):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def is_tar_day_file(day_path):
+    """"""
+    archive_path, _ = split_archive_path(day_path)
+    return archive_path is not None and not archive_path.endswith('.zip')
+
+
+def analyze_day_files(day_files, workers, volume_buckets=None, split_size=None, use_index=False):
+    """
+    Yield analyze_day_file of each day file in order. Day files of split_size bytes or more are parsed one at a time,
+    with their transaction blocks spread over the workers, the rest a whole file per worker. A tar can only be read
+    from the start, so runs of day files from the same tar month archive are decompressed in one pass by this
+    process and their text is sent to the workers, at most a couple per worker at a time.
+    """
+    analyze = functools.partial(analyze_day_file, volume_buckets=volume_buckets, use_index=use_index)
+    is_large = lambda df: bool(split_size) and workers > 1 and stat_day_file(df).st_size >= split_size
+    for (split, in_tar), group in itertools.groupby(day_files, lambda df: (is_large(df), is_tar_day_file(df))):
+        group = list(group)
+        if split and in_tar:
+            for df, data in iter_day_data(group):
+                if isinstance(data, Exception):
+                    raise data
+                yield analyze_day_buffer(df, data, volume_buckets, workers)
+        elif split:
+            for df in group:
+                yield analyze_day_file(df, volume_buckets, workers, use_index)
+        elif in_tar:
+            slots = threading.Semaphore(max(workers, 1) * 2)
+            results = map_day_files(functools.partial(analyze_prefetched_day, volume_buckets=volume_buckets), iter_with_slots(iter_day_data(group), slots), workers)
+            try:
+                for result in results:
+                    slots.release()
+                    yield result
+            except BaseException:
+                # Unblock the pool's feeder so the pool can be torn down
+                for _ in xrange(len(group) + 1):
+                    slots.release()
+                raise
+        else:
+            for result in map_day_files(analyze, group, workers):
+                yield result
+
+
+def analyze_prefetched_day(item, volume_buckets=None):
+    """Pool worker body for the pipeline: item is (day file, its contents or the error reading it)"""
+    day_path, data = item
+    if isinstance(data, Exception):
+        raise data
+    return analyze_day_buffer(day_path, data, volume_buckets)
+
+
+def read_day_files(day_files, queue):
+    """
+    Reader thread body: read day files in order into queue, followed by None. The queue is bounded, so reading stays
+    only a few files ahead of the parsers while they work.
+    """
+    for item in iter_day_data(day_files):
+        queue.put(item)
+    queue.put(None)
+
+
+def iter_prefetched(queue, slots):
+    """
+    The reader's day files as they arrive. Each one takes a slot that the consumer gives back once the file's result
+    is in, otherwise Pool.imap would pull every file into memory up front.
+    """
+    while True:
+        slots.acquire()
+        item = queue.get()
+        if item is None:
+            return
+        yield item
+
+
+def iter_with_slots(items, slots):
+    """items, each taking a slot before it's read, see iter_prefetched"""
+    items = iter(items)
+    while True:
+        slots.acquire()
+        item = next(items, None)
+        if item is None:
+            return
+        yield item
+
+
+ParsedDay = namedtuple('ParsedDay', 'path date gas_txns carwash_txns leftovers stats')
+
+
+def parse_day(day_path, use_index=False):
+    """
+    Parse one day file, plain, gzipped or in a month archive, into a ParsedDay. Finalizations of prepays rung up in
+    an earlier day file aren't in gas_txns but in leftovers, iter_days matches them across files.
+    """
+    stats = ParseStats(day_path)
+    parser = DayParser(stats)
+    with open_day_buffer(day_path) as buf:
+        gas_txns, carwash_txns = get_gas_transactions_from_buffer(buf, parser=parser, day_path=day_path if use_index else None)
+    return ParsedDay(day_path, get_date_for_day_file(day_path), gas_txns, carwash_txns, parser.get_leftovers(), stats.as_record())
+
+
+def get_day_paths(paths):
+    """The day files of paths, each of them a day file, a month directory or archive, or a directory of months"""
+    day_paths = []
+    for path in paths:
+        if isdir(path) and get_month_directories(path):
+            day_paths += [df for d in get_month_directories(path) for df in get_day_files(d)]
+        elif isdir(path) or get_archive_suffix(path):
+            day_paths += get_day_files(path)
+        else:
+            day_paths.append(path)
+    return day_paths
+
+
+def iter_days(paths, workers=1, prepay_ttl=PREPAY_TTL_HOURS, use_index=False, keep_duplicates=False):
+    """
+    Yield a ParsedDay for each day file of paths (see get_day_paths), in the order given. A prepay finalized in a later
+    day file is added to that day's gas_txns, the day the workbook counts it on; prepays never finalized are dropped.
+    Unless keep_duplicates, a transaction already yielded (same id, date and time) is dropped, see DuplicateFilter.
+    """
+    reconciler = PrepayReconciler(prepay_ttl)
+    duplicates = None if keep_duplicates else DuplicateFilter()
+    for day in map_day_files(functools.partial(parse_day, use_index=use_index), get_day_paths(paths), workers):
+        recovered, evicted, missing = reconciler.add_day(day.date, day.leftovers)
+        for prepay in evicted:
+            print '\tUnmatched prepay: {0}'.format(prepay.reference_num)
+        for final_txn in missing:
+            print '\tMissing txn number: {0}'.format(final_txn.reference_num)
+        if recovered:
+            day = day._replace(gas_txns=day.gas_txns + recovered)
+        if duplicates is not None:
+            (gas_txns, dropped_gas), (carwash_txns, dropped_carwash) = duplicates.filter(day.gas_txns), duplicates.filter(day.carwash_txns)
+            for txn in dropped_gas + dropped_carwash:
+                print '\tDuplicate txn: {0} at {1} {2} in {3}'.format(txn.id, txn.date, txn.time, day.path)
+            if dropped_gas or dropped_carwash:
+                day = day._replace(gas_txns=gas_txns, carwash_txns=carwash_txns)
+        yield day
+
+
+def iter_transactions(paths, workers=1, prepay_ttl=PREPAY_TTL_HOURS, use_index=False, keep_duplicates=False):
+    """Yield every GasTxn and CarWashTxn of the day files of paths, a day at a time, see iter_days"""
+    for day in iter_days(paths, workers, prepay_ttl, use_index, keep_duplicates):
+        for txn in day.gas_txns:
+            yield txn
+        for txn in day.carwash_txns:
+            yield txn
+
+
+def aggregate(txns, volume_buckets=None, sources=()):
+    """Count any mix of GasTxns and CarWashTxns the way a workbook column is counted, into a PartialAggregate"""
+    gas_txns, carwash_txns = [], []
+    for txn in txns:
+        (gas_txns if isinstance(txn, GasTxn) else carwash_txns).append(txn)
+    return DayAnalyzer(gas_txns, None, None, carwash_txns, volume_buckets).get_partial(sources)
+
+
+def get_group(date_obj, by):
+    """"""
+    return {'day': date_obj.strftime('%Y-%m-%d'), 'month': date_obj.strftime('%Y-%m'), 'total': 'total'}[by]
+
+
+def parse_volume_bucket_edges(value):
+    """"""
+    try:
+        edges = [float(e) for e in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid bucket edges: {0}'.format(value))
+    if len(set(edges)) != len(edges):
+        raise argparse.ArgumentTypeError('duplicate bucket edges: {0}'.format(value))
+    return edges
+
+
+def parse_args(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Count gas and carwash sales in Blue Cube day reports.')
+    arg_parser.add_argument('months_directory_path', nargs='?', default='./')
+    arg_parser.add_argument('excel_workbook_path', nargs='?', default='./results.xlsx')
+    arg_parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of day files to parse in parallel (default: number of cores)')
+    arg_parser.add_argument('--manifest', metavar='PATH', help='where to keep track of ingested day files (default: the workbook path + {0})'.format(MANIFEST_SUFFIX))
+    arg_parser.add_argument('--write-only', action='store_true', help='rebuild the whole workbook from the manifest in streaming mode instead of loading it and patching changed columns')
+    arg_parser.add_argument('--stats', metavar='PATH', help='write JSON records of per-file counters and stage timings to PATH, - for stderr')
+    arg_parser.add_argument('--profile', metavar='PATH', help='run under cProfile and dump the stats to PATH (only the main process is profiled, combine with --workers 1)')
+    arg_parser.add_argument('--volume-buckets', type=parse_volume_bucket_edges, default=VOLUME_BUCKET_EDGES, metavar='EDGES', help='comma separated gallon edges of the volume rows (default: 5,10,14,19)')
+    arg_parser.add_argument('--rollups', action='store_true', help='also write Weekly, Monthly, Quarterly and Yearly summary sheets')
+    arg_parser.add_argument('--pipeline', action='store_true', help='overlap reading, parsing and writing the workbook, for reports on slow or network storage')
+    arg_parser.add_argument('--prefetch', type=int, default=PREFETCH_FILES, metavar='N', help='with --pipeline, how many day files to read ahead of the parsers (default: {0})'.format(PREFETCH_FILES))
+    arg_parser.add_argument('--split-size', type=float, default=SPLIT_DAY_FILE_MB, metavar='MB', help='parse day files of at least this many megabytes in chunks across the workers instead of a file per worker (default: {0}, 0 never to split, ignored with --pipeline)'.format(SPLIT_DAY_FILE_MB))
+    arg_parser.add_argument('--index', action='store_true', help='keep a {0} file next to each day file with where its lines and transactions start, so parsing it again skips finding them (ignored with --pipeline)'.format(INDEX_SUFFIX))
+    arg_parser.add_argument('--prepay-ttl', type=float, default=PREPAY_TTL_HOURS, metavar='HOURS', help='how long a prepay can wait for its finalization in a later day file (default: {0}, 0 to match prepays within a day file only)'.format(PREPAY_TTL_HOURS))
+    arg_parser.add_argument('--keep-duplicates', action='store_true', help='count transactions whose id, date and time were already counted in an earlier day file again, like those of a day exported twice')
+    return arg_parser.parse_args(args[1:])
+
+
+def parse_command_args(command, args):
+    """Options of the parse and aggregate commands"""
+    descriptions = {'parse': 'Print every transaction in Blue Cube day reports as a JSON line.', 'aggregate': 'Print the workbook counts, gallons and revenue of Blue Cube day reports as JSON lines.'}
+    arg_parser = argparse.ArgumentParser(prog='{0} {1}'.format(os.path.basename(args[0]), command), description=descriptions[command])
+    arg_parser.add_argument('paths', nargs='+', metavar='PATH', help='day files, month directories or archives, or directories of months')
+    arg_parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of day files to parse in parallel (default: number of cores)')
+    arg_parser.add_argument('--index', action='store_true', help='keep a {0} file next to each day file, see export-xlsx --index'.format(INDEX_SUFFIX))
+    arg_parser.add_argument('--prepay-ttl', type=float, default=PREPAY_TTL_HOURS, metavar='HOURS', help='how long a prepay can wait for its finalization in a later day file (default: {0})'.format(PREPAY_TTL_HOURS))
+    arg_parser.add_argument('--keep-duplicates', action='store_true', help='keep transactions whose id, date and time were already seen, like those of a day exported twice')
+    if command == 'aggregate':
+        arg_parser.add_argument('--by', choices=GROUPINGS, default='day')
+        arg_parser.add_argument('--volume-buckets', type=parse_volume_bucket_edges, default=VOLUME_BUCKET_EDGES, metavar='EDGES', help='comma separated gallon edges of the volume rows (default: 5,10,14,19)')
+    return arg_parser.parse_args(args[1:])
+
+
+def print_transactions(opts, out):
+    """The parse command"""
+    for day in iter_days(opts.paths, opts.workers, opts.prepay_ttl, opts.index, opts.keep_duplicates):
+        day_name = day.date.strftime('%Y-%m-%d')
+        for kind, txns in (('gas', day.gas_txns), ('carwash', day.carwash_txns)):
+            for txn in txns:
+                out.write(json.dumps(dict(txn_to_record(txn), day=day_name, kind=kind), sort_keys=True) + '\n')
+
+
+def print_aggregates(opts, out):
+    """The aggregate command: one line per day, month or for everything, in date order"""
+    volume_buckets = VolumeBuckets(opts.volume_buckets)
+    labels = get_gas_cell_labels(volume_buckets)
+    groups = OrderedDict()
+    for day in iter_days(opts.paths, opts.workers, opts.prepay_ttl, opts.index, opts.keep_duplicates):
+        partial = aggregate(day.gas_txns + day.carwash_txns, volume_buckets, [day.path])
+        group = get_group(day.date, opts.by)
+        groups[group] = groups[group].merge(partial) if group in groups else partial
+    for group, partial in groups.items():
+        out.write(json.dumps(OrderedDict([(opts.by, group), ('counts', OrderedDict(zip(labels, partial.values))), ('gallons', round(partial.volume, 3)), ('revenue', round(partial.revenue, 2))])) + '\n')
+
+
+def run_command(command, args):
+    """parse and aggregate, which never import openpyxl. Anything printed while parsing goes to stderr, stdout is JSON"""
+    opts = parse_command_args(command, args)
+    out, sys.stdout = sys.stdout, sys.stderr
+    try:
+        if command == 'parse':
+            print_transactions(opts, out)
+        else:
+            print_aggregates(opts, out)
+    finally:
+        sys.stdout = out
+
+
+def update_month_worksheet(wb, month_dir, day_files, manifest, volume_buckets, removed_columns=()):
+    """
+    Bring a month's sheet in line with the manifest: write the day columns that are new, changed or have moved, and
+    blank out columns left over from removed day files. Returns True if the sheet was touched.
+    """
+    ws_title = get_worksheet_title(month_dir)
+    ws = wb.get_sheet_by_name(ws_title)
+    if ws is None:
+        ws = initialize_worksheet(wb.create_sheet(get_rollup_sheet_index(wb), ws_title), volume_buckets)
+        # Whatever the manifest says, nothing has been written to this sheet yet
+        for df in day_files:
+            manifest.days[df]['column'] = None
+    updated = False
+    for i, df in enumerate(day_files):
+        entry = manifest.days[df]
+        if entry['column'] != i+2:
+            date_obj = get_date_for_day_file(df)
+            print 'adding gas txns for {0}'.format(date_obj)
+            add_day_column_to_worksheet(ws, i+2, date_obj, manifest.get_values(df))
+            entry['column'] = i+2
+            updated = True
+    # Removing a day file shifts the later days left, so everything from past the new last day to the old last column
+    # is left over, not just the removed day's own column
+    for column in xrange(len(day_files) + 2, max([ws.get_highest_column()] + [c for c in removed_columns if c]) + 1):
+        for row in xrange(1, len(get_gas_cell_labels(volume_buckets)) + 2):
+            cell = ws.cell(get_column_letter_for_column_number(row, column))
+            if cell.value is not None:
+                cell.value = None
+                updated = True
+    if updated:
+        initialize_worksheet(ws, volume_buckets)
+    return updated
+
+
+class RunStats(object):
+    """
+    Wall time per stage of a run, plus the ParseStats of every parsed day file. Each file's record is written out as a
+    JSON line as it arrives and a summary record with the totals at the end. file_seconds are summed over the files,
+    which are parsed in parallel, so they can add up to more than the run took.
+    """
+    def __init__(self, out=None):
+        self.out = out
+        self.files = 0
+        self.seconds = {}
+        self.file_seconds = {}
+        self.counts = dict.fromkeys(ParseStats.COUNTERS, 0)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.time() - start
+
+    def add_file(self, record):
+        """"""
+        self.files += 1
+        for counter, count in record['counts'].items():
+            self.counts[counter] += count
+        for stage, seconds in record['seconds'].items():
+            self.file_seconds[stage] = self.file_seconds.get(stage, 0.0) + seconds
+        self.write(dict(record, record='file'))
+
+    def finish(self):
+        """"""
+        self.write({'record': 'run', 'files': self.files, 'counts': self.counts, 'seconds': self.seconds, 'file_seconds': self.file_seconds})
+
+    def write(self, record):
+        """"""
+        if self.out:
+            self.out.write(json.dumps(record, sort_keys=True) + '\n')
+            self.out.flush()
+
+
+def reconcile_prepays(manifest, ttl_hours, parsed_files, run_stats):
+    """
+    Match finalizations to the days before them, with ttl_hours 0 every day stands alone. Each prepay that never got
+    finalized is written to the stats as an unmatched_prepay record, and printed if its day file was parsed this run,
+    and so is each finalization whose prepay was never found, as a missing_finalization record.
+    """
+    reconciler = PrepayReconciler(ttl_hours)
+    unmatched, missing = manifest.reconcile(reconciler)
+    for day_path, prepay in unmatched:
+        report_unmatched_prepay(day_path, prepay, parsed_files, run_stats)
+    for day_path, final_txn in missing:
+        report_missing_finalization(day_path, final_txn, parsed_files, run_stats)
+    run_stats.write(dict(reconciler.counts, record='reconcile'))
+
+
+def drop_duplicate_txns(manifest, keep_duplicates, parsed_files, run_stats):
+    """
+    Take the transactions already counted in an earlier day file out of the later day's column, unless
+    keep_duplicates. How many each day had is written to the stats as a duplicates record, and printed if its day
+    file was parsed this run.
+    """
+    key_index = None if keep_duplicates else TxnKeyIndex()
+    for day_path, count in manifest.drop_duplicates(key_index):
+        report_duplicates(day_path, count, parsed_files, run_stats)
+    if key_index:
+        run_stats.write(dict(key_index.counts, record='dedup'))
+
+
+def report_duplicates(day_path, count, parsed_files, run_stats):
+    """"""
+    if day_path in parsed_files:
+        print '\tDuplicate txns: {0} already in an earlier day file'.format(count)
+    run_stats.write({'record': 'duplicates', 'path': day_path, 'count': count})
+
+
+def report_unmatched_prepay(day_path, prepay, parsed_files, run_stats):
+    """"""
+    if day_path in parsed_files:
+        print '\tUnmatched prepay: {0}'.format(prepay.reference_num)
+    run_stats.write({'record': 'unmatched_prepay', 'path': day_path, 'reference_num': prepay.reference_num, 'time': prepay.time, 'pump_num': prepay.pump_num, 'amount': prepay.amount})
+
+
+def report_missing_finalization(day_path, final_txn, parsed_files, run_stats):
+    """"""
+    if day_path in parsed_files:
+        print '\tMissing txn number: {0}'.format(final_txn.reference_num)
+    run_stats.write({'record': 'missing_finalization', 'path': day_path, 'reference_num': final_txn.reference_num, 'time': final_txn.time, 'volume': final_txn.volume})
+
+
+def scan_day_files(months_directory_path, manifest):
+    """(month directory, day files) pairs, the stat of every day file, and the new and changed ones, in date order"""
+    month_directories = get_month_directories(months_directory_path)
+    day_files_by_dir = [(d, get_day_files(d)) for d in month_directories]
+    file_stats = dict((df, stat_day_file(df)) for _, day_files in day_files_by_dir for df in day_files)
+    # Only new and changed day files are parsed
+    stale_files = [df for _, day_files in day_files_by_dir for df in day_files if manifest.is_stale(df, file_stats[df])]
+    return day_files_by_dir, file_stats, stale_files
+
+
+def load_or_create_workbook(excel_workbook_path):
+    """"""
+    from openpyxl import load_workbook
+    from openpyxl.exceptions import InvalidFileException
+    try:
+        return load_workbook(excel_workbook_path)
+    except InvalidFileException:
+        return create_workbook()
+
+
+class WorkbookWriter(threading.Thread):
+    """
+    Pipeline stage that owns the workbook: openpyxl isn't thread safe, so this is the only thread that touches it.
+    It loads (or, write-only, creates) the workbook while the first day files are still being parsed, writes each
+    month queued by put_month in order and saves at the end. The queue is bounded so finished months don't pile up.
+    """
+    def __init__(self, excel_workbook_path, manifest, volume_buckets, write_only, run_stats, rollups=False, queue_size=2):
+        threading.Thread.__init__(self, name='workbook-writer')
+        self.excel_workbook_path = excel_workbook_path
+        self.manifest = manifest
+        self.volume_buckets = volume_buckets
+        self.write_only = write_only
+        self.run_stats = run_stats
+        self.months = Queue.Queue(queue_size)
+        self.error = None
+        self.aborted = False
+        # Set before finish() when the rollup sheets are written
+        self.rollups = rollups
+        self.rollups_changed = False
+
+    def put_month(self, month_dir, day_files, removed_columns):
+        """Queue a month whose days are all parsed and reconciled, months have to come in order"""
+        self.months.put((month_dir, day_files, removed_columns))
+
+    def finish(self):
+        """Wait for the workbook to be saved, re-raising anything that went wrong writing it"""
+        self.months.put(None)
+        self.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def abort(self):
+        """Stop after the months already queued without saving, the run failed"""
+        self.aborted = True
+        self.months.put(None)
+        self.join()
+
+    def run(self):
+        """"""
+        try:
+            self.write()
+        except Exception:
+            self.error = sys.exc_info()
+            # Keep taking months so the pipeline isn't blocked on a full queue, finish() reports the error
+            for _ in iter(self.months.get, None):
+                pass
+
+    def write(self):
+        """"""
+        stage = self.run_stats.stage
+        if self.write_only:
+            wb = create_workbook(write_only=True)
+        else:
+            with stage('load'):
+                wb = load_or_create_workbook(self.excel_workbook_path)
+        updated = False
+        for month_dir, day_files, removed_columns in iter(self.months.get, None):
+            with stage('workbook'):
+                if self.write_only:
+                    append_month_sheet(wb, month_dir, day_files, self.manifest, self.volume_buckets)
+                else:
+                    updated = update_month_worksheet(wb, month_dir, day_files, self.manifest, self.volume_buckets, removed_columns) or updated
+        if self.aborted:
+            return
+        if self.rollups:
+            with stage('workbook'):
+                if self.write_only:
+                    append_rollup_sheets(wb, self.manifest, self.volume_buckets)
+                else:
+                    updated = update_rollup_sheets(wb, self.manifest, self.volume_buckets, self.rollups_changed) or updated
+        with stage('save'):
+            if self.write_only or updated or not os.path.exists(self.excel_workbook_path):
+                wb.save(self.excel_workbook_path)
+
+
+def run_pipelined(opts, run_stats):
+    """
+    run with every stage overlapped: a reader thread prefetches day files into a bounded queue, the pool parses them,
+    this thread takes the results in date order into the manifest and reconciles each day as it comes, and the
+    WorkbookWriter writes each month as soon as its last day is in. Slow storage is read while the CPUs parse, and at
+    most a few files are in memory at any time.
+    """
+    excel_workbook_path = opts.excel_workbook_path
+    volume_buckets = VolumeBuckets(opts.volume_buckets)
+    manifest = IngestManifest(opts.manifest or excel_workbook_path + MANIFEST_SUFFIX, volume_buckets)
+
+    with run_stats.stage('scan'):
+        day_files_by_dir, file_stats, stale_files = scan_day_files(opts.months_directory_path, manifest)
+        removed_columns = manifest.remove_missing(day_files_by_dir)
+    writer = WorkbookWriter(excel_workbook_path, manifest, volume_buckets, opts.write_only, run_stats, opts.rollups)
+    writer.start()
+    read_queue = Queue.Queue(opts.prefetch)
+    reader = threading.Thread(target=read_day_files, args=(stale_files, read_queue), name='day-file-reader')
+    reader.daemon = True
+    reader.start()
+    slots = threading.Semaphore(max(opts.workers, 1) * 2)
+    results = map_day_files(functools.partial(analyze_prefetched_day, volume_buckets=volume_buckets), iter_prefetched(read_queue, slots), opts.workers)
+    reconciler = PrepayReconciler(opts.prepay_ttl)
+    key_index = None if opts.keep_duplicates else TxnKeyIndex()
+    parsed_files = set(stale_files)
+    try:
+        for d, day_files in day_files_by_dir:
+            for df in day_files:
+                if df in parsed_files:
+                    with run_stats.stage('parse'):
+                        date_obj, values, sha1, stats_record, leftovers, keys = next(results)
+                    slots.release()
+                    manifest.update(df, file_stats[df], sha1, values, leftovers, keys)
+                    run_stats.add_file(stats_record)
+                with run_stats.stage('dedup'):
+                    count = manifest.dedup_day(key_index, df)
+                    if count:
+                        report_duplicates(df, count, parsed_files, run_stats)
+                with run_stats.stage('reconcile'):
+                    evicted, missing = manifest.reconcile_day(reconciler, df)
+                    for prepay in evicted:
+                        report_unmatched_prepay(df, prepay, parsed_files, run_stats)
+                    for final_txn in missing:
+                        report_missing_finalization(df, final_txn, parsed_files, run_stats)
+            writer.put_month(d, day_files, removed_columns[d])
+        # Everything is parsed, running the results out lets the pool shut down
+        for _ in results:
+            pass
+    except BaseException:
+        # Unblock the pool's feeder so the pool can be torn down, and leave the workbook as it was
+        for _ in xrange(len(stale_files) + 1):
+            slots.release()
+        writer.abort()
+        raise
+    with run_stats.stage('rollup'):
+        writer.rollups_changed = manifest.update_rollups()
+    # Saved before the manifest, so the manifest never claims columns that weren't written
+    writer.finish()
+    run_stats.write(dict(reconciler.counts, record='reconcile'))
+    if key_index:
+        run_stats.write(dict(key_index.counts, record='dedup'))
+    with run_stats.stage('save'):
+        manifest.save()
+
+
+def run(opts, run_stats):
+    """"""
+    if opts.pipeline:
+        return run_pipelined(opts, run_stats)
+    excel_workbook_path = opts.excel_workbook_path
+    volume_buckets = VolumeBuckets(opts.volume_buckets)
+    manifest = IngestManifest(opts.manifest or excel_workbook_path + MANIFEST_SUFFIX, volume_buckets)
+
+    with run_stats.stage('scan'):
+        day_files_by_dir, file_stats, stale_files = scan_day_files(opts.months_directory_path, manifest)
+    wb = None
+    if not opts.write_only:
+        with run_stats.stage('load'):
+            wb = load_or_create_workbook(excel_workbook_path)
+    # They all go to the pool at once, results come back in date order
+    results = analyze_day_files(stale_files, opts.workers, volume_buckets, int(opts.split_size * 1048576), opts.index)
+    with run_stats.stage('parse'):
+        for df, (date_obj, values, sha1, stats_record, leftovers, keys) in zip(stale_files, results):
+            manifest.update(df, file_stats[df], sha1, values, leftovers, keys)
+            run_stats.add_file(stats_record)
+        removed_columns = manifest.remove_missing(day_files_by_dir)
+    # In date order over every day, like reconciling, the first copy of a transaction is the one counted
+    with run_stats.stage('dedup'):
+        drop_duplicate_txns(manifest, opts.keep_duplicates, set(stale_files), run_stats)
+    # Every day has to be in the manifest first, a prepay can be finalized in the next month's first day file
+    with run_stats.stage('reconcile'):
+        reconcile_prepays(manifest, opts.prepay_ttl, set(stale_files), run_stats)
+    with run_stats.stage('rollup'):
+        rollups_changed = manifest.update_rollups()
+    updated = False
+    if wb is not None:
+        with run_stats.stage('workbook'):
+            for d, day_files in day_files_by_dir:
+                updated = update_month_worksheet(wb, d, day_files, manifest, volume_buckets, removed_columns[d]) or updated
+            if opts.rollups:
+                updated = update_rollup_sheets(wb, manifest, volume_buckets, rollups_changed) or updated
+    # The workbook is saved once, and before the manifest, so the manifest never claims columns that weren't written
+    with run_stats.stage('save'):
+        if opts.write_only:
+            write_workbook_streaming(excel_workbook_path, manifest, volume_buckets, opts.rollups)
+        elif updated or not os.path.exists(excel_workbook_path):
+            wb.save(excel_workbook_path)
+        manifest.save()
+
+
+def main(args):
+    """"""
+    if len(args) > 1 and args[1] in COMMANDS:
+        command, args = args[1], args[:1] + args[2:]
+    else:
+        # Without a command it's export-xlsx, the way the script has always been run
+        command = 'export-xlsx'
+    if command != 'export-xlsx':
+        return run_command(command, args)
+    opts = parse_args(args)
+    stats_out = None
+    if opts.stats:
+        stats_out = sys.stderr if opts.stats == '-' else open(opts.stats, 'a')
+    run_stats = RunStats(stats_out)
+    if opts.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(run, opts, run_stats)
+        profiler.dump_stats(opts.profile)
+    else:
+        run(opts, run_stats)
+    run_stats.finish()
+    if stats_out and stats_out is not sys.stderr:
+        stats_out.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Map/reduce over many stations' day reports with PartialAggregates. Each station parses its own reports and writes a
+small partials file, one partial per day, and only those files travel to wherever they're combined. Transactions a
+station's earlier day file already had, like those of a day exported twice, are only counted the first time.
+
+    $ python partials.py map <PATH TO DIRECTORY OF DAY REPORT TEXT FILES> <PARTIALS FILE> --station 0421
+    $ python partials.py reduce <PARTIALS FILE> [<PARTIALS FILE> ...] --by month --output <PARTIALS FILE>
+
+reduce prints the merged counts, gallons and revenue for each day, month, station or for everything, and can write
+them out as a partials file again, so the reduce step can itself be run in stages.
+"""
+import argparse
+import functools
+import gzip
+import json
+import multiprocessing
+import os
+import sys
+from parse import DayAnalyzer, DayParser, INDEX_SUFFIX, PREPAY_TTL_HOURS, PartialAggregate, PrepayReconciler, TxnKeyIndex, VOLUME_BUCKET_EDGES, VolumeBuckets, get_date_for_day_file, get_day_files, get_day_txn_keys, get_gas_cell_labels, get_gas_transactions_from_buffer, get_month_directories, map_day_files, merge_partials, open_day_buffer, parse_volume_bucket_edges, split_duplicate_txns
+
+PARTIALS_VERSION = 1
+GROUPINGS = ('day', 'month', 'station', 'total')
+
+
+def get_source(station, date_obj):
+    """"""
+    return '{0}/{1}'.format(station, date_obj.strftime('%Y-%m-%d'))
+
+
+def map_day_file(day_path, station, volume_buckets=None, use_index=False, duplicates=()):
+    """
+    Pool worker body: (date, the day's partial, leftovers for PrepayReconciler, keys for TxnKeyIndex) of a day file,
+    the partial leaving out the transactions at the duplicates positions (see split_duplicate_txns)
+    """
+    parser = DayParser()
+    with open_day_buffer(day_path) as buf:
+        gas_txns, carwash_txns = get_gas_transactions_from_buffer(buf, parser=parser, day_path=day_path if use_index else None)
+    keys = get_day_txn_keys(gas_txns, carwash_txns)
+    (gas_txns, carwash_txns), _ = split_duplicate_txns(gas_txns, carwash_txns, duplicates)
+    date_obj = get_date_for_day_file(day_path)
+    partial = DayAnalyzer(gas_txns, date_obj, None, carwash_txns, volume_buckets).get_partial([get_source(station, date_obj)])
+    return date_obj, partial, parser.get_leftovers(), keys
+
+
+def map_station(months_directory_path, station, workers, volume_buckets, prepay_ttl=PREPAY_TTL_HOURS, use_index=False, keep_duplicates=False):
+    """
+    The partial of every day file of a station, in date order, with prepays matched across days and, unless
+    keep_duplicates, the transactions of earlier day files left out. A day file with any of those is parsed again
+    here without them. Day files of the same day add up to one partial.
+    """
+    day_files = [df for d in get_month_directories(months_directory_path) for df in get_day_files(d)]
+    reconciler = PrepayReconciler(prepay_ttl)
+    key_index = None if keep_duplicates else TxnKeyIndex()
+    partials, day_partials = [], {}
+    for day_path, (date_obj, partial, leftovers, keys) in zip(day_files, map_day_files(functools.partial(map_day_file, station=station, volume_buckets=volume_buckets, use_index=use_index), day_files, workers)):
+        duplicates = key_index.add_day(day_path, keys) if key_index else []
+        if duplicates:
+            print '\tDuplicate txns: {0} already in an earlier day file'.format(len(duplicates))
+            _, partial, _, _ = map_day_file(day_path, station, volume_buckets, use_index, duplicates)
+        recovered, evicted, missing = reconciler.add_day(date_obj, leftovers)
+        for prepay in evicted:
+            print '\tUnmatched prepay: {0}'.format(prepay.reference_num)
+        for final_txn in missing:
+            print '\tMissing txn number: {0}'.format(final_txn.reference_num)
+        if recovered:
+            partial = partial.merge(DayAnalyzer(recovered, date_obj, None, [], volume_buckets).get_partial())
+        if date_obj in day_partials:
+            # Another day file of the same day, like one exported again into the next month, adds to the day's partial
+            i = day_partials[date_obj]
+            partials[i] = partials[i].merge(PartialAggregate(volume_buckets, partial.values, partial.volume, partial.revenue))
+        else:
+            day_partials[date_obj] = len(partials)
+            partials.append(partial)
+    return partials
+
+
+def write_partials(path, partials):
+    """"""
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        json.dump({'version': PARTIALS_VERSION, 'partials': [p.as_record() for p in partials]}, f, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def read_partials(path):
+    """"""
+    with gzip.open(path, 'rb') as f:
+        partials_file = json.load(f)
+    if partials_file.get('version') != PARTIALS_VERSION:
+        raise ValueError('{0} is not a version {1} partials file'.format(path, PARTIALS_VERSION))
+    return [PartialAggregate.from_record(record) for record in partials_file['partials']]
+
+
+def get_group(partial, by):
+    """The day, month, station or 'total' a partial belongs to, its sources can't span more than one"""
+    if by == 'total':
+        return 'total'
+    keys = set()
+    for source in partial.sources:
+        station, day = source.split('/')
+        keys.add({'day': day, 'month': day[:7], 'station': station}[by])
+    if len(keys) != 1:
+        raise ValueError('A partial covering {0} can\'t be grouped by {1}'.format(', '.join(sorted(partial.sources)), by))
+    return keys.pop()
+
+
+def reduce_partials(partials, by='day'):
+    """{group: merged partial} of partials grouped by day, month, station or all together"""
+    groups = {}
+    for p in partials:
+        groups.setdefault(get_group(p, by), []).append(p)
+    return dict((group, merge_partials(group_partials)) for group, group_partials in groups.items())
+
+
+def print_partials(merged):
+    """One column per group, one row per workbook label plus gallons and revenue"""
+    groups = sorted(merged)
+    labels = get_gas_cell_labels(merged[groups[0]].volume_buckets) if groups else []
+    width = max([len(l) for l in labels] + [len('Revenue')]) + 2
+    print ' ' * width + ''.join('{0:>12}'.format(g) for g in groups)
+    for i, label in enumerate(labels):
+        print '{0:<{1}}'.format(label, width) + ''.join('{0:>12}'.format(merged[g].values[i]) for g in groups)
+    print '{0:<{1}}'.format('Gallons', width) + ''.join('{0:>12.3f}'.format(merged[g].volume) for g in groups)
+    print '{0:<{1}}'.format('Revenue', width) + ''.join('{0:>12.2f}'.format(merged[g].revenue) for g in groups)
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Count Blue Cube day reports per station and combine the counts centrally.')
+    subparsers = arg_parser.add_subparsers(dest='command')
+    map_parser = subparsers.add_parser('map', help='parse a station\'s day files into a partials file')
+    map_parser.add_argument('months_directory_path')
+    map_parser.add_argument('partials_path')
+    map_parser.add_argument('--station', help='name of the station (default: the name of the months directory)')
+    map_parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of day files to parse in parallel (default: number of cores)')
+    map_parser.add_argument('--volume-buckets', type=parse_volume_bucket_edges, default=VOLUME_BUCKET_EDGES, metavar='EDGES', help='comma separated gallon edges of the volume rows (default: 5,10,14,19)')
+    map_parser.add_argument('--prepay-ttl', type=float, default=PREPAY_TTL_HOURS, metavar='HOURS', help='how long a prepay can wait for its finalization in a later day file (default: {0})'.format(PREPAY_TTL_HOURS))
+    map_parser.add_argument('--index', action='store_true', help='keep a {0} file next to each day file with where its lines and transactions start, so parsing it again skips finding them'.format(INDEX_SUFFIX))
+    map_parser.add_argument('--keep-duplicates', action='store_true', help='count transactions whose id, date and time were already counted in an earlier day file again, like those of a day exported twice')
+    reduce_parser = subparsers.add_parser('reduce', help='merge partials files and print the totals')
+    reduce_parser.add_argument('partials_paths', nargs='+')
+    reduce_parser.add_argument('--by', choices=GROUPINGS, default='day')
+    reduce_parser.add_argument('--output', metavar='PATH', help='also write the merged partials to PATH, for a further reduce')
+    opts = arg_parser.parse_args(args[1:])
+
+    if opts.command == 'map':
+        station = opts.station or os.path.basename(os.path.abspath(opts.months_directory_path))
+        partials = map_station(opts.months_directory_path, station, opts.workers, VolumeBuckets(opts.volume_buckets), opts.prepay_ttl, opts.index, opts.keep_duplicates)
+        write_partials(opts.partials_path, partials)
+        print 'wrote {0} day partials for {1}'.format(len(partials), station)
+    else:
+        merged = reduce_partials([p for path in opts.partials_paths for p in read_partials(path)], opts.by)
+        print_partials(merged)
+        if opts.output:
+            write_partials(opts.output, [merged[g] for g in sorted(merged)])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP service answering questions about a station's day reports with JSON, for dashboards and anything else that
+shouldn't have to open the workbook.
+
+    $ python serve.py <PATH TO DIRECTORY OF DAY REPORT TEXT FILES> --port 8421
+
+    GET /days?from=2015-01-01&to=2015-01-31     workbook counts, gallons and revenue of each day
+    GET /pumps?from=2015-01-01&to=2015-01-31    gas sales, gallons and revenue per pump over the range
+    GET /grades?...                             the same per grade
+    GET /tenders?...                            the same per tender
+    GET /cache                                  cache hits, misses, invalidations and evictions
+
+from and to are inclusive and default to the first and last day there is a report for. Each day file is parsed once
+into a DayAggregate kept in an LRU cache; it's parsed again only once its size or mtime changes, so polling the same
+ranges costs a stat per day and a merge. Prepays finalized in a later day file are matched up like the workbook does,
+and transactions a day file shares with an earlier one are left out of the later day. Only the days a query reads are
+checked for those though: the range and the few days before it that prepays are matched from, at least one.
+"""
+import argparse
+import BaseHTTPServer
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import json
+import math
+import os
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+from parse import DayAnalyzer, PREPAY_TTL_HOURS, PrepayReconciler, VOLUME_BUCKET_EDGES, VolumeBuckets, TxnKeyIndex, get_date_for_day_file, get_day_files, get_day_txn_keys, get_gas_cell_labels, get_month_directories, merge_partials, parse_day, parse_volume_bucket_edges, split_duplicate_txns, stat_day_file
+
+CACHE_DAYS = 4096
+SCAN_SECONDS = 2.0
+DUPLICATE_LOOKBACK_DAYS = 1
+BREAKDOWNS = {'pumps': 'pump_num', 'grades': 'gas_type', 'tenders': 'tender'}
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def get_breakdowns(gas_txns):
+    """{breakdown: {key: [sales, gallons, revenue]}} of gas transactions, per pump, grade and tender"""
+    breakdowns = dict((name, {}) for name in BREAKDOWNS)
+    for t in gas_txns:
+        revenue = round(t.volume * t.price, 2) if t.volume and t.price else 0.0
+        for name, field in BREAKDOWNS.items():
+            key = getattr(t, field)
+            totals = breakdowns[name].setdefault('unknown' if key is None else str(key), [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += t.volume or 0.0
+            totals[2] += revenue
+    return breakdowns
+
+
+class DayAggregate(object):
+    """A PartialAggregate of the workbook counts plus the per pump, grade and tender breakdowns of gas sales"""
+    def __init__(self, partial, breakdowns):
+        self.partial = partial
+        self.breakdowns = breakdowns
+
+    @classmethod
+    def from_txns(cls, gas_txns, carwash_txns, volume_buckets):
+        """"""
+        return cls(DayAnalyzer(gas_txns, None, None, carwash_txns, volume_buckets).get_partial(), get_breakdowns(gas_txns))
+
+    def merge(self, other):
+        """A new DayAggregate with both added up"""
+        breakdowns = {}
+        for name in BREAKDOWNS:
+            merged = dict((key, list(totals)) for key, totals in self.breakdowns[name].items())
+            for key, totals in other.breakdowns[name].items():
+                merged[key] = [a + b for a, b in zip(merged.get(key, [0, 0.0, 0.0]), totals)]
+            breakdowns[name] = merged
+        return DayAggregate(merge_partials([self.partial, other.partial]), breakdowns)
+
+
+class LRUCache(object):
+    """Least recently used entries are dropped past max_size. Thread safe, counts its hits and misses."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(('hits', 'misses', 'invalidations', 'evictions'), 0)
+
+    def get(self, key, version):
+        """The value cached for key if it was cached for this version of it, else None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+            if entry[0] != version:
+                self.counts['invalidations'] += 1
+                return None
+            self.entries[key] = entry
+            self.counts['hits'] += 1
+            return entry[1]
+
+    def put(self, key, version, value):
+        """"""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (version, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+
+    def get_stats(self):
+        """"""
+        with self.lock:
+            return dict(self.counts, size=len(self.entries), max_size=self.max_size)
+
+
+class QueryService(object):
+    """Answers the service's queries for one directory of months, from cached per-day aggregates"""
+    def __init__(self, months_directory_path, volume_buckets=None, cache_days=CACHE_DAYS, prepay_ttl=PREPAY_TTL_HOURS):
+        self.months_directory_path = months_directory_path
+        self.volume_buckets = volume_buckets or VolumeBuckets()
+        self.labels = get_gas_cell_labels(self.volume_buckets)
+        self.cache = LRUCache(cache_days)
+        self.prepay_ttl = prepay_ttl
+        # How many days before a range can have prepays finalized in it, or transactions exported again in it
+        self.lookback_days = max(int(math.ceil(prepay_ttl / 24.0)), DUPLICATE_LOOKBACK_DAYS)
+        self.day_files = {}
+        self.scanned_at = None
+        self.scan_lock = threading.Lock()
+
+    def get_day_files(self):
+        """{date: day file}, looked up again at most every SCAN_SECONDS so new day files are found"""
+        with self.scan_lock:
+            if self.scanned_at is None or time.time() - self.scanned_at >= SCAN_SECONDS:
+                day_files = {}
+                # If two month directories hold the same day, the later one wins
+                for d in get_month_directories(self.months_directory_path):
+                    for df in get_day_files(d):
+                        day_files[get_date_for_day_file(df).date()] = df
+                self.day_files, self.scanned_at = day_files, time.time()
+            return self.day_files
+
+    def get_day(self, day_path, duplicates=()):
+        """
+        (DayAggregate, leftovers, keys for TxnKeyIndex) of a day file, the aggregate leaving out the transactions at the
+        duplicates positions (see split_duplicate_txns). From the cache unless the file changed since it was parsed,
+        days with and without duplicates left out are cached apart.
+        """
+        stat = stat_day_file(day_path)
+        version = (stat.st_size, stat.st_mtime)
+        key = (day_path, tuple(duplicates)) if duplicates else day_path
+        cached = self.cache.get(key, version)
+        if cached is None:
+            day = parse_day(day_path)
+            keys = get_day_txn_keys(day.gas_txns, day.carwash_txns)
+            (gas_txns, carwash_txns), _ = split_duplicate_txns(day.gas_txns, day.carwash_txns, duplicates)
+            cached = (DayAggregate.from_txns(gas_txns, carwash_txns, self.volume_buckets), day.leftovers, keys)
+            self.cache.put(key, version, cached)
+        return cached
+
+    def get_range(self, start=None, end=None):
+        """
+        [(date, DayAggregate)] of every day with a report in [start, end], prepays matched across days and transactions
+        of earlier days left out
+        """
+        day_files = self.get_day_files()
+        if not day_files:
+            return []
+        start = start or min(day_files)
+        end = end or max(day_files)
+        reconciler = PrepayReconciler(self.prepay_ttl)
+        key_index = TxnKeyIndex()
+        days = []
+        for date_obj in sorted(d for d in day_files if start - timedelta(days=self.lookback_days) <= d <= end):
+            aggregate, leftovers, keys = self.get_day(day_files[date_obj])
+            duplicates = key_index.add_day(date_obj, keys)
+            if duplicates:
+                aggregate, _, _ = self.get_day(day_files[date_obj], duplicates)
+            recovered, _, _ = reconciler.add_day(datetime.combine(date_obj, datetime.min.time()), leftovers)
+            if date_obj < start:
+                continue
+            if recovered:
+                aggregate = aggregate.merge(DayAggregate.from_txns(recovered, [], self.volume_buckets))
+            days.append((date_obj, aggregate))
+        return days
+
+    def query_days(self, start=None, end=None):
+        """"""
+        return [OrderedDict([('day', date_obj.strftime(DATE_FORMAT)), ('counts', OrderedDict(zip(self.labels, a.partial.values))), ('gallons', round(a.partial.volume, 3)), ('revenue', round(a.partial.revenue, 2))]) for date_obj, a in self.get_range(start, end)]
+
+    def query_breakdown(self, name, start=None, end=None):
+        """{key: {sales, gallons, revenue}} of one breakdown over the range"""
+        totals = {}
+        for _, aggregate in self.get_range(start, end):
+            for key, (sales, gallons, revenue) in aggregate.breakdowns[name].items():
+                key_totals = totals.setdefault(key, [0, 0.0, 0.0])
+                key_totals[0] += sales
+                key_totals[1] += gallons
+                key_totals[2] += revenue
+        return OrderedDict((key, OrderedDict([('sales', t[0]), ('gallons', round(t[1], 3)), ('revenue', round(t[2], 2))])) for key, t in sorted(totals.items()))
+
+
+def parse_date(value):
+    """"""
+    return datetime.strptime(value, DATE_FORMAT).date() if value else None
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """"""
+    def do_GET(self):
+        """"""
+        url = urlparse.urlparse(self.path)
+        endpoint = url.path.strip('/')
+        params = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).items())
+        service = self.server.service
+        try:
+            start, end = parse_date(params.get('from')), parse_date(params.get('to'))
+        except ValueError:
+            return self.send_json(400, {'error': 'from and to have to be YYYY-MM-DD dates'})
+        if endpoint == 'days':
+            result = service.query_days(start, end)
+        elif endpoint in BREAKDOWNS:
+            result = service.query_breakdown(endpoint, start, end)
+        elif endpoint == 'cache':
+            result = service.cache.get_stats()
+        else:
+            return self.send_json(404, {'error': 'unknown endpoint /{0}'.format(endpoint)})
+        self.send_json(200, result)
+
+    def send_json(self, status, body):
+        """"""
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """Requests are only logged with --verbose"""
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """"""
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, QueryHandler)
+        self.service = service
+        self.verbose = verbose
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Serve counts, gallons and revenue from Blue Cube day reports as JSON over HTTP.')
+    arg_parser.add_argument('months_directory_path')
+    arg_parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1, only this machine)')
+    arg_parser.add_argument('--port', type=int, default=8421)
+    arg_parser.add_argument('--cache-days', type=int, default=CACHE_DAYS, metavar='N', help='how many days\' aggregates to keep in memory (default: {0})'.format(CACHE_DAYS))
+    arg_parser.add_argument('--volume-buckets', type=parse_volume_bucket_edges, default=VOLUME_BUCKET_EDGES, metavar='EDGES', help='comma separated gallon edges of the volume rows (default: 5,10,14,19)')
+    arg_parser.add_argument('--prepay-ttl', type=float, default=PREPAY_TTL_HOURS, metavar='HOURS', help='how long a prepay can wait for its finalization in a later day file (default: {0})'.format(PREPAY_TTL_HOURS))
+    arg_parser.add_argument('--verbose', action='store_true', help='log every request')
+    opts = arg_parser.parse_args(args[1:])
+
+    service = QueryService(opts.months_directory_path, VolumeBuckets(opts.volume_buckets), opts.cache_days, opts.prepay_ttl)
+    server = QueryServer((opts.host, opts.port), service, opts.verbose)
+    print 'serving {0} on http://{1}:{2}/'.format(os.path.abspath(opts.months_directory_path), opts.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite sink for parsed day reports. Every gas and carwash transaction is kept along with the day's counts from the
+workbook, so new reports can be answered with a query instead of re-parsing the text files. Prepays finalized in a
+later day file are matched up like the workbook does, and stored as gas txns of the day they were finalized.
+Transactions already stored for an earlier day, like those of a day file exported again overlapping the one before it,
+are left out of the later day.
+
+    $ python txn_store.py load <PATH TO DIRECTORY OF DAY REPORT TEXT FILES> <PATH TO DATABASE>
+    $ python txn_store.py query <PATH TO DATABASE> --by gas_type --from 2015-01-01 --to 2015-01-31
+"""
+import argparse
+from datetime import datetime
+import functools
+import hashlib
+import json
+import multiprocessing
+import sqlite3
+import sys
+from parse import DayAnalyzer, DayParser, GAS_CELL_LABELS, INDEX_SUFFIX, PREPAY_TTL_HOURS, PrepayReconciler, TxnKeyIndex, get_date_for_day_file, get_day_files, get_day_txn_keys, get_gas_transactions_from_buffer, get_month_directories, map_day_files, open_day_buffer, split_duplicate_txns, stat_day_file
+
+STORE_VERSION = 3
+TABLES = ('day_files', 'gas_txns', 'carwash_txns', 'day_counts')
+# day_files keeps the day's own counts, its leftovers for PrepayReconciler, the keys of all its transactions for
+# TxnKeyIndex and the positions of those left out as duplicates as JSON, gas_txns.recovered is 1 for a prepay rung up on
+# an earlier day and finalized on this one
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS day_files (day TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL, sha1 TEXT NOT NULL, counts TEXT NOT NULL, leftovers TEXT NOT NULL, keys TEXT NOT NULL, duplicates TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS gas_txns (day TEXT NOT NULL, txn_id INTEGER, date TEXT, time TEXT, location TEXT, tender TEXT, pump_num INTEGER, gas_type TEXT, volume REAL, price REAL, amount REAL, reference_num INTEGER, carwash_type TEXT, recovered INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS carwash_txns (day TEXT NOT NULL, location TEXT, tender TEXT, carwash_type TEXT)',
+    'CREATE TABLE IF NOT EXISTS day_counts (day TEXT NOT NULL, label TEXT NOT NULL, value INTEGER, PRIMARY KEY (day, label))',
+    'CREATE INDEX IF NOT EXISTS gas_txns_day ON gas_txns (day)',
+    'CREATE INDEX IF NOT EXISTS gas_txns_pump_num ON gas_txns (pump_num)',
+    'CREATE INDEX IF NOT EXISTS gas_txns_gas_type ON gas_txns (gas_type)',
+    'CREATE INDEX IF NOT EXISTS gas_txns_tender ON gas_txns (tender)',
+    'CREATE INDEX IF NOT EXISTS carwash_txns_day ON carwash_txns (day)',
+]
+SUMMARY_COLUMNS = ('day', 'gas_type', 'tender', 'location', 'pump_num', 'price')
+DAYS_PER_COMMIT = 31
+
+
+def get_gas_rows(day, gas_txns, recovered=False):
+    """"""
+    return [(day, int(t.id), t.date, t.time, t.location, t.tender, t.pump_num, t.gas_type, t.volume, t.price, t.amount, int(t.reference_num) if t.reference_num else None, t.carwash_txn.carwash_type if t.carwash_txn else None, int(recovered)) for t in gas_txns]
+
+
+def read_day_file(day_path, use_index=False, duplicates=()):
+    """
+    Parse a day file into the rows the store keeps for it, through its sidecar index with use_index, leaving out the
+    transactions at the duplicates positions (see split_duplicate_txns). This is what pool workers run. The cell values
+    are the day's own, before any prepays of earlier days are matched to it.
+    Returns (day, day_files row, gas_txns rows, carwash_txns rows, cell values).
+    """
+    parser = DayParser()
+    with open_day_buffer(day_path) as buf:
+        stat = stat_day_file(day_path)
+        sha1 = hashlib.sha1(buf).hexdigest()
+        gas_txns, carwash_txns = get_gas_transactions_from_buffer(buf, parser=parser, day_path=day_path if use_index else None)
+    keys = get_day_txn_keys(gas_txns, carwash_txns)
+    (gas_txns, carwash_txns), _ = split_duplicate_txns(gas_txns, carwash_txns, duplicates)
+    date_obj = get_date_for_day_file(day_path)
+    day = date_obj.strftime('%Y-%m-%d')
+    carwash_rows = [(day, c.location, c.tender, c.carwash_type) for c in carwash_txns]
+    values = DayAnalyzer(gas_txns, date_obj, None, carwash_txns).get_cell_values()
+    return day, (day, day_path, stat.st_size, stat.st_mtime, sha1, json.dumps(values), json.dumps(parser.get_leftovers()), json.dumps(keys), json.dumps(list(duplicates))), get_gas_rows(day, gas_txns), carwash_rows, values
+
+
+def get_day_range_clause(start=None, end=None):
+    """WHERE clause and parameters limiting the day column to [start, end], either end may be left open"""
+    conditions, params = [], []
+    if start:
+        conditions.append('day >= ?')
+        params.append(start)
+    if end:
+        conditions.append('day <= ?')
+        params.append(end)
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+
+class TransactionStore(object):
+    """
+    Parsed transactions and per-day counts in a local SQLite database, one set of rows per day. Loading a day again
+    replaces its rows, so re-exported or corrected day files never double count.
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        with self.conn:
+            # Stores from before the leftovers were kept can't be reconciled, they're loaded again from scratch
+            if self.conn.execute('PRAGMA user_version').fetchone()[0] != STORE_VERSION:
+                for table in TABLES:
+                    self.conn.execute('DROP TABLE IF EXISTS {0}'.format(table))
+                self.conn.execute('PRAGMA user_version = {0}'.format(STORE_VERSION))
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        """"""
+        self.conn.close()
+
+    def is_stale(self, day, day_path, stat):
+        """True if the day isn't stored yet or was stored from a different or since modified file"""
+        row = self.conn.execute('SELECT path, size, mtime FROM day_files WHERE day = ?', (day,)).fetchone()
+        return row is None or tuple(row) != (day_path, stat.st_size, stat.st_mtime)
+
+    def add_days(self, days):
+        """Store read_day_file results, replacing whatever was there for those days, in a single transaction"""
+        with self.conn:
+            for day, file_row, gas_rows, carwash_rows, values in days:
+                for table in TABLES:
+                    self.conn.execute('DELETE FROM {0} WHERE day = ?'.format(table), (day,))
+                self.conn.execute('INSERT INTO day_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', file_row)
+                self.conn.executemany('INSERT INTO gas_txns VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', gas_rows)
+                self.conn.executemany('INSERT INTO carwash_txns VALUES (?, ?, ?, ?)', carwash_rows)
+                self.set_day_counts(day, values)
+
+    def set_day_counts(self, day, values):
+        """"""
+        self.conn.execute('DELETE FROM day_counts WHERE day = ?', (day,))
+        self.conn.executemany('INSERT INTO day_counts VALUES (?, ?, ?)', [(day, label, value) for label, value in zip(GAS_CELL_LABELS, values)])
+
+    def drop_duplicates(self, key_index=None, use_index=False):
+        """
+        Run every stored day's keys through key_index in date order, and store again without them the days whose
+        duplicates changed, from their day files. Without a key_index, duplicates are all kept. Days whose day file is
+        gone keep what they have. Returns (day, number of duplicates) of every day with any.
+        """
+        duplicates = []
+        for day, day_path, keys, stored in self.query('SELECT day, path, keys, duplicates FROM day_files ORDER BY day'):
+            positions = key_index.add_day(day, json.loads(keys)) if key_index else []
+            if positions != json.loads(stored):
+                try:
+                    self.add_days([read_day_file(day_path, use_index, positions)])
+                except EnvironmentError:
+                    pass
+            if positions:
+                duplicates.append((day, len(positions)))
+        return duplicates
+
+    def reconcile(self, prepay_ttl=PREPAY_TTL_HOURS, reported_days=()):
+        """
+        Run every stored day's leftovers through a PrepayReconciler in date order, like the workbook does. The prepays
+        recovered on a day are stored as its gas txns and added to its day_counts, days whose recovered prepays are
+        unchanged are left alone. Returns the prepays given up on and the finalizations no prepay was found for, as
+        (day, txn) pairs, of reported_days only.
+        """
+        reconciler = PrepayReconciler(prepay_ttl)
+        unmatched, missing = [], []
+        with self.conn:
+            for day, counts, leftovers in self.query('SELECT day, counts, leftovers FROM day_files ORDER BY day'):
+                date_obj = datetime.strptime(day, '%Y-%m-%d')
+                recovered, evicted, day_missing = reconciler.add_day(date_obj, json.loads(leftovers))
+                if day in reported_days:
+                    unmatched += [(day, prepay) for prepay in evicted]
+                    missing += [(day, final_txn) for final_txn in day_missing]
+                rows = get_gas_rows(day, recovered, True)
+                if rows == self.query('SELECT * FROM gas_txns WHERE day = ? AND recovered = 1 ORDER BY rowid', (day,)):
+                    continue
+                self.conn.execute('DELETE FROM gas_txns WHERE day = ? AND recovered = 1', (day,))
+                self.conn.executemany('INSERT INTO gas_txns VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                recovered_values = DayAnalyzer(recovered, date_obj, None, []).get_cell_values()
+                self.set_day_counts(day, [a + b for a, b in zip(json.loads(counts), recovered_values)])
+        return unmatched, missing
+
+    def query(self, sql, params=()):
+        """Run any read query against the store, returns a list of row tuples"""
+        return self.conn.execute(sql, params).fetchall()
+
+    def get_day_counts(self, start=None, end=None):
+        """{day: {label: value}} of the workbook counts for days in [start, end]"""
+        where, params = get_day_range_clause(start, end)
+        counts = {}
+        for day, label, value in self.query('SELECT day, label, value FROM day_counts' + where, params):
+            counts.setdefault(day, {})[label] = value
+        return counts
+
+    def summarize(self, by, start=None, end=None):
+        """(value of by, gas txn count, total volume, total amount) for each value of the by column, over [start, end]"""
+        if by not in SUMMARY_COLUMNS:
+            raise ValueError('Can only summarize by one of {0}'.format(', '.join(SUMMARY_COLUMNS)))
+        where, params = get_day_range_clause(start, end)
+        return self.query('SELECT {0}, COUNT(*), SUM(volume), SUM(amount) FROM gas_txns{1} GROUP BY {0} ORDER BY {0}'.format(by, where), params)
+
+    def get_price_history(self, gas_type=None, start=None, end=None):
+        """(day, gas type, price, gas txn count, total volume) for each price a grade sold at on each day"""
+        where, params = get_day_range_clause(start, end)
+        if gas_type:
+            where += (' AND ' if where else ' WHERE ') + 'gas_type = ?'
+            params.append(gas_type)
+        return self.query('SELECT day, gas_type, price, COUNT(*), SUM(volume) FROM gas_txns{0} GROUP BY day, gas_type, price ORDER BY day, gas_type, price'.format(where), params)
+
+
+def load(months_directory_path, db_path, workers, use_index=False, prepay_ttl=PREPAY_TTL_HOURS, keep_duplicates=False):
+    """
+    Parse every new or changed day file under months_directory_path into the store, then leave out transactions
+    already stored for an earlier day (unless keep_duplicates) and match prepays across days
+    """
+    store = TransactionStore(db_path)
+    # If two month directories hold the same day, the later one wins
+    day_paths = {}
+    for d in get_month_directories(months_directory_path):
+        for df in get_day_files(d):
+            day_paths[get_date_for_day_file(df).strftime('%Y-%m-%d')] = df
+    stale_files = [day_paths[day] for day in sorted(day_paths) if store.is_stale(day, day_paths[day], stat_day_file(day_paths[day]))]
+    days = []
+    for result in map_day_files(functools.partial(read_day_file, use_index=use_index), stale_files, workers):
+        print 'storing gas txns for {0}'.format(result[0])
+        days.append(result)
+        if len(days) >= DAYS_PER_COMMIT:
+            store.add_days(days)
+            days = []
+    store.add_days(days)
+    reported_days = set(get_date_for_day_file(df).strftime('%Y-%m-%d') for df in stale_files)
+    for day, count in store.drop_duplicates(None if keep_duplicates else TxnKeyIndex(), use_index):
+        if day in reported_days:
+            print '\tDuplicate txns on {0}: {1} already stored for an earlier day'.format(day, count)
+    unmatched, missing = store.reconcile(prepay_ttl, reported_days)
+    for day, prepay in unmatched:
+        print '\tUnmatched prepay: {0}'.format(prepay.reference_num)
+    for day, final_txn in missing:
+        print '\tMissing txn number: {0}'.format(final_txn.reference_num)
+    store.close()
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Keep parsed Blue Cube transactions in a SQLite database.')
+    subparsers = arg_parser.add_subparsers(dest='command')
+    load_parser = subparsers.add_parser('load', help='parse new and changed day files into the database')
+    load_parser.add_argument('months_directory_path')
+    load_parser.add_argument('db_path')
+    load_parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of day files to parse in parallel (default: number of cores)')
+    load_parser.add_argument('--index', action='store_true', help='keep a {0} file next to each day file with where its lines and transactions start, so parsing it again skips finding them'.format(INDEX_SUFFIX))
+    load_parser.add_argument('--prepay-ttl', type=float, default=PREPAY_TTL_HOURS, metavar='HOURS', help='how long a prepay can wait for its finalization in a later day file (default: {0})'.format(PREPAY_TTL_HOURS))
+    load_parser.add_argument('--keep-duplicates', action='store_true', help='store transactions an earlier day already has again instead of leaving them out')
+    query_parser = subparsers.add_parser('query', help='print gas txn count, volume and amount grouped by a column')
+    query_parser.add_argument('db_path')
+    query_parser.add_argument('--by', choices=SUMMARY_COLUMNS, default='day')
+    query_parser.add_argument('--from', dest='start', metavar='YYYY-MM-DD')
+    query_parser.add_argument('--to', dest='end', metavar='YYYY-MM-DD')
+    opts = arg_parser.parse_args(args[1:])
+
+    if opts.command == 'load':
+        load(opts.months_directory_path, opts.db_path, opts.workers, opts.index, opts.prepay_ttl, opts.keep_duplicates)
+    else:
+        store = TransactionStore(opts.db_path)
+        for row in store.summarize(opts.by, opts.start, opts.end):
+            print '\t'.join(str(v) for v in row)
+        store.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
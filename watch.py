@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Watches a fleet of stations' reports and keeps every station's workbook up to date as day files arrive, instead of
+running parse.py over everything on a schedule.
+
+    $ python watch.py <FLEET DIRECTORY> <OUTPUT DIRECTORY> --concurrency 2 --settle 30 --rollups
+
+The fleet directory holds a directory of months per station (<FLEET>/<STATION>/<YYYYMM>/<YYYYMMDD>.txt, month
+archives included). A station whose day files change is queued once they have been left alone for --settle seconds,
+so files still being written aren't read half done, and is then brought up to date with parse.py export-xlsx into
+<OUTPUT>/<STATION>.xlsx. At most --concurrency stations are updated at once, a station is never updated twice at the
+same time, and its manifest makes each update parse only the day files that changed. Options this script doesn't
+know are passed on to export-xlsx.
+
+Changes are picked up with Linux inotify where it's available, otherwise by looking over the tree every
+--poll-interval seconds.
+"""
+import argparse
+import ctypes
+import ctypes.util
+from datetime import datetime
+import errno
+import os
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+from parse import get_archive_suffix, is_day_file_name
+
+SETTLE_SECONDS = 30
+POLL_SECONDS = 60
+PARSE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parse.py')
+
+
+def log(message):
+    """"""
+    sys.stdout.write('{0} {1}\n'.format(datetime.now().strftime('%H:%M:%S'), message))
+    sys.stdout.flush()
+
+
+def is_report_name(name):
+    """Day files and month archives, the only files whose changes matter"""
+    return is_day_file_name(name) or get_archive_suffix(name) is not None
+
+
+def get_stations(fleet_path):
+    """"""
+    return sorted(name for name in os.listdir(fleet_path) if os.path.isdir(os.path.join(fleet_path, name)))
+
+
+def scan_station(station_path):
+    """{path: (size, mtime)} of the day files and month archives of a station"""
+    files = {}
+    for dir_path, dir_names, names in os.walk(station_path):
+        # Only <STATION>/<MONTH>, month directories have no subdirectories of their own
+        if dir_path != station_path:
+            dir_names[:] = []
+        for name in names:
+            if is_report_name(name):
+                path = os.path.join(dir_path, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+class PollingWatcher(object):
+    """Finds changed stations by comparing the size and mtime of every report with the last look"""
+    def __init__(self, fleet_path, interval=POLL_SECONDS):
+        self.fleet_path = fleet_path
+        self.interval = interval
+        self.files = self.scan()
+        self.last_poll = time.time()
+
+    def scan(self):
+        """"""
+        return dict((station, scan_station(os.path.join(self.fleet_path, station))) for station in get_stations(self.fleet_path))
+
+    def wait(self, timeout):
+        """Stations that changed, after waiting up to timeout seconds (None to wait for the next poll)"""
+        next_poll = self.last_poll + self.interval
+        delay = next_poll - time.time()
+        if timeout is not None and timeout < delay:
+            time.sleep(max(timeout, 0))
+            return set()
+        time.sleep(max(delay, 0))
+        files = self.scan()
+        changed = set(station for station in set(files) | set(self.files) if files.get(station) != self.files.get(station))
+        self.files, self.last_poll = files, time.time()
+        return changed
+
+    def close(self):
+        """"""
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Finds changed stations through Linux inotify, called through ctypes so nothing needs to be installed. The fleet
+    directory, each station and each month directory get a watch, new ones as they are created. Raises OSError where
+    inotify isn't available, like on other systems or when out of watches.
+    """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, fleet_path):
+        self.fleet_path = os.path.abspath(fleet_path)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        # Watch descriptor to the directory it watches
+        self.paths = {}
+        self.add_tree(self.fleet_path, 2)
+
+    def add_watch(self, path):
+        """Returns False if path was gone again before it could be watched"""
+        wd = self.libc.inotify_add_watch(self.fd, path, self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise OSError(err, 'inotify_add_watch failed for {0}'.format(path))
+        self.paths[wd] = path
+        return True
+
+    def add_tree(self, path, depth):
+        """Watch path and the directories depth levels below it"""
+        if self.add_watch(path) and depth:
+            for name in os.listdir(path):
+                if os.path.isdir(os.path.join(path, name)):
+                    self.add_tree(os.path.join(path, name), depth - 1)
+
+    def get_station(self, path):
+        """The station a path in the fleet belongs to, None for the fleet directory itself"""
+        relative = os.path.relpath(path, self.fleet_path)
+        return None if relative == os.curdir else relative.split(os.sep)[0]
+
+    def read_events(self, timeout):
+        """(path, mask) of every event waiting, after waiting up to timeout seconds for the first one"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        events, pos = [], 0
+        while pos < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif wd in self.paths:
+                events.append((os.path.join(self.paths[wd], name) if name else self.paths[wd], mask))
+        return events
+
+    def wait(self, timeout):
+        """Stations that changed, waiting up to timeout seconds for something to happen (None to wait until it does)"""
+        changed = set()
+        for path, mask in self.read_events(timeout):
+            if path is None:
+                # Events were lost, so anything could have changed
+                changed.update(get_stations(self.fleet_path))
+                continue
+            station = self.get_station(path)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # A new station or month, which may have been filled before its watch was added
+                    self.add_tree(path, 1 if os.path.dirname(path) == self.fleet_path else 0)
+                if station:
+                    changed.add(station)
+            elif station and is_report_name(os.path.basename(path)):
+                changed.add(station)
+        return changed
+
+    def close(self):
+        """"""
+        os.close(self.fd)
+
+
+def get_watcher(fleet_path, poll_interval=POLL_SECONDS, polling=False):
+    """An InotifyWatcher, or a PollingWatcher if that's asked for or inotify doesn't work here"""
+    if not polling:
+        try:
+            return InotifyWatcher(fleet_path)
+        except OSError as e:
+            log('inotify unavailable ({0}), polling every {1}s instead'.format(e, poll_interval))
+    return PollingWatcher(fleet_path, poll_interval)
+
+
+class IngestScheduler(object):
+    """
+    Decides when each station gets updated. A station is due once settle seconds have passed since its last change,
+    due stations are started oldest change first in up to concurrency threads, and a station is never started while
+    its previous update is still running; changes that arrive meanwhile queue it again.
+    """
+    def __init__(self, update_station, concurrency=1, settle=SETTLE_SECONDS):
+        self.update_station = update_station
+        self.concurrency = concurrency
+        self.settle = settle
+        # Station to the time of its last change not yet handed to an update
+        self.changed = {}
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def touch(self, station, now):
+        """"""
+        with self.lock:
+            self.changed[station] = now
+
+    def get_due(self, now):
+        """Stations to start now, oldest change first"""
+        due = sorted((changed_at, station) for station, changed_at in self.changed.items() if now - changed_at >= self.settle and station not in self.running)
+        return [station for _, station in due[:max(self.concurrency - len(self.running), 0)]]
+
+    def dispatch(self, now):
+        """Start every station that is due and has a free slot"""
+        with self.lock:
+            for station in self.get_due(now):
+                del self.changed[station]
+                thread = threading.Thread(target=self.run, args=(station,), name='update-{0}'.format(station))
+                self.running[station] = thread
+                thread.start()
+
+    def run(self, station):
+        """Update thread body"""
+        try:
+            self.update_station(station)
+        finally:
+            with self.lock:
+                del self.running[station]
+
+    def get_timeout(self, now):
+        """How long the watcher can wait before the scheduler needs to look again, None if nothing is waiting"""
+        with self.lock:
+            if not self.changed:
+                return None
+            # A slot freeing up doesn't wake the watcher, so stations that are due anyway get looked at every second
+            waits = [max(self.settle - (now - changed_at), 0) for changed_at in self.changed.values()]
+            return max(min(waits), 1.0)
+
+    def join(self):
+        """Wait for the running updates"""
+        with self.lock:
+            threads = self.running.values()
+        for thread in threads:
+            thread.join()
+
+
+class StationUpdater(object):
+    """Runs parse.py export-xlsx for a station in a child process and logs its output, prefixed with the station"""
+    def __init__(self, fleet_path, output_path, export_args=()):
+        self.fleet_path = fleet_path
+        self.output_path = output_path
+        self.export_args = list(export_args)
+
+    def get_command(self, station):
+        """"""
+        return [sys.executable, PARSE_SCRIPT, 'export-xlsx', os.path.join(self.fleet_path, station), os.path.join(self.output_path, station + '.xlsx')] + self.export_args
+
+    def __call__(self, station):
+        """"""
+        start = time.time()
+        log('[{0}] updating'.format(station))
+        process = subprocess.Popen(self.get_command(station), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in iter(process.stdout.readline, ''):
+            log('[{0}] {1}'.format(station, line.rstrip()))
+        returncode = process.wait()
+        log('[{0}] {1} in {2:.1f}s'.format(station, 'updated' if returncode == 0 else 'failed with exit code {0}'.format(returncode), time.time() - start))
+
+
+def watch(fleet_path, scheduler, watcher):
+    """Feed the watcher's changes to the scheduler until interrupted. Every station is updated once at startup."""
+    for station in get_stations(fleet_path):
+        # Catch up on whatever changed while nothing was watching, without waiting to settle
+        scheduler.touch(station, 0)
+    try:
+        while True:
+            now = time.time()
+            scheduler.dispatch(now)
+            for station in watcher.wait(scheduler.get_timeout(now)):
+                scheduler.touch(station, time.time())
+    except KeyboardInterrupt:
+        log('stopping, waiting for the updates already running')
+    finally:
+        watcher.close()
+        scheduler.join()
+
+
+def main(args):
+    """"""
+    arg_parser = argparse.ArgumentParser(description='Keep the workbooks of a fleet of stations up to date as their Blue Cube day reports change. Unknown options are passed on to parse.py export-xlsx.')
+    arg_parser.add_argument('fleet_path')
+    arg_parser.add_argument('output_path')
+    arg_parser.add_argument('--concurrency', type=int, default=1, help='how many stations to update at once (default: 1)')
+    arg_parser.add_argument('--settle', type=float, default=SETTLE_SECONDS, metavar='SECONDS', help='how long a station\'s reports have to be left alone before it is updated (default: {0})'.format(SETTLE_SECONDS))
+    arg_parser.add_argument('--poll-interval', type=float, default=POLL_SECONDS, metavar='SECONDS', help='how often to look for changes when inotify isn\'t available (default: {0})'.format(POLL_SECONDS))
+    arg_parser.add_argument('--poll', action='store_true', help='poll even if inotify is available, for network file systems it doesn\'t see changes on')
+    opts, export_args = arg_parser.parse_known_args(args[1:])
+    if not any(a.startswith('--workers') for a in export_args):
+        # Stations run side by side, so each one gets a single worker unless told otherwise
+        export_args += ['--workers', '1']
+
+    if not os.path.isdir(opts.output_path):
+        os.makedirs(opts.output_path)
+    scheduler = IngestScheduler(StationUpdater(opts.fleet_path, opts.output_path, export_args), opts.concurrency, opts.settle)
+    watch(opts.fleet_path, scheduler, get_watcher(opts.fleet_path, opts.poll_interval, opts.poll))
+
+
+if __name__ == '__main__':
+    main(sys.argv)